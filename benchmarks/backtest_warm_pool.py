@@ -0,0 +1,63 @@
+"""
+Backtest the warm pool against a trace of job submission times, reporting
+the latency it saves against the instance-hours spent keeping workers warm.
+The trace is a file of unix timestamps, one per line. Without one, a
+synthetic trace of busy weekdays is used.
+
+    python benchmarks/backtest_warm_pool.py [trace] [train weeks] [boot time]
+"""
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ggprovisioner.forecast import backtest, HOUR, WEEK  # noqa
+
+# 2015-01-05T00:00:00Z, a Monday
+START = 1420416000
+
+
+def synthetic_trace(weeks, seed=1):
+    """
+    Jobs arriving through the working day on weekdays, busiest in the
+    morning, with a few overnight.
+    """
+    rnd = random.Random(seed)
+    arrivals = []
+    for week in range(weeks):
+        for day in range(7):
+            for hour in range(24):
+                if day < 5 and 9 <= hour < 17:
+                    rate = 12 if hour < 12 else 6
+                else:
+                    rate = 0.2
+                t = START + week * WEEK + (day * 24 + hour) * HOUR
+                end = t + HOUR
+                while True:
+                    t += rnd.expovariate(rate / float(HOUR))
+                    if t >= end:
+                        break
+                    arrivals.append(t)
+    return arrivals
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] != '-':
+        with open(sys.argv[1]) as f:
+            arrivals = [float(line) for line in f if line.strip()]
+    else:
+        arrivals = synthetic_trace(6)
+    train_weeks = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    boot_time = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+
+    results = {}
+    for coverage in (0.5, 0.8, 0.95):
+        results[str(coverage)] = backtest(arrivals, train_weeks, boot_time,
+                                          coverage=coverage)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
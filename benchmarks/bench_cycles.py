@@ -0,0 +1,55 @@
+"""
+Run the load simulator over a matrix of queue sizes and tenant counts,
+printing the per-phase latency, database round trips and EC2 calls of
+each. Every run is a separate process, as the provisioner's caches are
+singletons. Needs the Postgres server programs (initdb, pg_ctl) unless
+a server is given.
+
+    python benchmarks/bench_cycles.py [jobs,...] [tenants,...] [cycles]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from ggprovisioner.simulation.harness import format_report  # noqa
+
+
+def simulate(jobs, tenants, cycles):
+    (handle, path) = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        subprocess.check_call(
+            [sys.executable, '-m', 'ggprovisioner.simulation.harness',
+             '--jobs', str(jobs), '--tenants', str(tenants),
+             '--cycles', str(cycles), '--json', path],
+            cwd=ROOT, stdout=open(os.devnull, 'w'))
+        with open(path) as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def main():
+    jobs = [10, 1000, 100000]
+    tenants = [1, 10]
+    cycles = 3
+    if len(sys.argv) > 1:
+        jobs = [int(j) for j in sys.argv[1].split(',')]
+    if len(sys.argv) > 2:
+        tenants = [int(t) for t in sys.argv[2].split(',')]
+    if len(sys.argv) > 3:
+        cycles = int(sys.argv[3])
+    for t in tenants:
+        for j in jobs:
+            print format_report(simulate(j, t, cycles))
+            print
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+Time the functions on the decision hot path over a range of queue and
+catalog sizes. Each case is run several times and its best time is kept.
+Results can be saved as JSON and compared with a saved baseline, failing
+when a case has got slower than the threshold allows. Baselines are only
+comparable on the machine they were made on.
+
+    python benchmarks/bench_hot_paths.py --json baseline.json
+    python benchmarks/bench_hot_paths.py --baseline baseline.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from ggprovisioner import logger, Provisioner, ProvisionerConfig  # noqa
+from ggprovisioner.cloud.aws import Instance  # noqa
+from ggprovisioner.replay import RecordedProcess, RecordedResult  # noqa
+from ggprovisioner.scheduler import Job  # noqa
+from ggprovisioner.scheduler.condor import condor_scheduler  # noqa
+from ggprovisioner.tenant import Tenant  # noqa
+
+RESULTS_VERSION = 1
+
+ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d',
+         'us-east-1e']
+
+# (cpus, memory in GB) of the jobs in the queue
+SHAPES = [(1, 2), (2, 4), (4, 8), (4, 16), (8, 32), (16, 64)]
+
+
+class EmptyDatabase(object):
+    """
+    A database with no requests in it, so each job's existing requests
+    are looked up without waiting on a server.
+    """
+    def execute(self, statement, *args, **kwargs):
+        return RecordedResult([], [], 0)
+
+
+def make_catalog(size, seed=1):
+    rnd = random.Random(seed)
+    instances = []
+    for i in range(size):
+        cpus = 2 ** (i % 6)
+        ins = Instance(i, 'type%s.%s' % (i, cpus), 0.05 * cpus,
+                       cpus, 4 * cpus * (1 + i % 3), 100, 'ami-bench')
+        ins.spot = dict((zone, round(ins.ondemand * rnd.uniform(0.2, 0.9),
+                                     4))
+                        for zone in ZONES)
+        instances.append(ins)
+    return instances
+
+
+def make_jobs(count, seed=1):
+    rnd = random.Random(seed)
+    jobs = []
+    for i in range(count):
+        (cpus, memory) = SHAPES[rnd.randrange(len(SHAPES))]
+        jobs.append(Job('10.0.0.1', str(i), '1', '1420416000', cpus,
+                        memory, 10, {'tool': 'bwa', 'version': '0.7'}))
+    return jobs
+
+
+def make_tenant(jobs):
+    tenant = Tenant(1, 'bench', 'bench.example', '10.0.0.1', '10.0.0.1',
+                    ZONES[0], 'subnet-1', 1, 'vpc-1', 'sg-1', 'bench',
+                    1.0, 80, 0, 'AKIABENCH', 'secret', 'bench')
+    tenant.subnets = dict((zone, 'subnet-%s' % n)
+                          for (n, zone) in enumerate(ZONES))
+    tenant.subnets_db_id = dict((zone, n) for (n, zone) in enumerate(ZONES))
+    tenant.idle_jobs = list(jobs)
+    tenant.jobs = list(jobs)
+    return tenant
+
+
+def condor_q_output(count, seed=1):
+    """
+    The output of condor_q -global for a queue of jobs, in the format the
+    scheduler asks for.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(count):
+        (cpus, memory) = SHAPES[rnd.randrange(len(SHAPES))]
+        lines.append('10.0.0.1#%s.0#1420416000:%s:1:1420416000:%s:%s:10240:'
+                     '"tool=bwa,version=0.7,ondemand=false"0' %
+                     (i, i, cpus, memory * 1024))
+    return '\n'.join(lines) + '\n'
+
+
+def make_provisioner(catalog):
+    prov = Provisioner()
+    config = ProvisionerConfig()
+    config.catalog.load(catalog)
+    config.instance_types = config.catalog.instances
+    prov.load_candidates(catalog)
+    return prov
+
+
+# Each case makes the arguments to time a function with, outside of the
+# timing, and then calls the function
+
+def case_get_global_queue(queue, catalog):
+    output = condor_q_output(queue)
+    sched = condor_scheduler.CondorScheduler()
+
+    def setup():
+        condor_scheduler.popen = lambda cmd, **kwargs: RecordedProcess(
+            output, 0)
+        return ()
+    return (setup, sched.get_global_queue)
+
+
+def case_process_job_description(queue, catalog):
+    sched = condor_scheduler.CondorScheduler()
+    descriptions = ['"tool=bwa%s,version=0.7,ondemand=true"' % (i % 10)
+                    for i in range(queue)]
+
+    def run():
+        for desc in descriptions:
+            sched.process_job_description(desc)
+    return (lambda: (), run)
+
+
+def case_restrict_instances(queue, catalog):
+    jobs = make_jobs(queue)
+    prov = make_provisioner(make_catalog(catalog))
+
+    def setup():
+        # Fitting instances are cached between calls within a catalog
+        # version, start each run with an empty cache
+        ProvisionerConfig().catalog.fitting_cache = {}
+        return ()
+
+    def run():
+        for job in jobs:
+            prov.restrict_instances(job)
+    return (setup, run)
+
+
+def case_get_potential_instances(queue, catalog):
+    jobs = make_jobs(queue)
+    prov = make_provisioner(make_catalog(catalog))
+    eligible = [prov.restrict_instances(job) for job in jobs]
+
+    def setup():
+        prov.candidate_cache = {}
+        return ()
+
+    def run():
+        for (job, instances) in zip(jobs, eligible):
+            prov.get_potential_instances(instances, job)
+    return (setup, run)
+
+
+def case_check_ondemand_needed(queue, catalog):
+    jobs = make_jobs(queue)
+    prov = make_provisioner(make_catalog(catalog))
+    options = [prov.get_potential_instances(prov.restrict_instances(job),
+                                            job) for job in jobs]
+    tenant = make_tenant(jobs)
+
+    def run():
+        for (job, sorted_instances) in zip(jobs, options):
+            prov.check_ondemand_needed(tenant, sorted_instances, job)
+    return (lambda: (), run)
+
+
+def case_select_instance_type(queue, catalog):
+    instances = make_catalog(catalog)
+    prov = make_provisioner(instances)
+    ProvisionerConfig().dbconn = EmptyDatabase()
+
+    def setup():
+        prov.tenants = [make_tenant(make_jobs(queue))]
+        return (instances,)
+    return (setup, prov.select_instance_type)
+
+
+def case_repr(queue, catalog):
+    jobs = make_jobs(queue)
+    candidates = make_provisioner(make_catalog(catalog)).candidates
+    requests = [candidates[i % len(candidates)].request()
+                for i in range(queue)]
+
+    def run():
+        for job in jobs:
+            repr(job)
+        for req in requests:
+            repr(req)
+    return (lambda: (), run)
+
+
+CASES = [('get_global_queue', case_get_global_queue, False),
+         ('process_job_description', case_process_job_description, False),
+         ('restrict_instances', case_restrict_instances, True),
+         ('get_potential_instances', case_get_potential_instances, True),
+         ('check_ondemand_needed', case_check_ondemand_needed, True),
+         ('select_instance_type', case_select_instance_type, True),
+         ('repr', case_repr, True)]
+
+
+def measure(setup, run, repeat):
+    """
+    The best time of a number of runs. The collector is turned off while
+    timing, as it is in timeit.
+    """
+    best = None
+    for x in range(repeat):
+        args = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = timeit.default_timer()
+            run(*args)
+            elapsed = timeit.default_timer() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_cases(queues, catalogs, repeat, only=None):
+    results = {}
+    for (name, case, uses_catalog) in CASES:
+        if only is not None and only not in name:
+            continue
+        for queue in queues:
+            for catalog in (catalogs if uses_catalog else [None]):
+                key = '%s[queue=%s' % (name, queue)
+                if catalog is not None:
+                    key += ',catalog=%s' % catalog
+                key += ']'
+                (setup, run) = case(queue, catalog)
+                seconds = measure(setup, run, repeat)
+                results[key] = {'function': name, 'queue': queue,
+                                'catalog': catalog, 'seconds': seconds}
+                print "%-60s %10.3f ms" % (key, seconds * 1000)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Find the cases that have got slower than the baseline by more than
+    the threshold, a fraction of the baseline's time.
+    """
+    regressions = []
+    for (key, measured) in sorted(results.iteritems()):
+        before = baseline.get(key)
+        if before is None or before['seconds'] <= 0:
+            continue
+        change = measured['seconds'] / before['seconds'] - 1
+        if change > threshold:
+            regressions.append((key, before['seconds'], measured['seconds'],
+                                change))
+    return regressions
+
+
+def parse_sizes(value):
+    return [int(v) for v in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the decision hot paths and check them against '
+        'a baseline.')
+    parser.add_argument('--queue', type=parse_sizes,
+                        default=[100, 1000, 10000],
+                        help='the numbers of queued jobs, comma separated')
+    parser.add_argument('--catalog', type=parse_sizes, default=[10, 50],
+                        help='the numbers of instance types')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None,
+                        help='only run the cases of matching functions')
+    parser.add_argument('--json', default=None,
+                        help='save the results to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='compare the results with a saved file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='the slowdown allowed before a case fails, as '
+                        'a fraction of the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.chdir(ROOT)
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    ProvisionerConfig(connect=False)
+
+    results = run_cases(args.queue, args.catalog, args.repeat, args.only)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for (key, before, after, change) in regressions:
+            print "REGRESSED %s: %.3f ms -> %.3f ms (+%.0f%%)" % (
+                key, before * 1000, after * 1000, change * 100)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print "No regressions beyond %.0f%%." % (args.threshold * 100)
+
+
+if __name__ == '__main__':
+    main()
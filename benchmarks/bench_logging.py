@@ -0,0 +1,85 @@
+"""
+Time the logging done by a decision loop at DEBUG and INFO, written either
+synchronously or through the queue handler.
+
+    python benchmarks/bench_logging.py [jobs] [candidates]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ggprovisioner import log  # noqa
+from ggprovisioner.log import LazyRepr, fields  # noqa
+from ggprovisioner.scheduler import Job  # noqa
+
+
+def make_jobs(count):
+    return [Job('10.0.0.1', str(i), 1, 0, 4, 8, 10,
+                {'tool': 'bwa', 'version': '0.7'}) for i in range(count)]
+
+
+def decision_loop(logger, jobs, candidates):
+    """
+    The logging pattern of select_instance_type: a record per job and a
+    record per candidate considered for it.
+    """
+    for job in jobs:
+        logger.debug("Selecting instance for job %s", LazyRepr(job))
+        for i in range(candidates):
+            logger.debug("Request already exists",
+                         extra=fields(job=job.id, type='m4.large',
+                                      zone='us-east-1a'))
+        logger.info("Launching for job %s", job.id)
+
+
+def run(level, queued, jobs, candidates):
+    logger = logging.getLogger('bench-%s-%s' % (level, queued))
+    logger.propagate = False
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    listener = None
+    try:
+        if queued:
+            listener = log.setup_logging(logger, level, filename=path,
+                                         console=False, rate=10 ** 9)
+        else:
+            handler = logging.FileHandler(path)
+            handler.setFormatter(log.StructuredFormatter(
+                '%(asctime)s %(levelname)s %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(level)
+
+        start = time.time()
+        decision_loop(logger, jobs, candidates)
+        elapsed = time.time() - start
+
+        if listener is not None:
+            listener.stop()
+    finally:
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+        os.remove(path)
+    return elapsed
+
+
+def main(argv):
+    job_count = int(argv[1]) if len(argv) > 1 else 500
+    candidates = int(argv[2]) if len(argv) > 2 else 20
+    jobs = make_jobs(job_count)
+
+    print("%s jobs, %s candidates each" % (job_count, candidates))
+    for level in (logging.DEBUG, logging.INFO):
+        for queued in (False, True):
+            elapsed = run(level, queued, jobs, candidates)
+            print("%-7s %-12s %8.1f ms" % (
+                logging.getLevelName(level),
+                'queued' if queued else 'synchronous', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
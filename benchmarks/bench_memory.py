@@ -0,0 +1,136 @@
+"""
+Measure the memory and time taken selecting launch options for a large
+queue, comparing a dict-backed Request per (job, type, zone) with slotted
+jobs sharing one sorted list of candidates.
+
+    python benchmarks/bench_memory.py [jobs]
+"""
+import gc
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ggprovisioner.cloud.aws import Instance  # noqa
+from ggprovisioner.cloud.aws.request import make_candidates  # noqa
+from ggprovisioner.scheduler import Job  # noqa
+
+ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d',
+         'us-east-1e']
+
+
+class DictJob(object):
+    """
+    A job the way it was stored before it had slots.
+    """
+    def __init__(self, *args, **kwargs):
+        job = Job(*args, **kwargs)
+        for name in Job.__slots__:
+            setattr(self, name, getattr(job, name))
+
+
+class DictRequest(object):
+    """
+    A request the way it was stored before it had slots.
+    """
+    def __init__(self, instance, instance_type, zone, ami, count, bid=0,
+                 ondemand=False, odp=0, price=0):
+        self.instance = instance
+        self.instance_type = instance_type
+        self.zone = zone
+        self.ami = ami
+        self.count = count
+        self.bid = bid
+        self.ondemand = ondemand
+        self.odp = odp
+        self.price = price
+
+
+def make_instances(count=20):
+    instances = []
+    for i in range(count):
+        ins = Instance(i, 'type%s' % i, 0.1 * (i + 1), 2 ** (i % 6),
+                       4 * 2 ** (i % 6), 10, 'ami')
+        ins.spot = dict((zone, 0.03 * (i + 1) + 0.001 * z)
+                        for (z, zone) in enumerate(ZONES))
+        instances.append(ins)
+    return instances
+
+
+def legacy(jobs, instances):
+    """
+    Make and sort a request per option for each job, keeping the cheapest.
+    """
+    held = []
+    for i in range(jobs):
+        job = DictJob('10.0.0.1', str(i), 1, 0, 1, 1)
+        options = []
+        for ins in instances:
+            options.append(DictRequest(ins, ins.type, "", ins.ami, 1, 0, True,
+                                       ins.ondemand, ins.ondemand))
+            for zone, price in ins.spot.iteritems():
+                options.append(DictRequest(ins, ins.type, zone, ins.ami, 1, 0,
+                                           False, ins.ondemand, price))
+        job.launch = sorted(options, key=lambda k: k.price)[0]
+        held.append(job)
+    return held
+
+
+def shared(jobs, instances):
+    """
+    Share one sorted list of candidates between the slotted jobs, only
+    making a request for the cheapest.
+    """
+    candidates = make_candidates(instances)
+    held = []
+    for i in range(jobs):
+        job = Job('10.0.0.1', str(i), 1, 0, 1, 1)
+        job.launch = candidates[0].request()
+        held.append(job)
+    return held
+
+
+def rss():
+    """
+    The resident set size of this process in bytes.
+    """
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize()
+
+
+def measure(mode, jobs):
+    instances = make_instances()
+    gc.collect()
+    before = rss()
+    start = time.time()
+    held = globals()[mode](jobs, instances)
+    elapsed = time.time() - start
+    after = rss()
+    # A full collection has to traverse everything the jobs hold on to
+    gc_start = time.time()
+    gc.collect()
+    gc_elapsed = time.time() - gc_start
+    print("%-7s %8.1f MB %9.1f ms to select %8.1f ms to collect" % (
+        mode, (after - before) / 1048576.0, elapsed * 1000,
+        gc_elapsed * 1000))
+    return held
+
+
+def main(argv):
+    jobs = int(argv[1]) if len(argv) > 1 else 100000
+    if len(argv) > 2:
+        measure(argv[2], jobs)
+        return
+    print("%s idle jobs, %s launch options each" % (
+        jobs, len(make_candidates(make_instances()))))
+    # Run each mode in its own process so they don't share freed memory
+    for mode in ('legacy', 'shared'):
+        subprocess.check_call([sys.executable, __file__, str(jobs), mode])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
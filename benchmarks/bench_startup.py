@@ -0,0 +1,163 @@
+"""
+Time how long the provisioner's commands take to start, each in a new
+interpreter as it would be run. Each case is run several times and its
+best time is kept, along with which of the heavy dependencies it
+imported. Results can be saved as JSON and compared with a saved baseline,
+failing when a case has got slower than the threshold allows or has
+started importing a dependency it didn't before.
+
+    python benchmarks/bench_startup.py --json baseline.json
+    python benchmarks/bench_startup.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+RESULTS_VERSION = 1
+
+# The modules that make starting slow, and must only be imported by the
+# commands that use them
+HEAVY = ['boto', 'sqlalchemy', 'psycopg2']
+
+# Each case is a script run by a new interpreter. It prints how long it
+# took from before its first import and the heavy modules it imported.
+PREAMBLE = """
+import sys, time
+start = time.time()
+"""
+
+REPORT = """
+print time.time() - start
+print ','.join(m for m in %r if m in sys.modules)
+""" % HEAVY
+
+CASES = [
+    ('import ggprovisioner', 'import ggprovisioner'),
+    ('import cli', 'from ggprovisioner import cli'),
+    ('cli --help', """
+from ggprovisioner import cli
+try:
+    cli.parse_args(['--help'])
+except SystemExit:
+    pass
+"""),
+    ('cli status', """
+from ggprovisioner import cli
+cli.main(['status', '--config', CONFIG])
+"""),
+    ('import config', 'from ggprovisioner import ProvisionerConfig'),
+    ('import provisioner', 'from ggprovisioner import Provisioner')]
+
+
+def measure(body, repeat, config):
+    """
+    The best time of a number of runs of a case, and the heavy modules it
+    imported.
+    """
+    script = PREAMBLE + 'CONFIG = %r\n' % config + body + REPORT
+    best = None
+    for x in range(repeat):
+        with open(os.devnull, 'w') as null:
+            output = subprocess.check_output(
+                [sys.executable, '-c', script], cwd=ROOT, stderr=null)
+        # Anything the command printed comes before the report
+        (seconds, imported) = output.splitlines()[-2:]
+        seconds = float(seconds)
+        if best is None or seconds < best:
+            best = seconds
+    return {'seconds': best,
+            'imported': [m for m in imported.split(',') if m]}
+
+
+def run_cases(repeat, config, only=None):
+    results = {}
+    for (name, body) in CASES:
+        if only is not None and only not in name:
+            continue
+        results[name] = measure(body, repeat, config)
+        print "%-30s %10.3f ms  %s" % (
+            name, results[name]['seconds'] * 1000,
+            ','.join(results[name]['imported']) or '-')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Find the cases that have got slower than the baseline by more than
+    the threshold, a fraction of the baseline's time, or that import a
+    heavy module they didn't.
+    """
+    regressions = []
+    for (key, measured) in sorted(results.iteritems()):
+        before = baseline.get(key)
+        if before is None or before['seconds'] <= 0:
+            continue
+        change = measured['seconds'] / before['seconds'] - 1
+        added = set(measured['imported']) - set(before['imported'])
+        if change > threshold or len(added) > 0:
+            regressions.append((key, before['seconds'], measured['seconds'],
+                                change, sorted(added)))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time how long the commands take to start and check '
+        'them against a baseline.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None,
+                        help='only run the matching cases')
+    parser.add_argument('--json', default=None,
+                        help='save the results to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='compare the results with a saved file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='the slowdown allowed before a case fails, as '
+                        'a fraction of the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The status command reads a copy of the default configuration, so a
+    # checkpoint left in the tree isn't read
+    directory = tempfile.mkdtemp()
+    config = os.path.join(directory, 'provisioner.ini')
+    with open(os.path.join(ROOT, 'ggprovisioner', 'provisioner.ini')) as f:
+        settings = f.read()
+    with open(config, 'w') as f:
+        f.write(settings.replace(
+            'path: checkpoint.json.gz',
+            'path: %s' % os.path.join(directory, 'checkpoint.json.gz')))
+    try:
+        results = run_cases(args.repeat, config, args.only)
+    finally:
+        os.remove(config)
+        os.rmdir(directory)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for (key, before, after, change, added) in regressions:
+            print "REGRESSED %s: %.3f ms -> %.3f ms (+%.0f%%)%s" % (
+                key, before * 1000, after * 1000, change * 100,
+                ', now imports %s' % ','.join(added) if added else '')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print "No regressions beyond %.0f%%." % (args.threshold * 100)
+
+
+if __name__ == '__main__':
+    main()
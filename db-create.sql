@@ -49,6 +49,14 @@ virtualization varchar(255),
 available boolean default True
 );
 
+CREATE TABLE IF NOT EXISTS instance_region(
+instance_type integer not null,
+region varchar(255) not null,
+ami varchar(255) not null,
+PRIMARY KEY (instance_type, region),
+CONSTRAINT fk1_instance_type FOREIGN KEY (instance_type) REFERENCES instance_type (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE
+);
+
 CREATE TABLE IF NOT EXISTS instance_request(
 id bigserial primary key,
 tenant integer not null,
@@ -84,3 +92,99 @@ to_job integer not null,
 migration_time timestamp default now(),
 CONSTRAINT fk2_request FOREIGN KEY (request_id) REFERENCES instance_request (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE
 );
+
+CREATE TABLE IF NOT EXISTS instance_migration(
+id serial primary key,
+instance_id varchar(255) not null,
+from_job integer,
+to_job integer not null,
+migration_time timestamp default now()
+);
+
+CREATE TABLE IF NOT EXISTS instance_request_job(
+request bigint not null,
+job_runner_id integer not null,
+cpus integer not null,
+PRIMARY KEY (request, job_runner_id),
+CONSTRAINT fk1_request FOREIGN KEY (request) REFERENCES instance_request (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS job_history(
+id bigserial primary key,
+tenant integer not null,
+job_runner_id integer not null,
+cpus integer not null,
+memory integer not null,
+submit_time timestamp not null,
+CONSTRAINT fk1_tenant FOREIGN KEY (tenant) REFERENCES tenant (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS job_history_tenant_time ON job_history (tenant, submit_time);
+
+CREATE INDEX IF NOT EXISTS job_history_tenant_job ON job_history (tenant, job_runner_id);
+
+CREATE TABLE IF NOT EXISTS provisioner_replica(
+replica_id text primary key,
+heartbeat timestamp not null default now()
+);
+
+CREATE TABLE IF NOT EXISTS launch_outbox(
+id bigserial primary key,
+tenant integer not null,
+job_runner_id integer not null,
+instance_type integer not null,
+request_type text not null,
+price numeric not null,
+zone text,
+count integer not null default 1,
+packed_jobs integer[],
+packed_cpus integer[],
+client_token text not null unique default md5(random()::text || clock_timestamp()::text),
+state text not null default 'pending',
+attempts integer not null default 0,
+created timestamp not null default now(),
+claimed_time timestamp,
+error text,
+CONSTRAINT fk1_tenant FOREIGN KEY (tenant) REFERENCES tenant (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE,
+CONSTRAINT fk2_instance_type FOREIGN KEY (instance_type) REFERENCES instance_type (id) MATCH SIMPLE ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS launch_outbox_tenant_state ON launch_outbox (tenant, state);
+
+CREATE OR REPLACE VIEW job_request AS
+select instance_request.id as request, instance_request.tenant,
+coalesce(instance_request_job.job_runner_id, instance_request.job_runner_id) as job_runner_id,
+coalesce(instance_request_job.cpus, instance_type.cpus) as cpus,
+instance_request.request_type, instance_request.request_time
+from instance_request join instance_type on instance_type.id = instance_request.instance_type
+left join instance_request_job on instance_request_job.request = instance_request.id
+union all
+select null, launch_outbox.tenant,
+coalesce(packed.job, launch_outbox.job_runner_id) as job_runner_id,
+coalesce(packed.cpus, instance_type.cpus) as cpus,
+launch_outbox.request_type, launch_outbox.created
+from launch_outbox join instance_type on instance_type.id = launch_outbox.instance_type
+left join lateral unnest(launch_outbox.packed_jobs, launch_outbox.packed_cpus) as packed (job, cpus) on true
+where launch_outbox.state in ('pending', 'launching');
+
+CREATE OR REPLACE FUNCTION notify_tenant_changed() RETURNS trigger AS $$ BEGIN PERFORM pg_notify('tenant_changed', TG_TABLE_NAME); RETURN NULL; END; $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tenant_changed ON tenant;
+CREATE TRIGGER tenant_changed AFTER INSERT OR UPDATE OR DELETE ON tenant FOR EACH STATEMENT EXECUTE PROCEDURE notify_tenant_changed();
+
+DROP TRIGGER IF EXISTS tenant_changed ON tenant_settings;
+CREATE TRIGGER tenant_changed AFTER INSERT OR UPDATE OR DELETE ON tenant_settings FOR EACH STATEMENT EXECUTE PROCEDURE notify_tenant_changed();
+
+DROP TRIGGER IF EXISTS tenant_changed ON aws_credentials;
+CREATE TRIGGER tenant_changed AFTER INSERT OR UPDATE OR DELETE ON aws_credentials FOR EACH STATEMENT EXECUTE PROCEDURE notify_tenant_changed();
+
+DROP TRIGGER IF EXISTS tenant_changed ON subnet_mapping;
+CREATE TRIGGER tenant_changed AFTER INSERT OR UPDATE OR DELETE ON subnet_mapping FOR EACH STATEMENT EXECUTE PROCEDURE notify_tenant_changed();
+
+CREATE OR REPLACE FUNCTION notify_instance_type_changed() RETURNS trigger AS $$ BEGIN PERFORM pg_notify('instance_type_changed', TG_TABLE_NAME); RETURN NULL; END; $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS instance_type_changed ON instance_type;
+CREATE TRIGGER instance_type_changed AFTER INSERT OR UPDATE OR DELETE ON instance_type FOR EACH STATEMENT EXECUTE PROCEDURE notify_instance_type_changed();
+
+DROP TRIGGER IF EXISTS instance_type_changed ON instance_region;
+CREATE TRIGGER instance_type_changed AFTER INSERT OR UPDATE OR DELETE ON instance_region FOR EACH STATEMENT EXECUTE PROCEDURE notify_instance_type_changed();
@@ -1,10 +1,38 @@
+import importlib
 import logging
+import sys
+import types
 
 from .singleton import Singleton
 from .simplestringifiable import SimpleStringifiable
 
 logger = logging.getLogger('ggprovisioner')
 
-from .config import ProvisionerConfig
+# The config and the provisioner bring in boto, SQLAlchemy and psycopg2, so
+# they are only imported when first used. Commands that don't need them
+# start without paying for them.
+LAZY = {'ProvisionerConfig': '.config',
+        'Provisioner': '.provisioner'}
 
-from .provisioner import Provisioner
+
+class LazyModule(types.ModuleType):
+    """
+    The package, importing the names in LAZY the first time they are
+    looked up.
+    """
+    def __getattr__(self, name):
+        if name not in LAZY:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        value = getattr(importlib.import_module(LAZY[name], self.__name__),
+                        name)
+        setattr(self, name, value)
+        return value
+
+
+lazy = LazyModule(__name__)
+lazy.__dict__.update(sys.modules[__name__].__dict__)
+# The functions of this module look up their globals in the original, so
+# it must live as long as the package does
+lazy.original = sys.modules[__name__]
+sys.modules[__name__] = lazy
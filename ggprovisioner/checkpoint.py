@@ -0,0 +1,176 @@
+import decimal
+import gzip
+import json
+import os
+import time
+
+from ggprovisioner import logger
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(object):
+    """
+    Save the provisioner's caches to a local file every few cycles and
+    load them again on startup, so the first cycle after a restart only
+    picks up what has changed instead of starting from nothing.
+    The instance catalog and its spot prices, the last known state of
+    each tenant's instances and the job arrival forecasts are kept. A
+    checkpoint older than max_age is ignored, and its spot prices are only
+    used in place of fetching them if they are younger than price_age.
+    Tenants are always reloaded, so no credentials are written.
+    """
+    def __init__(self, path, interval=1, max_age=600, price_age=300):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.price_age = price_age
+        self.cycle = 0
+
+    def cycle_finished(self, prov):
+        """
+        Count a finished cycle, saving a checkpoint after every interval.
+        """
+        self.cycle += 1
+        if self.cycle % self.interval == 0:
+            self.save(prov)
+
+    def save(self, prov):
+        """
+        Write the caches to the checkpoint file. The file is replaced in
+        one step so a crash while saving leaves the last one whole.
+        """
+        state = snapshot(prov)
+        temp = '%s.tmp' % self.path
+        try:
+            with gzip.open(temp, 'wb') as f:
+                f.write(json.dumps(state))
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            logger.exception("Failed to save the checkpoint to %s." %
+                             self.path)
+            return False
+        logger.debug("Saved a checkpoint to %s.", self.path)
+        return True
+
+    def load(self, prov):
+        """
+        Restore the caches from the checkpoint file, if there is one that
+        is recent enough. Returns whether it was loaded.
+        """
+        state = read(self.path)
+        if state is None:
+            return False
+
+        age = time.time() - state.get('time', 0)
+        if state.get('version') != CHECKPOINT_VERSION:
+            logger.info("Ignoring a checkpoint of version %s.",
+                        state.get('version'))
+            return False
+        if age > self.max_age:
+            logger.info("Ignoring a checkpoint %d seconds old.", age)
+            return False
+        restore(prov, state, time.time() - state['prices_time'] <
+                self.price_age)
+        logger.info("Loaded a checkpoint %d seconds old.", age)
+        return True
+
+
+def read(path):
+    """
+    Read a checkpoint file, or get None if there isn't a readable one.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, 'rb') as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        logger.exception("Failed to read the checkpoint %s." % path)
+    return None
+
+
+def snapshot(prov):
+    """
+    The caches of a provisioner, as something that can be written as
+    JSON. Decimals are kept as strings so they come back exactly.
+    """
+    # These are imported here so reading a checkpoint, e.g. for the status
+    # command, doesn't import boto and the database drivers
+    from ggprovisioner import ProvisionerConfig
+    from ggprovisioner.cloud.aws.tracker import InstanceTracker
+    from ggprovisioner.forecast import Forecaster
+
+    catalog = ProvisionerConfig().catalog
+    tracker = InstanceTracker()
+    forecaster = Forecaster()
+    return {
+        'version': CHECKPOINT_VERSION,
+        'time': time.time(),
+        'prices_time': prov.prices_time,
+        'catalog': {
+            'version': catalog.version,
+            'loaded_time': catalog.loaded_time,
+            'instances': [
+                [ins.db_id, ins.type, str(ins.ondemand), ins.cpus,
+                 str(ins.memory), str(ins.disk), ins.ami, ins.amis,
+                 ins.spot] for ins in catalog.instances]},
+        'tracker': {
+            'states': tracker.states,
+            'retries': tracker.retries},
+        'forecast': {
+            'tenants': forecaster.tenants,
+            'recorded': dict((db_id, list(jobs)) for (db_id, jobs)
+                             in forecaster.recorded.iteritems())}}
+
+
+def restore(prov, state, prices_fresh):
+    """
+    Put the caches of a snapshot back. If the spot prices are fresh the
+    provisioner uses them for its first cycle rather than fetching them.
+    """
+    from ggprovisioner import ProvisionerConfig
+    from ggprovisioner.cloud.aws import Instance
+    from ggprovisioner.cloud.aws.tracker import InstanceTracker
+    from ggprovisioner.forecast import Forecaster
+    from ggprovisioner.listener import ChangeListener
+
+    config = ProvisionerConfig()
+    instances = []
+    for (db_id, ins_type, ondemand, cpus, memory, disk, ami, amis,
+         spot) in state['catalog']['instances']:
+        ins = Instance(db_id, ins_type, decimal.Decimal(ondemand), cpus,
+                       decimal.Decimal(memory), decimal.Decimal(disk), ami)
+        ins.amis = amis
+        ins.spot = spot
+        instances.append(ins)
+    # Anything derived from the catalog must still see a new version
+    config.catalog.version = max(config.catalog.version,
+                                 state['catalog']['version'])
+    config.catalog.load(instances, state['catalog']['loaded_time'])
+    config.instance_types = config.catalog.instances
+    # The catalog is reloaded when it expires, not straight away
+    listener = ChangeListener()
+    listener.listen('instance_type_changed')
+    listener.pending.discard('instance_type_changed')
+    if prices_fresh:
+        prov.prices_time = state['prices_time']
+        prov.restored_prices = config.catalog.version
+
+    # JSON keys are strings, tenants are keyed by their db ids
+    tracker = InstanceTracker()
+    tracker.states = int_keys(state['tracker']['states'])
+    tracker.retries = int_keys(state['tracker']['retries'])
+
+    forecaster = Forecaster()
+    forecaster.tenants = dict(
+        (db_id, (loaded, rates, tuple(shape) if shape else None))
+        for (db_id, (loaded, rates, shape))
+        in int_keys(state['forecast']['tenants']).iteritems())
+    forecaster.recorded = dict(
+        (db_id, set(jobs)) for (db_id, jobs)
+        in int_keys(state['forecast']['recorded']).iteritems())
+
+
+def int_keys(d):
+    return dict((int(k), v) for (k, v) in d.iteritems())
@@ -1,21 +1,378 @@
+import argparse
 import logging
+import sys
+import time
 
-from ggprovisioner import logger, Provisioner
+from ggprovisioner import logger
 
+# Each command imports what it needs when it is run, so the commands that
+# only read local files start without importing boto or the database
+# drivers, and without connecting to anything
+COMMANDS = ['run', 'status', 'prices', 'plan']
 
-def main():
-    hdlr = logging.FileHandler('provisioner.log')
+DEFAULT_CONFIG = 'ggprovisioner/provisioner.ini'
 
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-    hdlr.setFormatter(formatter)
-    logger.addHandler(hdlr)
-    logger.setLevel(logging.DEBUG)
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(formatter)
-    logger.addHandler(consoleHandler)
 
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # Without a command the provisioner is run, as it always has been
+    if len(argv) == 0 or (argv[0] not in COMMANDS and
+                          argv[0] not in ('-h', '--help')):
+        argv = ['run'] + list(argv)
+
+    parser = argparse.ArgumentParser(
+        description='Provision cloud resources for idle jobs.')
+    commands = parser.add_subparsers(dest='command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='the configuration file to read')
+    common.add_argument('--log-level', default='DEBUG',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='the lowest level of message to log')
+
+    run = commands.add_parser(
+        'run', parents=[common],
+        help='provision resources, the default command')
+    run.add_argument('--cycles', type=int, default=None,
+                     help='stop after running this many cycles')
+    run.add_argument('--profile', choices=['cprofile', 'sample'],
+                     default=None,
+                     help='profile every cycle from the start. Either way '
+                     'SIGUSR1 turns profiling on and off while running')
+    run.add_argument('--profile-dir', default='profiles',
+                     help='where profiles are written, one per phase')
+    run.add_argument('--record', default=None, metavar='TRACE',
+                     help='record the inputs of every cycle to a trace')
+    run.add_argument('--replay', default=None, metavar='TRACE',
+                     help='replay the cycles of a trace offline rather '
+                     'than provisioning')
+    run.add_argument('--strict', action='store_true',
+                     help='stop a replay at the first call that was not '
+                     'recorded')
+
+    status = commands.add_parser(
+        'status', parents=[common],
+        help='show the settings and the last checkpoint')
+    status.add_argument('--database', action='store_true',
+                        help='also count the open requests and pending '
+                        'launches in the database')
+
+    prices = commands.add_parser(
+        'prices', parents=[common],
+        help='show the spot prices of the shared price table or the last '
+        'checkpoint')
+    prices.add_argument('--live', action='store_true',
+                        help='fetch the current prices from EC2 instead, '
+                        'with the credentials of the first tenant')
+    prices.add_argument('--type', default=None, dest='instance_type',
+                        help='only show this instance type')
+    prices.add_argument('--limit', type=int, default=None,
+                        help='only show this many of the cheapest prices')
+
+    commands.add_parser(
+        'plan', parents=[common],
+        help='show what would be launched for the idle jobs, without '
+        'launching anything')
+
+    args = parser.parse_args(argv)
+    # The read-only commands print their results, so only warnings are
+    # logged unless asked for more
+    if args.command != 'run' and '--log-level' not in argv:
+        args.log_level = 'WARNING'
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    {'run': run, 'status': status, 'prices': prices,
+     'plan': plan}[args.command](args)
+
+
+def run(args):
+    """
+    Run the provisioner, or replay a trace of its cycles.
+    """
+    from ggprovisioner import log, metrics, profiling, replay
+    from ggprovisioner import Provisioner, ProvisionerConfig
+
+    # Records are written by a background thread, so a cycle never waits
+    # on the log file or the console
+    log.setup_logging(logger, getattr(logging, args.log_level))
+
+    # The sampler has lower overhead, but cProfile counts every call
+    if args.profile == 'sample':
+        profiler = profiling.StackSampler()
+    else:
+        profiler = profiling.PhaseProfiler()
+    profiling.install_toggle(profiler, args.profile_dir)
+
+    if args.replay is not None:
+        replay_trace(args, profiler)
+        return
+
+    config = ProvisionerConfig(config_file=args.config)
+    prov = Provisioner(profiler)
+    recorder = None
+    if args.record is not None:
+        recorder = replay.Recorder(args.record)
+        recorder.attach(prov)
+
+    if config.metrics_enabled:
+        metrics.start_server(config.metrics_port, config.engine)
+
+    if args.profile is not None:
+        profiler.start()
+    try:
+        prov.run(args.cycles)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if profiler.active:
+            profiler.stop()
+            profiler.dump(args.profile_dir)
+
+
+def replay_trace(args, profiler):
+    """
+    Replay the cycles of a trace, profiling them if asked to, and report
+    the calls that did not match the recording.
+    """
+    from ggprovisioner import replay
+
+    replayer = replay.Replayer(args.replay, args.strict)
+    if args.profile is not None:
+        profiler.start()
+    try:
+        result = replayer.run(profiler, args.cycles)
+    finally:
+        if profiler.active:
+            profiler.stop()
+            profiler.dump(args.profile_dir)
+    logger.info("Replayed %s cycles: %s calls were not recorded and %s "
+                "recorded calls were not made.", result['cycles'],
+                sum(result['missing']), sum(result['unused']))
+
+
+def console_logging(args):
+    """
+    Log to the console only, the provisioner's log file is left to it.
+    """
+    from ggprovisioner import log
+
+    log.setup_logging(logger, getattr(logging, args.log_level),
+                      filename=None)
+
+
+def read_settings(path):
+    """
+    Read the configuration file without the config, which would import
+    the database drivers and connect.
+    """
+    import ConfigParser
+
+    settings = ConfigParser.ConfigParser()
+    if len(settings.read(path)) == 0:
+        sys.exit("Could not read the configuration file %s." % path)
+    return settings
+
+
+def read_checkpoint(settings):
+    """
+    The path of the checkpoint and what it holds, or None if there isn't
+    one to read.
+    """
+    from ggprovisioner import checkpoint
+
+    path = 'checkpoint.json.gz'
+    if settings.has_option('Checkpoint', 'path'):
+        path = settings.get('Checkpoint', 'path')
+    return (path, checkpoint.read(path))
+
+
+def read_price_table(settings):
+    """
+    The path of the shared price table and when it was refreshed and its
+    entries, or None if there isn't one. The path is None if the table
+    isn't used.
+    """
+    from ggprovisioner import pricecache
+
+    if (not settings.has_option('PriceCache', 'enabled') or
+            not settings.getboolean('PriceCache', 'enabled')):
+        return (None, None)
+    path = settings.get('PriceCache', 'path')
+    return (path, pricecache.PriceCache(path).entries())
+
+
+def status(args):
+    """
+    Show the settings and what the last checkpoint holds. Nothing is
+    connected to unless the database is asked for.
+    """
+    console_logging(args)
+    settings = read_settings(args.config)
+
+    def enabled(section):
+        if not settings.has_option(section, 'enabled'):
+            return 'off'
+        return 'on' if settings.getboolean(section, 'enabled') else 'off'
+
+    print "Launch mode:  %s" % settings.get('Provision', 'launch_mode')
+    print "Regions:      %s" % (settings.get('Provision', 'regions') or
+                                'the default')
+    print "Run rate:     %ss" % settings.get('Provision', 'run_rate')
+    for section in ['ScaleIn', 'WarmPool', 'Outbox', 'Sharding', 'Checkpoint',
+                    'PriceCache', 'Metrics', 'Memory']:
+        print "%-13s %s" % (section + ':', enabled(section))
+
+    (path, state) = read_checkpoint(settings)
+    if state is None:
+        print "Last checkpoint: none at %s" % path
+    else:
+        now = time.time()
+        instances = state['catalog']['instances']
+        print "Last checkpoint: %s, %ds old" % (path, now - state['time'])
+        print "  Prices:        %ds old, %d instance types, %d prices" % (
+            now - state['prices_time'], len(instances),
+            sum(len(ins[-1]) for ins in instances))
+        print "  Tracked:       %d instances of %d tenants" % (
+            sum(len(s) for s in state['tracker']['states'].itervalues()),
+            len(state['tracker']['states']))
+
+    (path, table) = read_price_table(settings)
+    if path is not None and table is None:
+        print "Price table:     none at %s" % path
+    elif path is not None:
+        (refreshed, entries) = table
+        print "Price table:     %s, %ds old, %d prices" % (
+            path, time.time() - refreshed, len(entries))
+
+    if args.database:
+        database_status(args)
+
+
+def database_status(args):
+    """
+    Count the open requests and the launches waiting in the outbox.
+    """
+    from ggprovisioner import ProvisionerConfig
+
+    config = ProvisionerConfig(config_file=args.config)
+    if config.dbconn is None:
+        sys.exit("Could not connect to the database.")
+    rows = config.dbconn.execute(
+        "select tenant.name, count(instance_request.id) from tenant "
+        "left join instance_request on instance_request.tenant = tenant.id "
+        "left join instance on instance.request_id = instance_request.id "
+        "where instance.id is null "
+        "group by tenant.name order by tenant.name")
+    print "Open requests:"
+    for (name, count) in rows:
+        print "  %-20s %d" % (name, count)
+    rows = config.dbconn.execute(
+        "select state, count(*) from launch_outbox where state in "
+        "('pending', 'launching', 'failed') group by state order by state")
+    print "Outbox:"
+    for (state, count) in rows:
+        print "  %-20s %d" % (state, count)
+
+
+def prices(args):
+    """
+    Show the spot prices, cheapest first, from the shared price table if
+    there is one, the last checkpoint, or fetched from EC2. The table
+    doesn't hold the ondemand prices.
+    """
+    console_logging(args)
+    if args.live:
+        rows = live_prices(args)
+    else:
+        settings = read_settings(args.config)
+        (path, table) = read_price_table(settings)
+        if table is not None:
+            (refreshed, entries) = table
+            print "Prices from %s, %ds old" % (path,
+                                               time.time() - refreshed)
+            rows = [(e.instance_type, e.zone, e.price, None)
+                    for e in entries]
+        else:
+            (path, state) = read_checkpoint(settings)
+            if state is None:
+                sys.exit("There is no checkpoint at %s, use --live to "
+                         "fetch the prices." % path)
+            print "Prices from %s, %ds old" % (
+                path, time.time() - state['prices_time'])
+            rows = [(ins[1], zone, price, ins[2])
+                    for ins in state['catalog']['instances']
+                    for (zone, price) in ins[-1].iteritems()]
+
+    prices = sorted((float(price), ins_type, zone, ondemand)
+                    for (ins_type, zone, price, ondemand) in rows
+                    if args.instance_type in (None, ins_type))
+    for (price, ins_type, zone, ondemand) in prices[:args.limit]:
+        print "%-16s %-16s %10.4f %10s" % (
+            ins_type, zone, price,
+            '-' if ondemand is None else '%.4f' % float(ondemand))
+
+
+def live_prices(args):
+    """
+    Fetch the spot prices of the instance types in the database, or read
+    them from the shared price table if it is fresh.
+    """
+    from ggprovisioner import pricecache, ProvisionerConfig, tenant
+    from ggprovisioner.cloud import aws
+
+    config = ProvisionerConfig(config_file=args.config)
+    config.load_instance_types()
+    tenants = tenant.TenantRegistry().get_tenants()
+    if len(tenants) == 0:
+        sys.exit("There are no tenants to fetch the prices with.")
+    cache = None
+    if config.price_cache:
+        cache = pricecache.PriceCache(config.price_cache_path,
+                                      config.price_cache_max_age,
+                                      config.price_cache_capacity)
+    aws.api.get_spot_prices(config.instance_types, tenants[0], cache)
+    return [(ins.type, zone, price, ins.ondemand)
+            for ins in config.instance_types
+            for (zone, price) in ins.spot.iteritems()]
+
+
+def plan(args):
+    """
+    Select an instance for each idle job as a cycle would, and show the
+    selections without launching them or changing anything.
+    """
+    from ggprovisioner import Provisioner, ProvisionerConfig, tenant
+    from ggprovisioner.cloud import aws
+
+    console_logging(args)
+    config = ProvisionerConfig(config_file=args.config)
     prov = Provisioner()
-    prov.run()
+    prov.tenants = tenant.TenantRegistry().get_tenants()
+    if len(prov.tenants) == 0:
+        sys.exit("There are no tenants.")
+    prov.scheduler.load_jobs(prov.tenants, migrate=False)
+    config.load_instance_types()
+    aws.api.get_spot_prices(config.instance_types, prov.tenants[0],
+                            prov.price_cache)
+    prov.select_instance_type(config.instance_types)
+
+    for t in prov.tenants:
+        print "%s: %d idle jobs" % (t.name, len(t.idle_jobs))
+        for job in t.idle_jobs:
+            req = job.launch
+            if req is None:
+                continue
+            print "  job %-10s %-16s %-16s %10.4f%s" % (
+                job.id, req.instance_type,
+                'ondemand' if req.ondemand else req.zone,
+                float(req.price if req.ondemand else req.bid),
+                ' packed' if req.packed else '')
+
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,12 @@
 from ggprovisioner.cloud.aws.instance import Instance
-from ggprovisioner.cloud.aws.request import Request
+from ggprovisioner.cloud.aws.request import Request, Candidate
+from ggprovisioner.cloud.aws.catalog import InstanceCatalog
 
+from . import ratelimit
+from . import connection
+from . import request
 from . import api
+from . import fleet
 from . import manager
+from . import scaler
+from . import outbox
@@ -8,69 +8,99 @@ from boto.ec2.blockdevicemapping import BlockDeviceType
 from boto.ec2.blockdevicemapping import BlockDeviceMapping
 
 from ggprovisioner import ProvisionerConfig, logger
+from ggprovisioner.cloud.aws.connection import (get_zone_connection,
+                                                map_regions, region_of)
 
 
-def get_spot_prices(instances, tenant):
+def get_spot_prices(instances, tenant, cache=None):
     """
-    Get the current spot price for each instance type.
+    Get the current spot price for each instance type in every zone of
+    every region. The regions are queried at the same time. With a
+    PriceCache, the prices are only fetched if no process on the host has
+    fetched them recently.
     """
     utc = timezone('UTC')
-    utc_time = datetime.datetime.now(utc)
+    utc_time = datetime.datetime.fromtimestamp(time.time(), utc)
     now = utc_time.strftime('%Y-%m-%d %H:%M:%S')
-    conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
     jobCost = 0
     timeStr = str(now).replace(" ", "T") + "Z"
-    for ins in instances:
-        prices = conn.get_spot_price_history(
-            instance_type=ins.type, product_description="Linux/UNIX",
-            end_time=timeStr, start_time=timeStr)
-        for price in prices:
-            ins.spot.update({price.availability_zone: price.price})
+
+    def get_prices(conn):
+        prices = []
+        for ins in instances:
+            prices.append((ins, conn.get_spot_price_history(
+                instance_type=ins.type, product_description="Linux/UNIX",
+                end_time=timeStr, start_time=timeStr)))
+        return prices
+
+    def fetch():
+        regions = ProvisionerConfig().regions or [None]
+        for (region, prices) in map_regions(tenant, get_prices, regions):
+            for (ins, history) in prices:
+                for price in history:
+                    ins.spot.update({price.availability_zone: price.price})
+
+    if cache is None:
+        fetch()
+    else:
+        cache.refresh(instances, fetch)
 
 
 def tag_requests(req, tag, conn):
     """
     Tag any requests that have just been made with the tenant name
     """
+    # Throttling is retried by the connection, these retries give a new
+    # request time to become visible to the API
     for x in range(0, 3):
         try:
-            conn.create_tags([req], {"tenant": tag})
-            conn.create_tags([req], {"Name": 'worker@%s' % tag})
+            conn.create_tags([req], {"tenant": tag,
+                                     "Name": 'worker@%s' % tag})
             break
-        except boto.exception.BotoClientError as e:
-            time.sleep(2)
-            pass
-        except boto.exception.BotoServerError as e:
-            time.sleep(2)
-            pass
-        except boto.exception.EC2ResponseError:
-            logger.exception("There was an error communicating with EC2.")
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError):
+            if x == 2:
+                logger.exception("There was an error communicating with "
+                                 "EC2.")
+                break
+            time.sleep(2 ** x)
+
+
+def get_block_device_mapping():
+    """
+    The disks attached to each instance: a root volume and the instance
+    store volumes.
+    """
+    mapping = BlockDeviceMapping()
+    sda1 = BlockDeviceType()
+    eph0 = BlockDeviceType()
+    eph1 = BlockDeviceType()
+    eph2 = BlockDeviceType()
+    eph3 = BlockDeviceType()
+    sda1.size = 10
+    eph0.ephemeral_name = 'ephemeral0'
+    eph1.ephemeral_name = 'ephemeral1'
+    eph2.ephemeral_name = 'ephemeral2'
+    eph3.ephemeral_name = 'ephemeral3'
+    mapping['/dev/sda1'] = sda1
+    mapping['/dev/sdb'] = eph0
+    mapping['/dev/sdc'] = eph1
+    mapping['/dev/sdd'] = eph2
+    mapping['/dev/sde'] = eph3
+    return mapping
 
 
 def launch_ondemand_request(conn, request, tenant, job):
     try:
 
-        mapping = BlockDeviceMapping()
-        sda1 = BlockDeviceType()
-        eph0 = BlockDeviceType()
-        eph1 = BlockDeviceType()
-        eph2 = BlockDeviceType()
-        eph3 = BlockDeviceType()
-        sda1.size = 10
-        eph0.ephemeral_name = 'ephemeral0'
-        eph1.ephemeral_name = 'ephemeral1'
-        eph2.ephemeral_name = 'ephemeral2'
-        eph3.ephemeral_name = 'ephemeral3'
-        mapping['/dev/sda1'] = sda1
-        mapping['/dev/sdb'] = eph0
-        mapping['/dev/sdc'] = eph1
-        mapping['/dev/sdd'] = eph2
-        mapping['/dev/sde'] = eph3
+        mapping = get_block_device_mapping()
 
         # issue a run_instances command for this request
         res = conn.run_instances(
             min_count=request.count, max_count=request.count,
-            key_name=tenant.key_pair, image_id=request.ami,
+            key_name=tenant.key_pair,
+            image_id=(request.instance.ami_in(region_of(tenant.zone)) or
+                      request.ami),
             security_group_ids=[tenant.security_group],
             user_data=customise_cloudinit(tenant, job),
             instance_type=request.instance_type,
@@ -91,7 +121,6 @@ def launch_ondemand_request(conn, request, tenant, job):
                 (tenant.db_id, request.instance.db_id, 
                  request.instance.ondemand, job.id,
                  "ondemand", req, tenant.subnet_id))
-            ProvisionerConfig().dbconn.commit()
             return
     except boto.exception.EC2ResponseError:
         logger.exception("There was an error communicating with EC2.")
@@ -99,26 +128,10 @@ def launch_ondemand_request(conn, request, tenant, job):
 
 def launch_spot_request(conn, request, tenant, job):
     try:
-        logger.debug("%s = %s. tenants vpc = %s" %
-                     (request.zone, tenant.subnets[request.zone],
-                      tenant.vpc))
-
-        mapping = BlockDeviceMapping()
-        sda1 = BlockDeviceType()
-        eph0 = BlockDeviceType()
-        eph1 = BlockDeviceType()
-        eph2 = BlockDeviceType()
-        eph3 = BlockDeviceType()
-        sda1.size = 10
-        eph0.ephemeral_name = 'ephemeral0'
-        eph1.ephemeral_name = 'ephemeral1'
-        eph2.ephemeral_name = 'ephemeral2'
-        eph3.ephemeral_name = 'ephemeral3'
-        mapping['/dev/sda1'] = sda1
-        mapping['/dev/sdb'] = eph0
-        mapping['/dev/sdc'] = eph1
-        mapping['/dev/sdd'] = eph2
-        mapping['/dev/sde'] = eph3
+        logger.debug("%s = %s. tenants vpc = %s", request.zone,
+                     tenant.subnets[request.zone], tenant.vpc)
+
+        mapping = get_block_device_mapping()
 
         inst_req = conn.request_spot_instances(
             price=request.bid, image_id=request.ami,
@@ -139,36 +152,79 @@ def launch_spot_request(conn, request, tenant, job):
                  "subnet) values ('%s', '%s', %s, %s, '%s', '%s', %s)") %
                 (tenant.db_id, request.instance.db_id, request.bid, job.id,
                  "spot", req, tenant.subnets_db_id[request.zone]))
-            ProvisionerConfig().dbconn.commit()
+            if request.packed:
+                record_packed_jobs(request, req, tenant)
         return my_req_ids
     except boto.exception.EC2ResponseError:
         logger.exception("There was an error communicating with EC2.")
 
 
+def launch_warm_request(conn, request, tenant):
+    """
+    Request spot instances to keep warm for jobs that have not arrived yet.
+    They are recorded without a job.
+    """
+    try:
+        inst_req = conn.request_spot_instances(
+            price=request.bid, image_id=request.ami,
+            subnet_id=tenant.subnets[request.zone], count=request.count,
+            key_name=tenant.key_pair,
+            security_group_ids=[tenant.security_group],
+            instance_type=request.instance_type,
+            user_data=render_cloudinit(tenant, request.instance.cpus),
+            block_device_map=get_block_device_mapping())
+        my_req_ids = [req.id for req in inst_req]
+        for req in my_req_ids:
+            tag_requests(req, tenant.name, conn)
+        if len(my_req_ids) > 0:
+            ProvisionerConfig().dbconn.execute(
+                ("insert into instance_request (tenant, instance_type, " +
+                 "price, job_runner_id, request_type, request_id, " +
+                 "subnet) values %s") %
+                ", ".join("('%s', '%s', %s, null, 'warm', '%s', %s)" %
+                          (tenant.db_id, request.instance.db_id, request.bid,
+                           req, tenant.subnets_db_id[request.zone])
+                          for req in my_req_ids))
+        return my_req_ids
+    except boto.exception.EC2ResponseError:
+        logger.exception("There was an error communicating with EC2.")
+    return []
+
+
 def request_resources(tenant):
     """
-    Request the resources that have been selected for each job
+    Request the resources that have been selected for each job, each in
+    the region of its zone.
     """
-    conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
 
     output_string = "Name: %s\n" % tenant.name
     output_string = "%sTenant: %s\n" % (output_string, tenant.name)
     instance_req_string = ""
     req_cpus = 0
     req_instances = 0
+    # Jobs packed onto one instance share its request
+    launched = set()
 
     for job in tenant.idle_jobs:
         if job.fulfilled is False:
             request = job.launch
             if request == None:
-                logger.debug("Failed to find request object for job %s" % job)
+                logger.debug("Failed to find request object for job %s", job)
+                continue
+            if id(request) in launched:
                 continue
-            logger.debug(repr(request))
+            launched.add(id(request))
+            logger.debug("%r", request)
             # increment some counters
             req_instances += int(request.count)
-            req_cpus += int(job.req_cpus)
+            if request.packed:
+                req_cpus += sum(cpus for (job_id, cpus) in request.packed)
+            else:
+                req_cpus += int(job.req_cpus)
             # Launch any on-demand requests
             req_type = "spot"
+            # Ondemand instances are launched in the tenant's own zone
+            conn = get_zone_connection(tenant, request.zone or tenant.zone)
             if request.ondemand:
                 # launch the ondemand request
                 launch_ondemand_request(conn, request, tenant, job)
@@ -196,18 +252,38 @@ def request_resources(tenant):
         (output_string, req_cpus, req_instances, instance_req_string))
 
 
+def record_packed_jobs(request, request_id, tenant):
+    """
+    Record each of the jobs packed onto a request, so every one of them
+    counts as having had a request made for it.
+    """
+    ProvisionerConfig().dbconn.execute(
+        ("insert into instance_request_job (request, job_runner_id, cpus) " +
+         "select instance_request.id, packed.job, packed.cpus from " +
+         "instance_request, (values %s) as packed (job, cpus) where " +
+         "instance_request.request_id = '%s' and tenant = %s") %
+        (", ".join("(%s, %s)" % p for p in request.packed), request_id,
+         tenant.db_id))
+
+
 def customise_cloudinit(tenant, job):
     """
     Use a string template to construct an appropriate cloudinit script to
     pass as userdata to the aws request.
     """
-    cpus = job.launch.instance.cpus
+    return render_cloudinit(tenant, job.launch.instance.cpus)
+
+
+def render_cloudinit(tenant, cpus):
+    """
+    Construct the cloudinit script for an instance with a number of cpus.
+    """
     ip_addr = tenant.public_ip
     domain = tenant.domain
     d = {'ip_addr': ip_addr, 'cpus': cpus, 'domain': domain}
 
-    filein = open(ProvisionerConfig().cloudinit_file)
-    src = Template(filein.read())
+    with open(ProvisionerConfig().cloudinit_file) as filein:
+        src = Template(filein.read())
 
     result = src.substitute(d)
     return result
@@ -0,0 +1,56 @@
+import bisect
+
+
+class InstanceCatalog(object):
+    """
+    The set of available instance types, indexed by name, database id and
+    size. The version is bumped every time the catalog is reloaded so
+    anything derived from the catalog can tell when it is out of date.
+    """
+    def __init__(self):
+        self.version = 0
+        self.load([])
+
+    def load(self, instances, loaded_time=0):
+        """
+        Replace the instance types in the catalog and rebuild the indexes.
+        """
+        self.instances = instances
+        self.by_name = dict((ins.type, ins) for ins in instances)
+        self.by_id = dict((ins.db_id, ins) for ins in instances)
+
+        # Keep the instances sorted by (cpus, memory) so the ones large
+        # enough for a job can be found with a binary search
+        self.by_size = sorted(instances,
+                              key=lambda k: (int(k.cpus), float(k.memory)))
+        self.sizes = [(int(ins.cpus), float(ins.memory))
+                      for ins in self.by_size]
+        self.fitting_cache = {}
+
+        self.loaded_time = loaded_time
+        self.version += 1
+
+    def get(self, name):
+        """
+        Look up an instance type by its name, e.g. m2.4xlarge.
+        """
+        return self.by_name.get(name)
+
+    def get_by_id(self, db_id):
+        """
+        Look up an instance type by its database id.
+        """
+        return self.by_id.get(db_id)
+
+    def fitting(self, cpus, memory):
+        """
+        Get the instance types with at least the given cpus and memory,
+        ordered from smallest to largest.
+        """
+        key = (int(cpus), float(memory))
+        if key not in self.fitting_cache:
+            start = bisect.bisect_left(self.sizes, (key[0],))
+            self.fitting_cache[key] = [
+                self.by_size[pos] for pos in xrange(start, len(self.sizes))
+                if self.sizes[pos][1] >= key[1]]
+        return self.fitting_cache[key]
@@ -0,0 +1,222 @@
+import re
+import sys
+import threading
+import time
+
+import boto.ec2.connection
+from boto.regioninfo import RegionInfo
+
+from ggprovisioner import logger, metrics, ProvisionerConfig
+from ggprovisioner.cloud.aws import ratelimit
+
+connections = {}
+limiters = {}
+
+# RequestSpotInstances only takes a client token in versions of the API
+# newer than boto's
+CLIENT_TOKEN_API_VERSION = '2016-11-15'
+
+
+class EC2Connection(boto.ec2.connection.EC2Connection):
+    """
+    An EC2 connection that counts and times every call made through it.
+    Calls wait on the rate limiter of the account, if it has one, and
+    throttled calls are retried once it allows.
+    """
+    limiter = None
+    # The client token of the spot request being made by each thread
+    pending = threading.local()
+
+    def request_spot_instances(self, *args, **kwargs):
+        """
+        As boto's, but also taking a client token, so that making the
+        same request again returns the requests already made.
+        """
+        self.pending.client_token = kwargs.pop('client_token', None)
+        try:
+            return super(EC2Connection, self).request_spot_instances(
+                *args, **kwargs)
+        finally:
+            self.pending.client_token = None
+
+    def make_request(self, action, params=None, path='/', verb='GET',
+                     api_version=None):
+        token = getattr(self.pending, 'client_token', None)
+        if action == 'RequestSpotInstances' and token is not None:
+            params = dict(params or {}, ClientToken=token)
+            api_version = api_version or CLIENT_TOKEN_API_VERSION
+        start = time.time()
+        status = 'error'
+        if self.limiter is not None:
+            self.limiter.acquire(action)
+        try:
+            # As AWSQueryConnection.make_request, but handling throttling
+            http_request = self.build_base_http_request(verb, path, None,
+                                                        params, {}, '',
+                                                        self.host)
+            if action:
+                http_request.params['Action'] = action
+            # Actions newer than boto need a newer version of the API
+            if api_version or self.APIVersion:
+                http_request.params['Version'] = (api_version or
+                                                  self.APIVersion)
+            response = self._mexe(http_request,
+                                  retry_handler=self.throttle_handler(action))
+            status = response.status
+            if self.limiter is not None and status < 400:
+                self.limiter.succeeded(action)
+            return response
+        finally:
+            metrics.EC2_CALLS.inc(action=action, status=status)
+            metrics.EC2_CALL_SECONDS.observe(time.time() - start,
+                                             action=action)
+
+    def throttle_handler(self, action):
+        """
+        Make a boto retry handler that backs off and retries a call when
+        EC2 throttles it.
+        """
+        def handler(response, attempt, next_sleep):
+            if (self.limiter is None or
+                    not ratelimit.is_throttled(response)):
+                return None
+            backoff = self.limiter.throttled(action, attempt)
+            if backoff is None:
+                return None
+            self.limiter.acquire(action)
+            return ("%s was throttled, retrying in %.1f seconds." %
+                    (action, backoff), attempt + 1, backoff)
+        return handler
+
+
+def connect(access_key, secret_key, region=None):
+    """
+    Connect to EC2 in a region, or in boto's default region.
+    """
+    if region is None:
+        return EC2Connection(access_key, secret_key)
+    return EC2Connection(access_key, secret_key, region=RegionInfo(
+        name=region, endpoint='ec2.%s.amazonaws.com' % region))
+
+
+# Makes the connection for a set of credentials. The simulator replaces
+# this to connect to its fake cloud
+factory = connect
+
+# The region of an availability zone, e.g. us-west-2 for us-west-2a or for
+# the local zone us-west-2-lax-1a
+ZONE_REGION = re.compile(r'^([a-z]{2}(?:-gov)?-[a-z]+-\d+)')
+
+
+def get_limiter(access_key, region=None):
+    """
+    Get the rate limiter of an account in a region. Every connection using
+    the account's key in the region shares it, as EC2 limits calls per
+    account and region.
+    """
+    key = (access_key, region)
+    if key not in limiters:
+        config = ProvisionerConfig()
+        limiters[key] = ratelimit.RateLimiter(
+            config.describe_rate, config.describe_burst,
+            config.mutate_rate, config.mutate_burst,
+            config.throttle_retries)
+        logger.debug("Created a rate limiter for account %s in %s.",
+                     access_key[:4], region or "the default region")
+    return limiters[key]
+
+
+def get_connection(tenant, region=None):
+    """
+    Get an EC2 connection to a region using a tenant's credentials, or to
+    boto's default region if the provisioner isn't set up with regions.
+    Connections are reused between calls and cycles.
+    """
+    key = (tenant.access_key, tenant.secret_key, region)
+    if key not in connections:
+        if region is None:
+            conn = factory(tenant.access_key, tenant.secret_key)
+        else:
+            conn = factory(tenant.access_key, tenant.secret_key,
+                           region=region)
+        conn.limiter = get_limiter(tenant.access_key, region)
+        connections[key] = conn
+    return connections[key]
+
+
+def zone_region(zone):
+    """
+    Get the region to make calls about an availability zone in, or the
+    first region if the zone isn't known. With no regions set up,
+    everything is in boto's default region (None).
+    """
+    regions = ProvisionerConfig().regions
+    if len(regions) == 0:
+        return None
+    return region_of(zone) or regions[0]
+
+
+def region_of(zone):
+    """
+    Get the region an availability zone is in, or None for no zone.
+    """
+    match = ZONE_REGION.match(zone or '')
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def get_zone_connection(tenant, zone):
+    """
+    Get a tenant's connection to the region of an availability zone.
+    """
+    return get_connection(tenant, zone_region(zone))
+
+
+def tenant_regions(tenant):
+    """
+    The regions a tenant can have resources in: those it has subnets in,
+    including the region of its own zone, where ondemand instances are
+    launched.
+    """
+    regions = ProvisionerConfig().regions
+    if len(regions) == 0:
+        return [None]
+    used = set(zone_region(zone) for zone in
+               list(tenant.subnets) + [tenant.zone])
+    return [r for r in regions if r in used]
+
+
+def map_regions(tenant, func, regions=None):
+    """
+    Call func with the tenant's connection to each of its regions (or the
+    regions given) at the same time, one thread per region, so more
+    regions don't make a cycle longer. Returns a list of (region, result)
+    in the order of the regions. If any call fails, the first error is
+    raised once they have all finished.
+    """
+    if regions is None:
+        regions = tenant_regions(tenant)
+    # Connections are made up front, as the cache isn't thread safe
+    conns = [(region, get_connection(tenant, region)) for region in regions]
+    if len(conns) == 1:
+        return [(conns[0][0], func(conns[0][1]))]
+
+    results = {}
+    errors = []
+
+    def call(region, conn):
+        try:
+            results[region] = func(conn)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=call, args=(region, conn),
+                                name='region-%s' % region)
+               for (region, conn) in conns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return [(region, results[region]) for region in regions]
@@ -0,0 +1,302 @@
+import base64
+import collections
+import xml.etree.ElementTree as ElementTree
+
+import boto
+import psycopg2
+import sqlalchemy
+
+from ggprovisioner import logger, ProvisionerConfig
+from ggprovisioner.cloud.aws import api
+from ggprovisioner.cloud.aws.connection import (get_connection, region_of,
+                                                zone_region)
+
+# CreateFleet came after boto 2, so it is called through the query API
+FLEET_API_VERSION = '2016-11-15'
+
+# The template data last sent for each launch template, so a new version is
+# only made when the data changes
+templates = {}
+
+BLOCK_DEVICES = [('/dev/sda1', None), ('/dev/sdb', 'ephemeral0'),
+                 ('/dev/sdc', 'ephemeral1'), ('/dev/sdd', 'ephemeral2'),
+                 ('/dev/sde', 'ephemeral3')]
+
+
+def request_fleets(tenant):
+    """
+    Launch instances for a tenant's idle jobs with one instant EC2 fleet
+    per group of jobs with the same options, rather than a request per
+    job. Spot capacity the fleet can't find is made up with ondemand
+    instances. Fleets are made in the region of the tenant's own zone.
+    """
+    region = zone_region(tenant.zone)
+    conn = get_connection(tenant, region)
+    output_string = ""
+
+    for ((ondemand, cpus), options, jobs) in group_jobs(tenant.idle_jobs):
+        launched = []
+        try:
+            name = ensure_launch_template(conn, tenant, cpus)
+            if not ondemand:
+                launched = create_fleet(
+                    conn, name,
+                    build_overrides(tenant, options, cpus, False, region),
+                    len(jobs), False, tenant.name)
+            shortfall = len(jobs) - len(launched)
+            if shortfall > 0:
+                launched.extend(create_fleet(
+                    conn, name,
+                    build_overrides(tenant, options, cpus, True, region),
+                    shortfall, True, tenant.name))
+            record_fleet_instances(tenant, options, zip(jobs, launched))
+        except boto.exception.EC2ResponseError:
+            logger.exception("There was an error communicating with EC2.")
+            continue
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            # The instances are running but have no request, so name them
+            # for them to be reconciled
+            logger.exception("Error recording fleet instances %s of tenant "
+                             "%s." % (", ".join(i[0] for i in launched),
+                                      tenant.name))
+            continue
+
+        for (job, (instance_id, ins_type, subnet, lifecycle)) in zip(
+                jobs, launched):
+            output_string = ("%sFLEET_INSTANCE_REQUEST\t%s\t%s\t%s\t%s\t%s\n" %
+                             (output_string, tenant.name, ins_type, job.id,
+                              lifecycle, instance_id))
+        if len(launched) < len(jobs):
+            logger.warn("A fleet only launched %s of %s instances.",
+                        len(launched), len(jobs))
+
+    if output_string:
+        logger.debug("Name: %s\n%s", tenant.name, output_string)
+
+
+def group_jobs(jobs):
+    """
+    Group the jobs that have had a launch selected by their options, as
+    jobs with the same eligible instances share a list of options. The
+    options are limited to instance types with as many cpus as the one
+    selected, as the cloudinit script depends on it.
+    Returns a list of ((ondemand, cpus), options, jobs) tuples.
+    """
+    groups = collections.OrderedDict()
+    for job in jobs:
+        if job.fulfilled or job.launch is None or job.launch_options is None:
+            continue
+        cpus = job.launch.instance.cpus
+        key = (id(job.launch_options), bool(job.launch.ondemand), cpus)
+        if key not in groups:
+            groups[key] = (job.launch_options, [])
+        groups[key][1].append(job)
+    return [((ondemand, cpus), options, group)
+            for ((i, ondemand, cpus), (options, group))
+            in groups.iteritems()]
+
+
+def build_overrides(tenant, options, cpus, ondemand, region=None):
+    """
+    Make the fleet overrides for each option of a group that the tenant
+    can afford: the instance type, subnet and image to launch, and for
+    spot the most to pay. If a region is given, only its zones are used.
+    """
+    overrides = []
+    for option in options:
+        if (option.ondemand != ondemand or
+                option.instance.cpus != cpus or
+                option.price >= tenant.max_bid_price):
+            continue
+        if ondemand:
+            subnets = [subnet for (zone, subnet) in tenant.subnets.items()
+                       if region is None or region_of(zone) == region]
+        elif (option.zone in tenant.subnets and
+                (region is None or region_of(option.zone) == region)):
+            subnets = [tenant.subnets[option.zone]]
+        else:
+            continue
+        image = option.instance.ami_in(region)
+        for subnet in subnets:
+            override = {'InstanceType': option.instance_type,
+                        'SubnetId': subnet,
+                        'ImageId': image}
+            if not ondemand:
+                bid = float(tenant.bid_percent) / 100 * float(option.odp)
+                override['MaxPrice'] = str(min(bid, tenant.max_bid_price))
+            overrides.append(override)
+    return overrides
+
+
+def build_fleet_params(template, overrides, capacity, ondemand, tag):
+    """
+    Make the query parameters of an instant CreateFleet call.
+    """
+    lifecycle = 'on-demand' if ondemand else 'spot'
+    prefix = 'LaunchTemplateConfigs.1.'
+    params = {
+        'Type': 'instant',
+        prefix + 'LaunchTemplateSpecification.LaunchTemplateName': template,
+        prefix + 'LaunchTemplateSpecification.Version': '$Latest',
+        'TargetCapacitySpecification.TotalTargetCapacity': capacity,
+        'TargetCapacitySpecification.DefaultTargetCapacityType': lifecycle,
+        'SpotOptions.AllocationStrategy': 'price-capacity-optimized',
+        'OnDemandOptions.AllocationStrategy': 'lowest-price',
+        # Tag the instances as they launch rather than afterwards
+        'TagSpecification.1.ResourceType': 'instance',
+        'TagSpecification.1.Tag.1.Key': 'tenant',
+        'TagSpecification.1.Tag.1.Value': tag,
+        'TagSpecification.1.Tag.2.Key': 'Name',
+        'TagSpecification.1.Tag.2.Value': 'worker@%s' % tag}
+    if ondemand:
+        params['TargetCapacitySpecification.OnDemandTargetCapacity'] = \
+            capacity
+    else:
+        params['TargetCapacitySpecification.SpotTargetCapacity'] = capacity
+    for (i, override) in enumerate(overrides, 1):
+        for (key, value) in override.iteritems():
+            params['%sOverrides.%s.%s' % (prefix, i, key)] = value
+    return params
+
+
+def create_fleet(conn, template, overrides, capacity, ondemand, tag):
+    """
+    Launch an instant fleet. Returns a list of
+    (instance id, instance type, subnet, lifecycle) tuples for the
+    instances launched.
+    """
+    if len(overrides) == 0:
+        return []
+    params = build_fleet_params(template, overrides, capacity, ondemand, tag)
+    body = call(conn, 'CreateFleet', params)
+    (instances, errors) = parse_fleet_response(body)
+    for (code, message) in errors:
+        logger.warn("Fleet error %s: %s", code, message)
+    return instances
+
+
+def parse_fleet_response(body):
+    """
+    Read the instances launched and the errors from a CreateFleet
+    response.
+    """
+    root = ElementTree.fromstring(body)
+    instances = []
+    errors = []
+    for item in children(child(root, 'fleetInstanceSet'), 'item'):
+        overrides = child(child(item, 'launchTemplateAndOverrides'),
+                          'overrides')
+        for instance_id in children(child(item, 'instanceIds'), 'item'):
+            instances.append((instance_id.text, text(item, 'instanceType'),
+                              text(overrides, 'subnetId'),
+                              text(item, 'lifecycle')))
+    for item in children(child(root, 'errorSet'), 'item'):
+        errors.append((text(item, 'errorCode'), text(item, 'errorMessage')))
+    return (instances, errors)
+
+
+def ensure_launch_template(conn, tenant, cpus):
+    """
+    Make sure the launch template for a tenant's instances with a number
+    of cpus is current, making a new version of it if its data has
+    changed. Returns the name of the template.
+    """
+    name = 'ggprovisioner-%s-%scpu' % (tenant.name, cpus)
+    data = build_template_data(tenant, cpus)
+    if templates.get(name) == data:
+        return name
+
+    params = dict(data)
+    params['LaunchTemplateName'] = name
+    try:
+        call(conn, 'CreateLaunchTemplate', params)
+    except boto.exception.EC2ResponseError as e:
+        if 'AlreadyExists' not in (e.error_code or ''):
+            raise
+        call(conn, 'CreateLaunchTemplateVersion', params)
+    templates[name] = data
+    return name
+
+
+def build_template_data(tenant, cpus):
+    """
+    Make the launch template parameters for a tenant's instances with a
+    number of cpus. The image is given by the fleet overrides.
+    """
+    prefix = 'LaunchTemplateData.'
+    data = {
+        prefix + 'KeyName': tenant.key_pair,
+        prefix + 'SecurityGroupId.1': tenant.security_group,
+        prefix + 'UserData': base64.b64encode(
+            api.render_cloudinit(tenant, cpus))}
+    for (i, (device, ephemeral)) in enumerate(BLOCK_DEVICES, 1):
+        mapping = '%sBlockDeviceMapping.%s.' % (prefix, i)
+        data[mapping + 'DeviceName'] = device
+        if ephemeral is None:
+            data[mapping + 'Ebs.VolumeSize'] = 10
+        else:
+            data[mapping + 'VirtualName'] = ephemeral
+    return data
+
+
+def record_fleet_instances(tenant, options, launched):
+    """
+    Record an instance_request for each instance a fleet launched, using
+    the instance id as the request id as ondemand requests do.
+    """
+    if len(launched) == 0:
+        return
+    zones = dict((subnet, zone) for (zone, subnet)
+                 in tenant.subnets.iteritems())
+    types = dict((option.instance_type, option.instance)
+                 for option in options)
+    values = []
+    for (job, (instance_id, ins_type, subnet, lifecycle)) in launched:
+        instance = types[ins_type]
+        price = instance.ondemand
+        if lifecycle == 'spot':
+            price = min(float(tenant.bid_percent) / 100 *
+                        float(instance.ondemand), tenant.max_bid_price)
+        values.append("(%s, %s, %s, %s, 'fleet', '%s', %s)" %
+                      (tenant.db_id, instance.db_id, price, job.id,
+                       instance_id, tenant.subnets_db_id[zones[subnet]]))
+    ProvisionerConfig().dbconn.execute(
+        ("insert into instance_request (tenant, instance_type, price, " +
+         "job_runner_id, request_type, request_id, subnet) values %s") %
+        ", ".join(values))
+
+
+def call(conn, action, params):
+    """
+    Call an EC2 action through the query API, returning the body of the
+    response.
+    """
+    response = conn.make_request(action, params, verb='POST',
+                                 api_version=FLEET_API_VERSION)
+    body = response.read()
+    if response.status != 200:
+        raise conn.ResponseError(response.status, response.reason, body)
+    return body
+
+
+def child(elem, name):
+    """
+    Find the first child of an element with a name, ignoring namespaces.
+    """
+    if elem is None:
+        return None
+    for c in elem:
+        if c.tag.rsplit('}', 1)[-1] == name:
+            return c
+    return None
+
+
+def children(elem, name):
+    if elem is None:
+        return []
+    return [c for c in elem if c.tag.rsplit('}', 1)[-1] == name]
+
+
+def text(elem, name):
+    c = child(elem, name)
+    return c.text if c is not None else None
@@ -5,6 +5,9 @@ class Instance(SimpleStringifiable):
     """
     A class to manage AWS instance types.
     """
+    __slots__ = ('db_id', 'type', 'ondemand', 'cpus', 'memory', 'disk', 'ami',
+                 'amis', 'spot')
+
     def __init__(self, db_id, ins_type, ondemand, cpus, memory, disk, ami):
         self.db_id = db_id
         self.type = ins_type
@@ -13,4 +16,16 @@ class Instance(SimpleStringifiable):
         self.memory = memory
         self.disk = disk
         self.ami = ami
+        # The image to launch in each region, when provisioning in several
+        self.amis = {}
         self.spot = {}
+
+    def ami_in(self, region):
+        """
+        Get the image to launch in a region, or None if there isn't one.
+        Without images for several regions, the instance type's own image
+        is used everywhere.
+        """
+        if region is None or len(self.amis) == 0:
+            return self.ami
+        return self.amis.get(region)
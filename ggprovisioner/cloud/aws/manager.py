@@ -1,11 +1,17 @@
 import boto
 import psycopg2
+import sqlalchemy
 import sys
 import copy
 import datetime
+import time
 
 from ggprovisioner import logger, ProvisionerConfig
-from ggprovisioner.cloud.aws import api
+from ggprovisioner.log import LazyRepr
+from ggprovisioner.cloud.aws import api, scaler
+from ggprovisioner.cloud.aws.connection import map_regions
+from ggprovisioner.cloud.aws.instance import Instance
+from ggprovisioner.cloud.aws.tracker import InstanceTracker
 
 
 def process_resources(tenants):
@@ -33,73 +39,98 @@ def update_database(tenants):
     """
     Record when an instance is started in the database. This should also
     try and record when an instance is terminated.
+    Only instances whose state has changed since the last cycle are
+    written to the database.
     In future work this should probably calculate the cost of the instance
     as well.
     """
-
+    tracker = InstanceTracker()
     for tenant in tenants:
-        conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
+        launched = []
+        terminated = []
         try:
-            # First get all operating instances (instances probably are not
-            # yet tagged, so don't filter them yet.)
-            reservations = conn.get_all_instances()
-            instance_spot_ids = []
-            # Go over the fulfilled spot requests
-            for r in reservations:
-                for i in r.instances:
-                    if i.spot_instance_request_id is not None:
-                        instance_spot_ids.append(
-                            "'%s'" % i.spot_instance_request_id)
-                    # Also include ondemand instances which tag as the id.
-                    else:
-                        instance_spot_ids.append(
-                            "'%s'" % i.id)
-
-            # Get the entry in the instance_request table for each of these
-            # requests
-            check_for_new_instances(reservations, instance_spot_ids,
-                                         conn, tenant)
-            check_for_terminated_instances(reservations)
-
-        except psycopg2.Error:
+            # Scan every region at once, remembering the connection to the
+            # region of each instance
+            found = map_regions(tenant, lambda conn: (
+                conn, list(tracker.scan(conn, tenant))))
+            conns = {}
+            instances = []
+            for (region, (conn, region_instances)) in found:
+                for inst in region_instances:
+                    conns[inst.id] = conn
+                    instances.append(inst)
+            launched, terminated = tracker.update(tenant, instances)
+
+            # Get the entry in the instance_request table for each of the
+            # newly running instances
+            unmatched = []
+            for (region, (conn, region_instances)) in found:
+                unmatched.extend(check_for_new_instances(
+                    [i for i in launched if conns[i.id] is conn], conn,
+                    tenant))
+            tracker.retry(tenant, unmatched)
+            check_for_terminated_instances(terminated)
+
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
             logger.exception("Error updating database.")
+            # The changes weren't all written, so report them again
+            tracker.report_again(tenant, launched + terminated)
+        except boto.exception.EC2ResponseError:
+            logger.exception("There was an error communicating with EC2.")
+            tracker.report_again(tenant, launched + terminated)
 
 
-def check_for_terminated_instances(reservations):
-    for r in reservations:
-        for i in r.instances:
-            if i.state == 'terminated':
-                # Sadly, I can't seem to get the actual shutdown time
-                # i.state_reason does not contain it and i.state does not
-                # exist. So instead, we will just flag it as now and sort
-                # out determining the full hour when computing cost.
-                ProvisionerConfig().dbconn.execute(
-                    ("update instance set terminate_time = NOW() " +
-                     "where instance_id = '%s' and terminate_time is null;") %
-                    i.id)
+def check_for_terminated_instances(instances):
+    """
+    Flag newly terminated instances in the database in one update.
+    """
+    if len(instances) == 0:
+        return
+    # Sadly, I can't seem to get the actual shutdown time
+    # i.state_reason does not contain it and i.state does not
+    # exist. So instead, we will just flag it as now and sort
+    # out determining the full hour when computing cost.
+    ProvisionerConfig().dbconn.execute(
+        ("update instance set terminate_time = NOW() " +
+         "where instance_id in (%s) and terminate_time is null;") %
+        ", ".join("'%s'" % i.id for i in instances))
 
 
-def check_for_new_instances(reservations, instance_spot_ids, conn, tenant):
-    if len(instance_spot_ids) > 0:
-        # Check that it isn't already in the instance table
-        rows = ProvisionerConfig().dbconn.execute(
-            ("select instance_request.id, instance_request.job_runner_id, " +
-             "instance_request.request_id from instance_request left join " +
-             "instance on instance_request.id = instance.request_id where " +
-             "instance.request_id is null and instance_request.request_id " +
-             "in (%s) and tenant = %s") %
-            (",".join(instance_spot_ids), tenant.db_id))
-
-        for row in rows:
-            for r in reservations:
-                # Match the instance_request entry to an instance request
-                # returned from aws
-                for i in r.instances:
-                    if i.spot_instance_request_id == row['request_id']:
-                        # If one is found then update the database
-                        instance_acquired(i, row, tenant, conn)
-                    if i.id in row['request_id']:
-                        instance_acquired(i, row, tenant, conn)
+def check_for_new_instances(instances, conn, tenant):
+    """
+    Match newly running instances to their entries in the instance_request
+    table and record them. Returns the instances that could not be matched.
+    """
+    if len(instances) == 0:
+        return []
+
+    # Index the instances by the id stored in instance_request. Spot
+    # instances use their request id, ondemand instances use their own id.
+    # Spot instances launched by a fleet also use their own id.
+    by_request_id = {}
+    for i in instances:
+        if i.spot_instance_request_id is not None:
+            by_request_id[i.spot_instance_request_id] = i
+        by_request_id[i.id] = i
+
+    # Check that it isn't already in the instance table
+    rows = ProvisionerConfig().dbconn.execute(
+        ("select instance_request.id, instance_request.job_runner_id, " +
+         "instance_request.request_id from instance_request left join " +
+         "instance on instance_request.id = instance.request_id where " +
+         "instance.request_id is null and instance_request.request_id " +
+         "in (%s) and tenant = %s") %
+        (",".join("'%s'" % r for r in by_request_id), tenant.db_id))
+
+    matched = set()
+    for row in rows:
+        i = by_request_id.get(row['request_id'])
+        if i is not None and i.id not in matched:
+            # If one is found then update the database
+            matched.add(i.id)
+            instance_acquired(i, row, tenant, conn)
+
+    return [i for i in instances if i.id not in matched]
 
 
 def request_ids_dict(reqs):
@@ -120,11 +151,11 @@ def migrate_requests(tenants):
     If there are no other jobs in the idle queue, cancel
     all existing requests tagged by a tenant.
     """
+    # Requests are resolved to their instance types through the catalog's
+    # name index
+    instance_types = ProvisionerConfig().catalog.by_name
     for tenant in tenants:
-        conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
-        reqs = conn.get_all_spot_instance_requests(
-            filters={"tag-value": tenant.name,
-                     "state": "open"})
+        (reqs, conns) = get_open_requests(tenant)
 
         # Get a list of ids that can be used in a db query
         ids_to_check = []
@@ -148,17 +179,16 @@ def migrate_requests(tenants):
         reqs = get_orphaned_requests(tenant, ids_to_check,
                                      idle_job_numbers)
 
-        # if there are any requests, try to reassign them to another job
-        if len(reqs) > 0:
-            for req in reqs:
-                for job in potential_jobs:
-                    # try to migrate it. if it works, then go to the next
-                    # request. otherwise try the next job.
-                    if migrate_request_to_job(req, job):
-                        # Remove it from idle jobs so it doesn't also get
-                        # a request made for it this round
-                        if job in tenant.idle_jobs:
-                            tenant.idle_jobs.remove(job)
+        # if there are any requests, try to reassign them to other jobs
+        if len(reqs) > 0 and len(potential_jobs) > 0:
+            assignments = assign_requests_to_jobs(reqs, potential_jobs,
+                                                  instance_types)
+            if record_request_migrations(assignments):
+                for (req, job) in assignments:
+                    # Remove it from idle jobs so it doesn't also get
+                    # a request made for it this round
+                    if job in tenant.idle_jobs:
+                        tenant.idle_jobs.remove(job)
 
 
 def get_orphaned_requests(tenant, ids_to_check, idle_job_numbers):
@@ -181,9 +211,11 @@ def get_orphaned_requests(tenant, ids_to_check, idle_job_numbers):
                      "instance_request.job_runner_id, " +
                      "instance_request.request_id from instance_request, " +
                      "instance_type where instance_request.instance_type = " +
-                     "instance_type.id and job_runner_id not in (%s) and " +
-                     "request_id in (%s) and request_type = 'spot' and " +
-                     "tenant = %s") %
+                     "instance_type.id and not exists (select 1 from " +
+                     "job_request where job_request.request = " +
+                     "instance_request.id and job_request.job_runner_id " +
+                     "in (%s)) and request_id in (%s) and " +
+                     "request_type = 'spot' and tenant = %s") %
                     (",".join(idle_job_numbers), sir_ids,
                      tenant.db_id))
             else:
@@ -201,7 +233,7 @@ def get_orphaned_requests(tenant, ids_to_check, idle_job_numbers):
                 res.append({'id': row['id'], 'type': row['type'],
                             'job_runner_id': row['job_runner_id'],
                             'request_id': row['request_id']})
-                logger.warn("Orphaned request %s" % row['request_id'])
+                logger.warn("Orphaned request %s", row['request_id'])
 
         except psycopg2.Error:
             logger.exception("Error migrating instances.")
@@ -209,33 +241,83 @@ def get_orphaned_requests(tenant, ids_to_check, idle_job_numbers):
     return res
 
 
-def migrate_request_to_job(request, job):
+def assign_requests_to_jobs(requests, jobs, instance_types):
     """
-    Check if an instance can be repurposed to another job and update the
-    database.
+    Match orphaned requests to idle jobs in a single greedy pass. Jobs are
+    grouped by their (cpus, memory) shape and requests by instance type so
+    the requirements are only checked once per shape and type. The most
+    demanding jobs are placed first, each on the smallest type that fits.
+    Every request is assigned to at most one job. Returns a list of
+    (request, job) pairs.
     """
-    # Check to see if the job can be fulfilled by the requested instance
-    if check_requirements(request['type'], job):
-        next_idle_job_id = job.id
-        try:
-            logger.debug(
-                ("Migrating instance request  %s, from job " +
-                 "%s to job %s.") %
-                (request['id'], request['job_runner_id'],
-                 next_idle_job_id))
-            ProvisionerConfig().dbconn.execute(
-                ("update instance_request set job_runner_id = '%s' " +
-                 "where id = %s") %
-                (next_idle_job_id, request['id']))
-            ProvisionerConfig().dbconn.execute(
-                ("insert into request_migration " +
-                 "(request_id, from_job, to_job, migration_time) " +
-                 "values (%s, %s, %s, NOW())") %
-                (request['id'], request['job_runner_id'],
-                 next_idle_job_id))
-            return True
-        except psycopg2.Error:
-            logger.exception("Error performing migration in database.")
+    # Group the requests by their instance type
+    by_type = {}
+    for req in requests:
+        if req['type'] not in instance_types:
+            logger.warn("Unknown instance type %s for request %s",
+                        req['type'], req['request_id'])
+            continue
+        by_type.setdefault(req['type'], []).append(req)
+    types = sorted(by_type.keys(),
+                   key=lambda t: (int(instance_types[t].cpus),
+                                  int(instance_types[t].memory)))
+
+    # Group the jobs by their shape
+    by_shape = {}
+    for job in jobs:
+        by_shape.setdefault((int(job.req_cpus), int(job.req_mem)),
+                            []).append(job)
+
+    assignments = []
+    for shape in sorted(by_shape.keys(), reverse=True):
+        shape_jobs = by_shape[shape]
+        # Every job in the bucket has the same requirements
+        fitting = [t for t in types
+                   if check_requirements(instance_types[t], shape_jobs[0])]
+        for job in shape_jobs:
+            fitting = [t for t in fitting if len(by_type[t]) > 0]
+            if len(fitting) == 0:
+                break
+            assignments.append((by_type[fitting[0]].pop(), job))
+
+    return assignments
+
+
+def record_request_migrations(assignments):
+    """
+    Reassign requests to their new jobs and record each migration in the
+    request_migration table, all in one statement.
+    """
+    if len(assignments) == 0:
+        return False
+
+    values = ', '.join("(%s, %s, %s)" %
+                       (int(req['id']), int(req['job_runner_id']),
+                        int(job.id))
+                       for (req, job) in assignments)
+    try:
+        logger.debug("Migrating instance requests: %s" %
+                     ', '.join("%s: %s -> %s" %
+                               (req['id'], req['job_runner_id'], job.id)
+                               for (req, job) in assignments))
+        # The statement starts with a CTE, so isn't committed unless asked
+        ProvisionerConfig().dbconn.execute(sqlalchemy.text(
+            ("with moved as (update instance_request " +
+             "set job_runner_id = v.to_job " +
+             "from (values %s) as v(id, from_job, to_job) " +
+             "where instance_request.id = v.id " +
+             "returning v.id, v.from_job, v.to_job), " +
+             # a request moved to a job is no longer shared
+             "unpacked as (delete from instance_request_job " +
+             "using moved where instance_request_job.request = moved.id) " +
+             "insert into request_migration " +
+             "(request_id, from_job, to_job, migration_time) " +
+             "select id, from_job, to_job, NOW() from moved") %
+            values).execution_options(autocommit=True))
+        return True
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+        logger.exception("Error performing migration in database.")
+    return False
 
 
 def cancel_unmigrated_requests(tenants):
@@ -247,9 +329,7 @@ def cancel_unmigrated_requests(tenants):
     """
     for tenant in tenants:
         # start by grabbing all of the open spot requests for this tenant
-        conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
-        reqs = conn.get_all_spot_instance_requests(
-            filters={"tag-value": tenant.name, "state": "open"})
+        (reqs, conns) = get_open_requests(tenant)
 
         # Get a list of ids that can be used in a db query
         ids_to_check = []
@@ -275,7 +355,7 @@ def cancel_unmigrated_requests(tenants):
             if len(reqs_to_cancel) > 0:
                 logger.debug("Cancelling unmigrated requests: %s" %
                              reqs_to_cancel)
-                conn.cancel_spot_instance_requests(ids_to_check)
+                cancel_requests(reqs_to_cancel, conns)
         except Exception as e:
             logger.exception("Error removing spot instance requests.")
             raise e
@@ -290,9 +370,7 @@ def cancel_unnecessary_requests(tenants):
     """
     for tenant in tenants:
         # start by grabbing all of the open spot requests for this tenant
-        conn = boto.connect_ec2(tenant.access_key, tenant.secret_key)
-        reqs = conn.get_all_spot_instance_requests(
-            filters={"tag-value": tenant.name, "state": "open"})
+        (reqs, conns) = get_open_requests(tenant)
         # That should be sufficient, but just because spot requests are
         # scary lets double check and kill anything if there are no idle
         # jobs.
@@ -307,14 +385,63 @@ def cancel_unnecessary_requests(tenants):
         if not all(stat == '1' for stat in status) or len(status) == 0:
             # Reorder these requests to a usable array
             id_to_req = request_ids_dict(reqs)
-            # Build a list of requests to cancel
-            to_cancel = id_to_req.keys()
+            # Build a list of requests to cancel, keeping the warm pool
+            warm = get_warm_request_ids(tenant, id_to_req.keys())
+            to_cancel = [r for r in id_to_req.keys() if r not in warm]
             # Cancel these requests
             if len(to_cancel) > 0:
                 logger.error("This should be deprecated if the other " +
                              "cancel function is working correctly.")
                 logger.debug("Cancelling spot requests: %s" % to_cancel)
-                conn.cancel_spot_instance_requests(to_cancel)
+                cancel_requests(to_cancel, conns)
+
+
+def get_open_requests(tenant):
+    """
+    Get a tenant's open spot requests in each of its regions, which are
+    queried at the same time. Returns the requests and a dict of the
+    connection to the region of each request, by its id.
+    """
+    found = map_regions(tenant, lambda conn: (
+        conn, conn.get_all_spot_instance_requests(
+            filters={"tag-value": tenant.name, "state": "open"})))
+    reqs = []
+    conns = {}
+    for (region, (conn, region_reqs)) in found:
+        for r in region_reqs:
+            conns[r.id] = conn
+            reqs.append(r)
+    return (reqs, conns)
+
+
+def cancel_requests(request_ids, conns):
+    """
+    Cancel spot requests with one call per region.
+    """
+    by_conn = {}
+    for request_id in request_ids:
+        by_conn.setdefault(conns[request_id], []).append(request_id)
+    for (conn, ids) in by_conn.iteritems():
+        conn.cancel_spot_instance_requests(ids)
+
+
+def get_warm_request_ids(tenant, ids):
+    """
+    Get the requests in a list that were made for the warm pool.
+    """
+    if len(ids) == 0:
+        return set()
+    try:
+        rows = ProvisionerConfig().dbconn.execute(
+            ("select request_id from instance_request where " +
+             "request_type = 'warm' and request_id in (%s) and " +
+             "tenant = %s") % (", ".join("'%s'" % i for i in ids),
+                               tenant.db_id))
+        return set(row['request_id'] for row in rows)
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+        logger.exception("Error getting warm requests.")
+    # Don't cancel anything we aren't sure about
+    return set(ids)
 
 
 def instance_acquired(inst, request, tenant, conn):
@@ -330,28 +457,121 @@ def instance_acquired(inst, request, tenant, conn):
          "public_dns, private_dns) values ('%s', '%s', '%s', '%s', '%s')") %
         (request['id'], inst.id, launch_time,
          inst.public_dns_name, inst.private_dns_name))
-    logger.debug("An instance has been acquired. " +
-                 "Tenant={0}; Request={1}, Instance={2}".format(
-                     tenant.name, repr(request), repr(inst)))
+    logger.debug("An instance has been acquired. "
+                 "Tenant=%s; Request=%r, Instance=%s",
+                 tenant.name, request, LazyRepr(inst))
 
     # now tag the request
     api.tag_requests(inst.id, tenant.name, conn)
 
+    # warm workers are launched before their job arrives
+    if request['job_runner_id'] is None:
+        return
     # if the job is still in the idle queue, we should remove it as the
     # instance was now launched for it
     for job in tenant.jobs:
-        logger.debug("Checking {0} vs {1}".format(repr(job), repr(request)))
         if int(job.id) == int(request['job_runner_id']):
-            logger.debug("Launched an instance for job %s - removing it." %
+            logger.debug("Launched an instance for job %s - removing it.",
                          request['job_runner_id'])
             job.fulfilled = True
 
 
-def migrate_instance():
+def migrate_instances(tenants):
+    """
+    Reuse workers that have finished their jobs for jobs waiting in the idle
+    queue. A job that fits an idle worker is removed from the idle queue so
+    no new instance is launched for it, and the worker is reserved so it is
+    not scaled in.
+    """
+    now = time.time()
+    for tenant in tenants:
+        if len(tenant.idle_jobs) == 0:
+            continue
+        workers = get_idle_workers(tenant, now)
+        if len(workers) == 0:
+            continue
+
+        # Give the largest jobs first pick of the workers
+        jobs = sorted(tenant.idle_jobs,
+                      key=lambda j: (int(j.req_cpus), int(j.req_mem)),
+                      reverse=True)
+        for job in jobs:
+            for worker in workers:
+                if not check_requirements(worker['instance'], job):
+                    continue
+                if migrate_instance(worker, job):
+                    workers.remove(worker)
+                    tenant.idle_jobs.remove(job)
+                    tenant.reserved_machines.add(worker['private_dns'])
+                break
+            if len(workers) == 0:
+                break
+
+
+def get_idle_workers(tenant, now):
     """
-    A placeholder for where the migration of instances will fit in to this.
+    Get the instances the provisioner launched for a tenant that are now
+    sitting idle in its pool, along with the job they last ran.
     """
-    logger.debug("Migration not yet supported.")
+    res = []
+    idle_machines = scaler.get_idle_machines(tenant, now)
+    if len(idle_machines) == 0:
+        return res
+
+    machines = (', '.join('\'' + item + '\'' for item in idle_machines))
+    try:
+        rows = ProvisionerConfig().dbconn.execute(
+            ("select instance.instance_id, instance.private_dns, " +
+             "coalesce((select to_job from instance_migration where " +
+             "instance_migration.instance_id = instance.instance_id " +
+             "order by migration_time desc limit 1), " +
+             "instance_request.job_runner_id) as job_runner_id, " +
+             "instance_type.id as type_id, instance_type.type, " +
+             "instance_type.ondemand_price, instance_type.cpus, " +
+             "instance_type.memory, instance_type.disk, instance_type.ami " +
+             "from instance, instance_request, instance_type where " +
+             "instance.request_id = instance_request.id and " +
+             "instance_request.instance_type = instance_type.id and " +
+             "instance.terminate_time is null and " +
+             "instance.private_dns in (%s) and " +
+             "instance_request.tenant = %s") % (machines, tenant.db_id))
+        for row in rows:
+            res.append({'instance_id': row['instance_id'],
+                        'private_dns': row['private_dns'],
+                        'job_runner_id': row['job_runner_id'],
+                        'instance': Instance(
+                            row['type_id'], row['type'],
+                            row['ondemand_price'], row['cpus'],
+                            row['memory'], row['disk'], row['ami'])})
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+        logger.exception("Error getting idle workers.")
+
+    return res
+
+
+def migrate_instance(worker, job):
+    """
+    Hand an idle worker over to another job and record the migration in
+    the database.
+    """
+    try:
+        logger.debug(
+            ("Migrating instance %s, from job %s to job %s.") %
+            (worker['instance_id'], worker['job_runner_id'], job.id))
+        # Only record the migration once if the job is still waiting for
+        # the worker on the next cycle
+        ProvisionerConfig().dbconn.execute(
+            ("insert into instance_migration " +
+             "(instance_id, from_job, to_job, migration_time) " +
+             "select '%s', %s, %s, NOW() where not exists " +
+             "(select 1 from instance_migration where instance_id = '%s' " +
+             "and to_job = %s)") %
+            (worker['instance_id'], worker['job_runner_id'] or 'null',
+             job.id, worker['instance_id'], job.id))
+        return True
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+        logger.exception("Error performing migration in database.")
+    return False
 
 
 def check_requirements(instance, job):
@@ -363,19 +583,11 @@ def check_requirements(instance, job):
     e.g. m2.4xlarge)
     """
     # This lets it pass in the name of an instance too, e.g. m2.4xlarge,
-    # where if it is a str it will look up the instance and use that.
-#    if isinstance(instance, basestring):
-#        instance_types = ProvisionerConfig().instance_types
-#        instance = [ins for ins in instance_types
-#                    if ins.type == instance][0]
-
+    # where if it is a str it will look up the instance in the catalog.
     if isinstance(instance, basestring):
-        for ins in ProvisionerConfig().instance_types:
-            if ins.type == instance:
-                instance = ins
-                break
-    # logger.debug(instance)
-    # logger.debug(ProvisionerConfig().instance_types)
+        instance = ProvisionerConfig().catalog.get(instance)
+        if instance is None:
+            return False
     # Check it meets cpu requirements
     if int(instance.cpus) < int(job.req_cpus):
         return False
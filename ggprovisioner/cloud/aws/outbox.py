@@ -0,0 +1,336 @@
+import Queue
+import threading
+
+import boto
+import psycopg2
+import sqlalchemy
+
+from ggprovisioner import logger, metrics, ProvisionerConfig
+from ggprovisioner.cloud.aws import api
+from ggprovisioner.cloud.aws.connection import (get_zone_connection,
+                                                region_of)
+
+OUTBOX_COLUMNS = ("tenant, job_runner_id, instance_type, request_type, " +
+                  "price, zone, count, packed_jobs, packed_cpus")
+
+
+class LaunchOutbox(object):
+    """
+    Make the requests selected for jobs through an outbox table rather
+    than calling EC2 while selecting. Each tenant's launches are written
+    to launch_outbox in one statement, and a pool of workers makes them
+    concurrently, so a slow EC2 call doesn't hold up the next tenant or
+    cycle.
+    Every launch has its own client token, which EC2 uses to make a
+    retried call return the request it already made instead of making
+    another. The instance requests are recorded and the launch marked done
+    in one statement, so a launch that fails part way, or is cut short by
+    a crash, is safe to make again.
+    Launches still in the outbox count as requests made for their jobs, so
+    they are not selected again while waiting for a worker.
+    """
+    def __init__(self, workers=4, max_attempts=5, stale_timeout=600):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        # Launches claimed by a worker longer ago than this are assumed to
+        # have been cut short and are made again
+        self.stale_timeout = stale_timeout
+        self.queue = Queue.Queue()
+        self.threads = []
+        # ids of the launches queued or being made by this process
+        self.queued = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the workers. With no workers, launches are made as soon as
+        they are queued, using the provisioner's connection.
+        """
+        for n in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.work,
+                                      name='launch-worker-%s' % n)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """
+        Stop the workers. Unless waiting for the queued launches to be
+        made, they are left in the outbox to be resumed by the next run.
+        """
+        if not wait:
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+            except Queue.Empty:
+                pass
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.lock:
+            self.queued = set()
+
+    def enqueue(self, tenant):
+        """
+        Write the launches selected for a tenant's idle jobs to the
+        outbox, and queue them for the workers.
+        """
+        values = []
+        # Jobs packed onto one instance share its request
+        launched = set()
+        for job in tenant.idle_jobs:
+            request = job.launch
+            if job.fulfilled is not False or request is None:
+                continue
+            if id(request) in launched:
+                continue
+            launched.add(id(request))
+            values.append(make_values(tenant, job, request))
+        if len(values) == 0:
+            return []
+
+        try:
+            rows = ProvisionerConfig().dbconn.execute(
+                ("insert into launch_outbox (%s) values %s returning *") %
+                (OUTBOX_COLUMNS, ", ".join(values)))
+            rows = [dict(row) for row in rows]
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Error writing launches for tenant %s to the "
+                             "outbox." % tenant.name)
+            return []
+        logger.debug("Queued %s launches for tenant %s.", len(rows),
+                     tenant.name)
+        self.submit(rows, tenant)
+        return rows
+
+    def resume(self, tenants):
+        """
+        Queue the launches of some tenants left in the outbox by an earlier
+        cycle or run, e.g. after EC2 errors or a crash.
+        """
+        if len(tenants) == 0:
+            return
+        by_id = dict((t.db_id, t) for t in tenants)
+        tenant_ids = ", ".join(str(db_id) for db_id in by_id)
+        try:
+            # Launches cut short on their last attempt are given up on
+            ProvisionerConfig().dbconn.execute(
+                ("update launch_outbox set state = 'failed', error = " +
+                 "'Cut short on every attempt.' where tenant in (%s) and " +
+                 "state = 'launching' and attempts >= %s and " +
+                 "claimed_time < now() - '%s second'::interval") %
+                (tenant_ids, self.max_attempts, self.stale_timeout))
+            rows = ProvisionerConfig().dbconn.execute(
+                ("select * from launch_outbox where tenant in (%s) and " +
+                 "(state = 'pending' or (state = 'launching' and " +
+                 "claimed_time < now() - '%s second'::interval)) " +
+                 "and attempts < %s order by id") %
+                (tenant_ids, self.stale_timeout, self.max_attempts))
+            rows = [dict(row) for row in rows]
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Error reading the launch outbox.")
+            return
+        for row in rows:
+            with self.lock:
+                if row['id'] in self.queued:
+                    continue
+            logger.info("Resuming launch %s for tenant %s.", row['id'],
+                        by_id[row['tenant']].name)
+            self.submit([row], by_id[row['tenant']])
+
+    def submit(self, rows, tenant):
+        if self.workers == 0:
+            for row in rows:
+                try:
+                    self.launch(ProvisionerConfig().dbconn, row, tenant)
+                except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+                    logger.exception("Error making launch %s." % row['id'])
+            return
+        self.start()
+        for row in rows:
+            with self.lock:
+                self.queued.add(row['id'])
+            self.queue.put((row, tenant))
+        metrics.OUTBOX_PENDING.set(self.queue.qsize())
+
+    def work(self):
+        """
+        Make queued launches until told to stop. Each worker has its own
+        database connection.
+        """
+        db = None
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+            (row, tenant) = task
+            try:
+                if db is None:
+                    db = ProvisionerConfig().engine.connect()
+                self.launch(db, row, tenant)
+            except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+                logger.exception("Lost the connection making launch %s."
+                                 % row['id'])
+                db = None
+            except Exception:
+                logger.exception("Error making launch %s." % row['id'])
+            finally:
+                with self.lock:
+                    self.queued.discard(row['id'])
+                self.queue.task_done()
+                metrics.OUTBOX_PENDING.set(self.queue.qsize())
+        if db is not None:
+            db.close()
+
+    def launch(self, db, row, tenant):
+        """
+        Make one launch from the outbox, unless another worker or replica
+        already has.
+        """
+        claimed = db.execute(
+            ("update launch_outbox set state = 'launching', attempts = " +
+             "attempts + 1, claimed_time = now() where id = %s and " +
+             "(state = 'pending' or (state = 'launching' and " +
+             "claimed_time < now() - '%s second'::interval)) and " +
+             "attempts < %s returning attempts") %
+            (row['id'], self.stale_timeout, self.max_attempts))
+        claimed = list(claimed)
+        if len(claimed) == 0:
+            return None
+        attempts = claimed[0]['attempts']
+
+        try:
+            # Ondemand instances are launched in the tenant's own zone
+            conn = get_zone_connection(tenant, row['zone'] or tenant.zone)
+            request_ids = make_request(conn, row, tenant)
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError), e:
+            logger.exception("There was an error communicating with EC2.")
+            return self.release(db, row, attempts, e)
+        except Exception, e:
+            # e.g. the tenant no longer has a subnet in the zone, the row
+            # must still leave the launching state
+            logger.exception("Error making launch %s." % row['id'])
+            return self.release(db, row, attempts, e)
+        if len(request_ids) == 0:
+            db.execute("update launch_outbox set state = 'failed', error = " +
+                       "'No requests were made.' where id = %s" % row['id'])
+            metrics.OUTBOX_LAUNCHES.inc(result='failed')
+            return None
+
+        for req in request_ids:
+            api.tag_requests(req, tenant.name, conn)
+        # The statement starts with a CTE, so isn't committed unless asked
+        db.execute(sqlalchemy.text(
+            complete_statement(row, tenant, request_ids)).execution_options(
+                autocommit=True))
+        metrics.OUTBOX_LAUNCHES.inc(result='done')
+        logger.debug("Made launch %s for job %s: %s", row['id'],
+                     row['job_runner_id'], ", ".join(request_ids))
+        return request_ids
+
+    def release(self, db, row, attempts, error):
+        """
+        Return a launch that failed to the outbox to be retried, or fail it
+        if it is out of attempts.
+        """
+        state = 'pending'
+        if attempts >= self.max_attempts:
+            state = 'failed'
+        db.execute(
+            ("update launch_outbox set state = '%s', error = '%s' " +
+             "where id = %s") %
+            (state, str(error).replace("'", "''")[:1000], row['id']))
+        metrics.OUTBOX_LAUNCHES.inc(result=state)
+        return None
+
+
+def make_values(tenant, job, request):
+    """
+    The outbox row for the request selected for a job.
+    """
+    if request.ondemand:
+        (request_type, price, zone) = ('ondemand', request.instance.ondemand,
+                                       'null')
+    else:
+        (request_type, price, zone) = ('spot', request.bid,
+                                       "'%s'" % request.zone)
+    (packed_jobs, packed_cpus) = ('null', 'null')
+    if request.packed:
+        packed_jobs = "array[%s]::integer[]" % ", ".join(
+            str(job_id) for (job_id, cpus) in request.packed)
+        packed_cpus = "array[%s]::integer[]" % ", ".join(
+            str(cpus) for (job_id, cpus) in request.packed)
+    return "(%s, %s, %s, '%s', %s, %s, %s, %s, %s)" % (
+        tenant.db_id, job.id, request.instance.db_id, request_type, price,
+        zone, request.count, packed_jobs, packed_cpus)
+
+
+def find_instance(db_id):
+    for ins in ProvisionerConfig().instance_types:
+        if ins.db_id == db_id:
+            return ins
+    raise ValueError("Instance type %s is not available." % db_id)
+
+
+def make_request(conn, row, tenant):
+    """
+    Call EC2 for a launch, using its client token so that making it again
+    returns the requests it already made. Returns the request ids, or the
+    instance ids for ondemand launches.
+    """
+    instance = find_instance(row['instance_type'])
+    image = instance.ami_in(region_of(row['zone'] or tenant.zone))
+    user_data = api.render_cloudinit(tenant, instance.cpus)
+    if row['request_type'] == 'ondemand':
+        res = conn.run_instances(
+            min_count=row['count'], max_count=row['count'],
+            key_name=tenant.key_pair, image_id=image,
+            security_group_ids=[tenant.security_group],
+            user_data=user_data, instance_type=instance.type,
+            subnet_id=tenant.subnet,
+            block_device_map=api.get_block_device_mapping(),
+            client_token=row['client_token'])
+        return [i.id for i in res.instances]
+    reqs = conn.request_spot_instances(
+        price=row['price'], image_id=image,
+        subnet_id=tenant.subnets[row['zone']], count=row['count'],
+        key_name=tenant.key_pair,
+        security_group_ids=[tenant.security_group],
+        instance_type=instance.type, user_data=user_data,
+        block_device_map=api.get_block_device_mapping(),
+        client_token=row['client_token'])
+    return [req.id for req in reqs]
+
+
+def complete_statement(row, tenant, request_ids):
+    """
+    The statement recording the requests made for a launch and marking it
+    done. It is a single statement so either both happen or neither does.
+    """
+    subnet = tenant.subnet_id
+    if row['request_type'] == 'spot':
+        subnet = tenant.subnets_db_id[row['zone']]
+    statement = (
+        ("with done as (update launch_outbox set state = 'done', " +
+         "error = null where id = %s returning *), " +
+         "inserted as (insert into instance_request (tenant, " +
+         "instance_type, price, job_runner_id, request_type, request_id, " +
+         "subnet) select done.tenant, done.instance_type, done.price, " +
+         "done.job_runner_id, done.request_type, made.request_id, %s " +
+         "from done, (values %s) as made (request_id) returning id) ") %
+        (row['id'], subnet,
+         ", ".join("('%s')" % req for req in request_ids)))
+    if row['packed_jobs']:
+        # Record each of the jobs packed onto the requests
+        return statement + (
+            "insert into instance_request_job (request, job_runner_id, " +
+            "cpus) select inserted.id, packed.job, packed.cpus from " +
+            "inserted, (values %s) as packed (job, cpus)") % ", ".join(
+                "(%s, %s)" % p
+                for p in zip(row['packed_jobs'], row['packed_cpus']))
+    return statement + "select count(*) from inserted"
@@ -0,0 +1,136 @@
+import random
+import threading
+import time
+
+from ggprovisioner import logger, metrics
+
+# EC2 gives describe calls and calls that change resources separate budgets
+DESCRIBE = 'describe'
+MUTATE = 'mutate'
+
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling')
+
+
+class TokenBucket(object):
+    """
+    A token bucket whose refill rate adapts to throttling. The rate is
+    halved each time a call is throttled and grows back slowly while calls
+    succeed (AIMD), so it settles just under the limit EC2 will accept.
+    """
+    def __init__(self, rate, burst, min_rate=0.2, max_rate=None,
+                 clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available. Returns the number
+        of seconds waited.
+        """
+        with self.lock:
+            self.refill(self.clock())
+            # Reserve the token now and wait outside the lock, so callers
+            # queue up in order rather than all waking at once
+            self.tokens -= 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """
+        A call was throttled: halve the rate and empty the bucket.
+        """
+        with self.lock:
+            self.refill(self.clock())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        """
+        A call went through: add a token per second to the rate over each
+        second's worth of calls.
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+
+class RateLimiter(object):
+    """
+    The call budgets of an AWS account, one bucket for describe calls and
+    one for calls that change resources.
+    """
+    def __init__(self, describe_rate, describe_burst, mutate_rate,
+                 mutate_burst, max_retries=5, clock=time.time,
+                 sleep=time.sleep):
+        self.buckets = {
+            DESCRIBE: TokenBucket(describe_rate, describe_burst,
+                                  clock=clock, sleep=sleep),
+            MUTATE: TokenBucket(mutate_rate, mutate_burst, clock=clock,
+                                sleep=sleep)}
+        self.max_retries = max_retries
+        self.sleep = sleep
+
+    def acquire(self, action):
+        kind = get_kind(action)
+        waited = self.buckets[kind].acquire()
+        metrics.EC2_LIMITER_WAIT_SECONDS.observe(waited, kind=kind)
+
+    def succeeded(self, action):
+        kind = get_kind(action)
+        bucket = self.buckets[kind]
+        bucket.succeeded()
+        metrics.EC2_CALL_RATE.set(bucket.rate, kind=kind)
+
+    def throttled(self, action, attempt):
+        """
+        Slow down after a call was throttled. Returns how long to back off
+        before retrying, or None if the call has been retried enough.
+        """
+        kind = get_kind(action)
+        bucket = self.buckets[kind]
+        bucket.throttled()
+        metrics.EC2_THROTTLES.inc(action=action)
+        metrics.EC2_CALL_RATE.set(bucket.rate, kind=kind)
+        if attempt >= self.max_retries:
+            logger.warn("%s was throttled %s times, giving up.",
+                        action, attempt + 1)
+            return None
+        # Full jitter, so throttled callers don't all retry together
+        return random.uniform(0, min(20, 0.5 * 2 ** attempt))
+
+
+def get_kind(action):
+    """
+    Work out which budget an EC2 action comes out of.
+    """
+    if action.startswith('Describe') or action.startswith('Get'):
+        return DESCRIBE
+    return MUTATE
+
+
+def is_throttled(response):
+    """
+    Check whether EC2 refused a call because the account is over its
+    request rate. The body of a boto response is cached once read, so it
+    is still there for the caller.
+    """
+    if response.status not in (400, 503):
+        return False
+    body = response.read()
+    return any(code in body for code in THROTTLE_CODES)
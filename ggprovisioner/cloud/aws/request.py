@@ -1,10 +1,16 @@
+import collections
+
 from ggprovisioner import SimpleStringifiable
+from ggprovisioner.cloud.aws.connection import region_of
 
 
 class Request(SimpleStringifiable):
     """
     Store the details of what is being requested.
     """
+    __slots__ = ('instance', 'instance_type', 'zone', 'ami', 'count', 'bid',
+                 'ondemand', 'odp', 'price', 'packed')
+
     def __init__(self, instance, instance_type, zone, ami, count, bid=0,
                  ondemand=False, odp=0, price=0):
         self.instance = instance
@@ -16,3 +22,56 @@ class Request(SimpleStringifiable):
         self.ondemand = ondemand
         self.odp = odp
         self.price = price
+        # The (job id, cpus) of each job sharing the instance, if several
+        # jobs have been packed onto it
+        self.packed = None
+
+
+class Candidate(collections.namedtuple('Candidate',
+                                       'instance zone ondemand price')):
+    """
+    An option for launching an instance type: ondemand, or as a spot
+    request in a zone at that zone's price. Candidates are immutable so a
+    single list of them can be shared between all of the jobs in a cycle;
+    a Request is only made for the candidate that is selected.
+    """
+    __slots__ = ()
+
+    @property
+    def instance_type(self):
+        return self.instance.type
+
+    @property
+    def ami(self):
+        return self.instance.ami_in(region_of(self.zone))
+
+    @property
+    def odp(self):
+        return self.instance.ondemand
+
+    def request(self, bid=0):
+        """
+        Make a request to launch one instance of this candidate.
+        """
+        return Request(self.instance, self.instance.type, self.zone,
+                       self.ami, 1, bid, self.ondemand,
+                       self.instance.ondemand, self.price)
+
+
+def make_candidates(instances):
+    """
+    Make the ondemand candidate and a spot candidate per zone for each
+    instance type, sorted by price. Zones are only included for instance
+    types with an image in their region.
+    """
+    candidates = []
+    regions = {}
+    for ins in instances:
+        candidates.append(Candidate(ins, "", True, ins.ondemand))
+        for zone, price in ins.spot.iteritems():
+            if zone not in regions:
+                regions[zone] = region_of(zone)
+            if ins.ami_in(regions[zone]) is None:
+                continue
+            candidates.append(Candidate(ins, zone, False, price))
+    return sorted(candidates, key=lambda k: k.price)
@@ -0,0 +1,200 @@
+import boto
+import calendar
+import datetime
+import psycopg2
+import sqlalchemy
+import time
+
+from ggprovisioner import logger, ProvisionerConfig
+from ggprovisioner.forecast import Forecaster
+from ggprovisioner.cloud.aws import api
+from ggprovisioner.cloud.aws.connection import (get_zone_connection,
+                                                map_regions)
+
+
+def scale_in(tenants):
+    """
+    Terminate workers that have been sitting idle in a tenant's pool for
+    longer than the idle threshold. Workers closest to the end of their
+    billing period go first, as they have the least paid-for time left.
+    """
+    config = ProvisionerConfig()
+    now = time.time()
+
+    for tenant in tenants:
+        idle_machines = get_idle_machines(tenant, now)
+        if len(idle_machines) == 0:
+            continue
+
+        try:
+            found = map_regions(tenant, lambda conn: (
+                conn, conn.get_all_instances(
+                    filters={"tag:tenant": tenant.name,
+                             "instance-state-name": "running"})))
+        except boto.exception.EC2ResponseError:
+            logger.exception("There was an error communicating with EC2.")
+            continue
+        # The connection to the region of each instance
+        conns = {}
+        instances = []
+        for (region, (conn, reservations)) in found:
+            for r in reservations:
+                for i in r.instances:
+                    conns[i.id] = conn
+                    instances.append(i)
+
+        workers = select_idle_workers(instances, idle_machines, now,
+                                      config.idle_threshold,
+                                      config.billing_period)
+        terminations = config.max_terminations
+        if config.warm_pool:
+            # Keep enough idle workers for the jobs forecast to arrive,
+            # keeping those with the most paid-for time left
+            warm = Forecaster().warm_target(tenant, now)
+            terminations = min(terminations,
+                               max(0, len(idle_machines) - warm))
+        workers = workers[:terminations]
+        if len(workers) == 0:
+            continue
+
+        output_string = ""
+        for (inst, idle, remaining) in workers:
+            output_string = (
+                "%sSCALE_IN_TERMINATE\t%s\t%s\t%s\t%s\t%s\n" %
+                (output_string, tenant.name, inst.id, inst.instance_type,
+                 int(idle), int(remaining)))
+
+        if config.scale_in_dry_run:
+            logger.info("Dry run, would terminate idle workers:\n%s" %
+                        output_string)
+            continue
+
+        logger.info("Terminating idle workers:\n%s" % output_string)
+        # terminate the whole batch in one call per region
+        by_conn = {}
+        for (inst, i, r) in workers:
+            by_conn.setdefault(conns[inst.id], []).append(inst.id)
+        for (conn, instance_ids) in by_conn.iteritems():
+            try:
+                conn.terminate_instances(instance_ids=instance_ids)
+            except boto.exception.EC2ResponseError:
+                logger.exception("Error terminating idle workers.")
+
+
+def get_idle_machines(tenant, now):
+    """
+    Work out which machines in a tenant's pool have nothing running on them.
+    Returns a dict of machine name to the number of seconds it has been
+    idle. Machines whose capacity is reserved for an idle job are skipped.
+    """
+    machines = {}
+    busy = set(tenant.reserved_machines)
+    for slot in tenant.slots:
+        if not slot.is_free():
+            busy.add(slot.machine)
+            continue
+        entered = slot.entered_activity or now
+        # The machine has only been idle since its last slot went idle
+        idle = now - int(entered)
+        if slot.machine not in machines or idle < machines[slot.machine]:
+            machines[slot.machine] = idle
+
+    for machine in busy:
+        machines.pop(machine, None)
+    return machines
+
+
+def select_idle_workers(instances, idle_machines, now, threshold, period):
+    """
+    Match idle machines to their instances and select those that have been
+    idle longer than the threshold. Returns a list of
+    (instance, seconds idle, seconds left in the billing period) tuples,
+    ordered so the instances nearest their billing boundary come first.
+    """
+    selected = []
+    for inst in instances:
+        # condor advertises the machine by its private hostname
+        idle = idle_machines.get(inst.private_dns_name)
+        if idle is None or idle < threshold:
+            continue
+        launch_time = datetime.datetime.strptime(inst.launch_time,
+                                                 "%Y-%m-%dT%H:%M:%S.000Z")
+        running = now - calendar.timegm(launch_time.timetuple())
+        remaining = period - (running % period)
+        selected.append((inst, idle, remaining))
+
+    return sorted(selected, key=lambda k: k[2])
+
+
+def scale_out_warm(tenants, candidates):
+    """
+    Keep a pool of warm workers ready for the jobs forecast to arrive, so
+    they don't wait for an instance to boot. Idle machines and warm
+    workers still booting count towards the pool. Workers are launched
+    for each tenant's most common job shape.
+    """
+    config = ProvisionerConfig()
+    if not config.warm_pool:
+        return
+    forecaster = Forecaster()
+    now = time.time()
+
+    for tenant in tenants:
+        target = forecaster.warm_target(tenant, now)
+        if target == 0:
+            continue
+        supply = (len(get_idle_machines(tenant, now)) +
+                  count_booting_warm_workers(tenant, config.boot_time))
+        if supply >= target:
+            continue
+
+        (rates, shape) = forecaster.load(tenant, now)
+        option = select_warm_option(candidates, shape, tenant)
+        if option is None:
+            logger.debug("No affordable warm worker for tenant %s.",
+                         tenant.name)
+            continue
+        bid = min(float(tenant.bid_percent) / 100 * float(option.odp),
+                  tenant.max_bid_price)
+        request = option.request(bid)
+        request.count = target - supply
+        logger.info("Launching %s warm workers for tenant %s (%s in %s).",
+                    request.count, tenant.name, option.instance_type,
+                    option.zone)
+        api.launch_warm_request(get_zone_connection(tenant, option.zone),
+                                request, tenant)
+
+
+def select_warm_option(candidates, shape, tenant):
+    """
+    Find the cheapest spot option the tenant can launch that fits a job
+    shape of (cpus, memory).
+    """
+    if shape is None:
+        return None
+    (cpus, memory) = shape
+    for option in candidates:
+        if (not option.ondemand and option.zone in tenant.subnets and
+                option.price < tenant.max_bid_price and
+                int(option.instance.cpus) >= cpus and
+                int(option.instance.memory) >= memory):
+            return option
+    return None
+
+
+def count_booting_warm_workers(tenant, boot_time):
+    """
+    Count the warm workers requested recently that have not started yet.
+    """
+    try:
+        rows = ProvisionerConfig().dbconn.execute(
+            ("select count(*) from instance_request left join instance on " +
+             "instance.request_id = instance_request.id where " +
+             "instance_request.tenant = %s and request_type = 'warm' and " +
+             "instance.id is null and request_time >= Now() - " +
+             "'%s second'::interval") % (tenant.db_id, boot_time))
+        for row in rows:
+            return row['count']
+    except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+        logger.exception("Error counting warm workers.")
+    return 0
@@ -0,0 +1,116 @@
+from ggprovisioner import Singleton, logger
+
+
+class InstanceTracker(object):
+    """
+    Keep the last known state of each tenant's instances between cycles so
+    only the instances that have changed state need to be written to the
+    database.
+    Because this class is a Singleton, the state survives for as long as
+    the provisioner is running.
+    """
+    __metaclass__ = Singleton
+
+    # The number of cycles to keep reporting a launched instance that has
+    # not been matched to a request before giving up on it
+    max_retries = 10
+
+    def __init__(self):
+        self.states = {}
+        self.retries = {}
+
+    def scan(self, conn, tenant, page_size=500):
+        """
+        Stream the instances that may belong to a tenant from EC2 a page at
+        a time. New instances are not tagged until they are recorded, so
+        running instances in the tenant's subnets are included as well as
+        anything tagged with the tenant.
+        """
+        filters = [{"tag:tenant": tenant.name}]
+        subnets = list(set(tenant.subnets.values()))
+        if len(subnets) > 0:
+            filters.append({"subnet-id": subnets,
+                            "instance-state-name": ["pending", "running"]})
+        for f in filters:
+            for inst in iter_instances(conn, f, page_size):
+                yield inst
+
+    def update(self, tenant, instances):
+        """
+        Record the current state of a tenant's instances. Returns a tuple of
+        the instances that have started running and those that have been
+        terminated since they were last seen.
+        """
+        previous = self.states.get(tenant.db_id, {})
+        current = {}
+        launched = []
+        terminated = []
+        for inst in instances:
+            # The same instance may be returned by more than one filter
+            if inst.id in current:
+                continue
+            current[inst.id] = inst.state
+            if inst.state == previous.get(inst.id):
+                continue
+            if inst.state == 'running':
+                launched.append(inst)
+            elif inst.state == 'terminated':
+                terminated.append(inst)
+
+        # Anything no longer returned by EC2 is forgotten
+        retries = self.retries.setdefault(tenant.db_id, {})
+        for inst_id in set(retries) - set(current):
+            del retries[inst_id]
+        self.states[tenant.db_id] = current
+        return (launched, terminated)
+
+    def forget(self, db_id):
+        """
+        Forget the instances of a tenant, so the next scan reports every
+        running instance again.
+        """
+        self.states.pop(db_id, None)
+        self.retries.pop(db_id, None)
+
+    def retry(self, tenant, instances):
+        """
+        Report launched instances again next cycle, as they could not be
+        matched to a request yet (e.g. the request has not been written to
+        the database).
+        """
+        retries = self.retries.setdefault(tenant.db_id, {})
+        again = []
+        for inst in instances:
+            count = retries.get(inst.id, 0) + 1
+            if count > self.max_retries:
+                logger.debug("Giving up on matching instance %s." % inst.id)
+                continue
+            retries[inst.id] = count
+            again.append(inst)
+        self.report_again(tenant, again)
+
+    def report_again(self, tenant, instances):
+        """
+        Report instances as changed again next cycle, e.g. as their changes
+        could not be written to the database.
+        """
+        states = self.states.get(tenant.db_id, {})
+        for inst in instances:
+            states.pop(inst.id, None)
+
+
+def iter_instances(conn, filters, page_size=500):
+    """
+    Yield the instances matching a set of filters, fetching one page of
+    reservations at a time.
+    """
+    next_token = None
+    while True:
+        reservations = conn.get_all_reservations(
+            filters=filters, max_results=page_size, next_token=next_token)
+        for r in reservations:
+            for i in r.instances:
+                yield i
+        next_token = reservations.next_token
+        if not next_token:
+            break
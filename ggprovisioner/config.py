@@ -1,4 +1,5 @@
 import ConfigParser
+import time
 
 import sqlalchemy
 import psycopg2
@@ -42,29 +43,127 @@ class ProvisionerConfig(object):
         port = config.get('Database', 'port')
         database = config.get('Database', 'database')
 
-        # create a connection and keep it as a config attribute
-        try:
-            engine = sqlalchemy.create_engine(
-                'postgresql://%s:%s@%s:%s/%s' %
-                (user, password, host, port, database))
-            self.dbconn = engine.connect()
-        except psycopg2.Error:
-            logger.exception("Failed to connect to database.")
+        # create a connection and keep it as a config attribute, unless told
+        # not to connect (e.g. when replaying recorded cycles)
+        self.engine = None
+        self.dbconn = None
+        if kwargs.get('connect', True):
+            try:
+                engine = sqlalchemy.create_engine(
+                    'postgresql://%s:%s@%s:%s/%s' %
+                    (user, password, host, port, database))
+                self.engine = engine
+                self.dbconn = engine.connect()
+            except psycopg2.Error:
+                logger.exception("Failed to connect to database.")
 
         # Get some provisioner specific config settings
         self.ondemand_price_threshold = float(
             config.get('Provision', 'ondemand_price_threshold'))
         self.max_requests = int(config.get('Provision', 'max_requests'))
         self.run_rate = int(config.get('Provision', 'run_rate'))
+        # Either a request per job ('single') or one EC2 fleet per group of
+        # jobs with the same options ('fleet')
+        self.launch_mode = config.get('Provision', 'launch_mode')
+        # Whether small jobs may be packed onto a shared instance
+        self.packing = config.getboolean('Provision', 'packing')
+        # The regions to provision in, the first being where ondemand
+        # instances are launched. With none, boto's default region is used
+        self.regions = [r.strip() for r in
+                        config.get('Provision', 'regions').split(',')
+                        if r.strip()]
+        # How often cached tenant data is reloaded even if no change has
+        # been notified by the database
+        self.cache_refresh_rate = int(
+            config.get('Provision', 'cache_refresh_rate'))
+
+        # Settings for terminating workers that have gone idle
+        self.scale_in = config.getboolean('ScaleIn', 'enabled')
+        self.idle_threshold = int(config.get('ScaleIn', 'idle_threshold'))
+        self.billing_period = int(config.get('ScaleIn', 'billing_period'))
+        self.max_terminations = int(
+            config.get('ScaleIn', 'max_terminations'))
+        self.scale_in_dry_run = config.getboolean('ScaleIn', 'dry_run')
+
+        # Settings for keeping warm workers ready for forecast jobs
+        self.warm_pool = config.getboolean('WarmPool', 'enabled')
+        self.max_warm_workers = int(config.get('WarmPool', 'max_workers'))
+        self.warm_coverage = float(config.get('WarmPool', 'coverage'))
+        self.boot_time = int(config.get('WarmPool', 'boot_time'))
+        self.history_weeks = int(config.get('WarmPool', 'history_weeks'))
+        self.forecast_refresh = int(config.get('WarmPool', 'refresh_rate'))
+
+        # Calls per second allowed to the EC2 API, and the bursts allowed
+        # above that, for describe calls and for calls changing resources
+        self.describe_rate = float(config.get('RateLimit', 'describe_rate'))
+        self.describe_burst = int(config.get('RateLimit', 'describe_burst'))
+        self.mutate_rate = float(config.get('RateLimit', 'mutate_rate'))
+        self.mutate_burst = int(config.get('RateLimit', 'mutate_burst'))
+        self.throttle_retries = int(config.get('RateLimit', 'max_retries'))
+
+        # Settings for exposing metrics
+        self.metrics_enabled = config.getboolean('Metrics', 'enabled')
+        self.metrics_port = int(config.get('Metrics', 'port'))
+
+        # Settings for watching the memory of the provisioner for leaks
+        self.memory_monitor = config.getboolean('Memory', 'enabled')
+        self.memory_interval = int(config.get('Memory', 'interval'))
+        self.memory_growth_checks = int(config.get('Memory',
+                                                   'growth_checks'))
+        self.memory_top = int(config.get('Memory', 'top'))
+        self.memory_trace = config.getboolean('Memory', 'tracemalloc')
+
+        # Settings for splitting the tenants between several replicas. The
+        # replica id defaults to the host name and process id
+        self.sharding = config.getboolean('Sharding', 'enabled')
+        self.replica_id = config.get('Sharding', 'replica_id')
+        self.lease_timeout = int(config.get('Sharding', 'lease_timeout'))
 
+        # Settings for making launches through the outbox table with a pool
+        # of workers, rather than while selecting
+        self.launch_outbox = config.getboolean('Outbox', 'enabled')
+        self.launch_workers = int(config.get('Outbox', 'workers'))
+        self.launch_attempts = int(config.get('Outbox', 'max_attempts'))
+        self.launch_stale_timeout = int(config.get('Outbox',
+                                                   'stale_timeout'))
+
+        # Settings for saving the caches to a checkpoint to warm start from
+        self.checkpoint = config.getboolean('Checkpoint', 'enabled')
+        self.checkpoint_path = config.get('Checkpoint', 'path')
+        self.checkpoint_interval = int(config.get('Checkpoint', 'interval'))
+        self.checkpoint_max_age = int(config.get('Checkpoint', 'max_age'))
+        self.checkpoint_price_age = int(config.get('Checkpoint',
+                                                   'price_age'))
+
+        # Settings for sharing the spot prices between the processes on a
+        # host through a memory-mapped table
+        self.price_cache = config.getboolean('PriceCache', 'enabled')
+        self.price_cache_path = config.get('PriceCache', 'path')
+        self.price_cache_max_age = int(config.get('PriceCache', 'max_age'))
+        self.price_cache_capacity = int(config.get('PriceCache',
+                                                   'capacity'))
+
+        # this must be imported here to avoid a circular import
+        from ggprovisioner.cloud.aws.catalog import InstanceCatalog
+        self.catalog = InstanceCatalog()
         self.instance_types = []
 
     def load_instance_types(self):
         """
-        Load instance types from database into config object
+        Load instance types from database into config object. The catalog
+        is only reloaded when a trigger notifies that the instance types
+        have changed, or when it is older than the refresh rate.
         """
         # this must be imported here to avoid a circular import
         from ggprovisioner.cloud import aws
+        from ggprovisioner.listener import ChangeListener
+
+        listener = ChangeListener()
+        listener.listen('instance_type_changed')
+        expired = (time.time() - self.catalog.loaded_time >
+                   self.cache_refresh_rate)
+        if not listener.changed('instance_type_changed') and not expired:
+            return
 
         def get_instance_types():
             """
@@ -79,6 +178,8 @@ class ProvisionerConfig(object):
                         row['id'], row['type'], row['ondemand_price'],
                         row['cpus'], row['memory'], row['disk'], 
                         row['ami']))
+                if len(self.regions) > 0:
+                    load_amis(instances)
             except psycopg2.Error:
                 logger.exception("Error getting instance types from database.")
             # logger.debug("The set of instances from the database:")
@@ -86,4 +187,24 @@ class ProvisionerConfig(object):
             #     logger.debug(repr(ins))
             return instances
 
-        self.instance_types = get_instance_types()
+        def load_amis(instances):
+            """
+            Set the image each instance type is launched from in each
+            region. An instance type's own image is for the first region,
+            and it can only be launched in the regions it has one for.
+            """
+            by_id = dict((ins.db_id, ins) for ins in instances)
+            for ins in instances:
+                ins.amis[self.regions[0]] = ins.ami
+            rows = self.dbconn.execute(
+                "select * from instance_region where region in (%s)" %
+                ", ".join("'%s'" % r for r in self.regions))
+            for row in rows:
+                if row['instance_type'] in by_id:
+                    by_id[row['instance_type']].amis[row['region']] = (
+                        row['ami'])
+
+        self.catalog.load(get_instance_types(), time.time())
+        self.instance_types = self.catalog.instances
+        logger.debug("Loaded version %s of the instance catalog." %
+                     self.catalog.version)
@@ -0,0 +1,219 @@
+import datetime
+import math
+
+import psycopg2
+import sqlalchemy
+
+from ggprovisioner import logger, ProvisionerConfig, Singleton
+
+HOUR = 3600
+WEEK = 7 * 24 * HOUR
+
+
+class Forecaster(object):
+    """
+    Learn how many jobs each tenant submits in each hour of the week from
+    the job history, and forecast how many will arrive soon. The rates are
+    reloaded from the database every refresh seconds.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        # tenant db id -> (loaded time, rates, most common job shape)
+        self.tenants = {}
+        # tenant db id -> job ids already written to the job history
+        self.recorded = {}
+
+    def record(self, tenant):
+        """
+        Add the jobs in a tenant's queue to the job history. Only jobs not
+        seen before are written.
+        """
+        seen = self.recorded.setdefault(tenant.db_id, set())
+        new = [job for job in tenant.jobs
+               if job.id not in seen and job.req_time is not None]
+        if len(new) == 0:
+            return
+        values = ", ".join("(%s, %s, %s, %s, %s)" %
+                           (tenant.db_id, job.id, int(job.req_cpus),
+                            int(job.req_mem), int(job.req_time))
+                           for job in new)
+        try:
+            # A job may already be recorded if the provisioner restarted
+            ProvisionerConfig().dbconn.execute(
+                ("insert into job_history (tenant, job_runner_id, cpus, " +
+                 "memory, submit_time) select v.tenant, v.job, v.cpus, " +
+                 "v.memory, to_timestamp(v.submitted) at time zone 'UTC' " +
+                 "from (values %s) as v(tenant, job, cpus, memory, " +
+                 "submitted) where not exists (select 1 from job_history " +
+                 "where job_history.tenant = v.tenant and " +
+                 "job_history.job_runner_id = v.job)") % values)
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Error recording job history.")
+            return
+        # Forget jobs that have left the queue so this doesn't grow
+        seen.intersection_update(job.id for job in tenant.jobs)
+        seen.update(job.id for job in new)
+
+    def load(self, tenant, now):
+        """
+        Get the hourly arrival rates and the most common job shape of a
+        tenant, reloading them from the job history when they are stale.
+        History older than the weeks the forecast covers is deleted when
+        reloading, so the table doesn't grow forever.
+        """
+        config = ProvisionerConfig()
+        cached = self.tenants.get(tenant.db_id)
+        if cached is not None and now - cached[0] < config.forecast_refresh:
+            return cached[1:]
+
+        weeks = config.history_weeks
+        counts = []
+        shape = None
+        try:
+            config.dbconn.execute(
+                ("delete from job_history where tenant = %s and " +
+                 "submit_time < (now() at time zone 'UTC') - " +
+                 "interval '%s weeks'") % (tenant.db_id, weeks))
+            rows = config.dbconn.execute(
+                ("select extract(isodow from submit_time) - 1 as weekday, " +
+                 "extract(hour from submit_time) as hour, count(*) " +
+                 "from job_history where tenant = %s and submit_time >= " +
+                 "(now() at time zone 'UTC') - interval '%s weeks' " +
+                 "group by 1, 2") % (tenant.db_id, weeks))
+            counts = [(int(row['weekday']), int(row['hour']), row['count'])
+                      for row in rows]
+            rows = config.dbconn.execute(
+                ("select cpus, memory, count(*) from job_history " +
+                 "where tenant = %s and submit_time >= " +
+                 "(now() at time zone 'UTC') - interval '%s weeks' " +
+                 "group by cpus, memory order by count(*) desc limit 1") %
+                (tenant.db_id, weeks))
+            for row in rows:
+                shape = (int(row['cpus']), int(row['memory']))
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Error loading job history.")
+
+        rates = build_rates(counts, weeks)
+        self.tenants[tenant.db_id] = (now, rates, shape)
+        return (rates, shape)
+
+    def warm_target(self, tenant, now):
+        """
+        The number of warm workers a tenant should have ready for the jobs
+        forecast to arrive within the time it takes to boot one.
+        """
+        config = ProvisionerConfig()
+        (rates, shape) = self.load(tenant, now)
+        expected = expected_arrivals(rates, now,
+                                     config.boot_time + config.run_rate)
+        return warm_pool_size(expected, config.warm_coverage,
+                              config.max_warm_workers)
+
+
+def build_rates(counts, weeks):
+    """
+    Turn (weekday, hour, count) rows covering a number of weeks into the
+    average number of jobs submitted in each hour of the week. Weekdays
+    start at 0 for Monday.
+    """
+    rates = [[0.0] * 24 for day in range(7)]
+    for (weekday, hour, count) in counts:
+        rates[weekday][hour] += float(count) / weeks
+    return rates
+
+
+def rates_from_arrivals(arrivals, weeks):
+    """
+    Build the hourly rates from a list of submission times.
+    """
+    counts = {}
+    for arrival in arrivals:
+        when = datetime.datetime.utcfromtimestamp(arrival)
+        key = (when.weekday(), when.hour)
+        counts[key] = counts.get(key, 0) + 1
+    return build_rates([(d, h, c) for ((d, h), c) in counts.iteritems()],
+                       weeks)
+
+
+def expected_arrivals(rates, start, horizon):
+    """
+    The number of jobs expected to arrive between start and start + horizon
+    seconds, walking through the hours the window covers.
+    """
+    expected = 0.0
+    t = start
+    end = start + horizon
+    while t < end:
+        when = datetime.datetime.utcfromtimestamp(t)
+        hour_end = t - (t % HOUR) + HOUR
+        step = min(end, hour_end) - t
+        expected += rates[when.weekday()][when.hour] * step / HOUR
+        t += step
+    return expected
+
+
+def warm_pool_size(expected, coverage, limit):
+    """
+    The smallest number of workers that covers the arrivals with the given
+    probability, treating arrivals as Poisson, up to a limit.
+    """
+    if expected <= 0:
+        return 0
+    size = 0
+    term = math.exp(-expected)
+    cdf = term
+    while cdf < coverage and size < limit:
+        size += 1
+        term *= expected / size
+        cdf += term
+    return size
+
+
+def backtest(arrivals, train_weeks, boot_time, step=60, coverage=0.8,
+             limit=10):
+    """
+    Replay a trace of submission times against a warm pool sized from the
+    rates learned over its first train_weeks weeks. Jobs arriving when a
+    warm worker is ready skip the boot. Returns a dict reporting the jobs
+    replayed, how many found a warm worker, the hours of latency that saved
+    and the instance-hours spent keeping workers warm.
+    """
+    arrivals = sorted(arrivals)
+    if len(arrivals) == 0:
+        return {'jobs': 0, 'warm_starts': 0, 'latency_saved_hours': 0.0,
+                'extra_instance_hours': 0.0}
+    split = arrivals[0] + train_weeks * WEEK
+    rates = rates_from_arrivals([a for a in arrivals if a < split],
+                                train_weeks)
+    replay = [a for a in arrivals if a >= split]
+
+    # The times warm workers become ready, in launch order
+    pool = []
+    warm_starts = 0
+    warm_seconds = 0.0
+    pos = 0
+    t = split
+    end = replay[-1] if replay else split
+    while t <= end:
+        # Jobs arriving in this step take any ready worker
+        while pos < len(replay) and replay[pos] < t + step:
+            ready = [w for w in pool if w <= replay[pos]]
+            if ready:
+                pool.remove(ready[0])
+                warm_starts += 1
+            pos += 1
+        # Size the pool for what is forecast, launching or terminating
+        target = warm_pool_size(expected_arrivals(rates, t, boot_time + step),
+                                coverage, limit)
+        while len(pool) < target:
+            pool.append(t + boot_time)
+        while len(pool) > target:
+            # Terminate the most recently launched first
+            pool.pop()
+        warm_seconds += len(pool) * step
+        t += step
+
+    return {'jobs': len(replay), 'warm_starts': warm_starts,
+            'latency_saved_hours': warm_starts * boot_time / float(HOUR),
+            'extra_instance_hours': warm_seconds / HOUR}
@@ -0,0 +1,100 @@
+import psycopg2
+import psycopg2.extensions
+import sqlalchemy.exc
+
+from ggprovisioner import Singleton, logger, ProvisionerConfig
+
+
+class ChangeListener(object):
+    """
+    Listen for Postgres notifications so cached data is only reloaded when
+    a trigger reports that the underlying tables have changed.
+    The listener uses its own autocommit connection, as notifications are
+    not delivered while a transaction is open. If the connection is lost,
+    every channel is reported as changed because notifications may have
+    been missed.
+    Because this class is a Singleton, there is one listening connection
+    shared by all caches.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.channels = set()
+        self.pending = set()
+        self.dbapi_conn = None
+        self.conn = None
+
+    def listen(self, channel):
+        """
+        Start listening on a channel. The channel reports a change straight
+        away so the cache behind it gets loaded.
+        """
+        if channel in self.channels:
+            return
+        self.channels.add(channel)
+        self.pending.add(channel)
+        if self.conn is not None:
+            self.execute_listen([channel])
+
+    def changed(self, channel):
+        """
+        Check whether a notification has arrived on a channel since the
+        last time it was checked.
+        """
+        self.poll()
+        if channel in self.pending:
+            self.pending.discard(channel)
+            return True
+        return False
+
+    def poll(self):
+        """
+        Collect any notifications waiting on the connection.
+        """
+        if self.conn is None and not self.connect():
+            return
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            logger.exception("Lost the notification connection.")
+            self.close()
+            return
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            self.pending.add(notify.channel)
+
+    def connect(self):
+        """
+        Open the listening connection and subscribe to every channel.
+        """
+        try:
+            # Hold on to the pooled connection so it is not handed back to
+            # the pool (and stops listening) when it is garbage collected
+            self.dbapi_conn = ProvisionerConfig().engine.raw_connection()
+            self.conn = self.dbapi_conn.connection
+            self.conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self.execute_listen(self.channels)
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Failed to listen for database notifications.")
+            self.close()
+            return False
+        # Anything could have changed while we were not listening
+        self.pending.update(self.channels)
+        return True
+
+    def execute_listen(self, channels):
+        cursor = self.conn.cursor()
+        for channel in channels:
+            cursor.execute("LISTEN %s" % channel)
+        cursor.close()
+
+    def close(self):
+        if self.dbapi_conn is not None:
+            try:
+                self.dbapi_conn.invalidate()
+            except psycopg2.Error:
+                pass
+        self.dbapi_conn = None
+        self.conn = None
+        self.pending.update(self.channels)
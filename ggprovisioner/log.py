@@ -0,0 +1,185 @@
+import atexit
+import logging
+import Queue
+import threading
+import time
+
+
+class LazyRepr(object):
+    """
+    Defer calling repr() on an object until a log record is actually
+    formatted, and only ever do it once.
+
+    Example usage:
+
+    >>> logger.debug("Removing job: %s", LazyRepr(job))
+    """
+    __slots__ = ('obj', 'text')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = repr(self.obj)
+        return self.text
+
+    __repr__ = __str__
+
+
+def fields(**kwargs):
+    """
+    Attach key/value pairs to a log record, e.g.
+    logger.debug("Selected instance", extra=fields(job=job.id))
+    """
+    return {'fields': kwargs}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    A formatter that appends any key/value fields attached to a record.
+    """
+    def format(self, record):
+        output = logging.Formatter.format(self, record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            output = "%s %s" % (output, " ".join(
+                "%s=%s" % (k, v) for (k, v) in sorted(
+                    record_fields.iteritems())))
+        return output
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records from each logging call every
+    `period` seconds. Warnings and errors are never dropped. The number of
+    records dropped is attached to the next record let through from that
+    call. Records are told apart by where they were logged rather than by
+    their message, as many calls share a bare format like "%s".
+    """
+    def __init__(self, rate=50, period=60, level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.period = period
+        self.level = level
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        now = time.time()
+        if len(self.windows) > 1000:
+            self.prune(now)
+        key = (record.pathname, record.lineno)
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.period:
+            suppressed = window[2] if window is not None else 0
+            window = self.windows[key] = [now, 0, 0]
+            if suppressed > 0:
+                if getattr(record, 'fields', None) is None:
+                    record.fields = {}
+                record.fields['suppressed'] = suppressed
+        if window[1] >= self.rate:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+    def prune(self, now):
+        """
+        Forget the calls whose windows have ended, so calls logged once
+        don't pile up.
+        """
+        for (key, window) in self.windows.items():
+            if now - window[0] >= self.period:
+                del self.windows[key]
+
+
+class QueueHandler(logging.Handler):
+    """
+    Put records on a queue so the slow handlers can write them from
+    another thread. The message is formatted here, as the objects it refers
+    to may have changed by the time the record is written.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Take records off a queue in a background thread and pass them on to a
+    set of handlers.
+    """
+    sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor,
+                                       name='log-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self.sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Write out anything still on the queue and stop the thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(self.sentinel)
+        self.thread.join()
+        self.thread = None
+
+
+def setup_logging(logger, level=logging.DEBUG, filename='provisioner.log',
+                  console=True, rate=50, period=60):
+    """
+    Configure a logger to write to a file (and the console) without the
+    calling thread waiting on the I/O. Returns the QueueListener doing the
+    writing.
+    """
+    formatter = StructuredFormatter('%(asctime)s %(levelname)s %(message)s')
+    handlers = []
+    if filename is not None:
+        handlers.append(logging.FileHandler(filename))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue = Queue.Queue(-1)
+    listener = QueueListener(queue, *handlers)
+    queue_handler = QueueHandler(queue)
+    queue_handler.addFilter(RateLimitFilter(rate, period))
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,135 @@
+import collections
+import gc
+import resource
+
+from ggprovisioner import logger, metrics
+from ggprovisioner.log import fields
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 only has tracemalloc when built with the pytracemalloc
+    # patches, otherwise growth is found by counting objects
+    tracemalloc = None
+
+
+class MemoryMonitor(object):
+    """
+    Watch the memory of the provisioner as it runs. After every interval
+    of cycles the RSS and the number of live objects of each type are
+    measured and the types that grew the most are logged, along with the
+    source lines that allocated the most since the last check if
+    tracemalloc is available and turned on.
+    If the RSS has grown at every one of the last growth_checks checks a
+    warning is logged, as the process is probably leaking.
+    """
+    def __init__(self, interval=1, growth_checks=10, top=10,
+                 trace=False, frames=1):
+        self.interval = interval
+        self.growth_checks = growth_checks
+        self.top = top
+        self.trace = trace and tracemalloc is not None
+        self.frames = frames
+        self.cycle = 0
+        self.counts = None
+        self.snapshot = None
+        self.history = collections.deque(maxlen=growth_checks + 1)
+        if trace and tracemalloc is None:
+            logger.warn("tracemalloc is not available, only counting "
+                        "objects.")
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def cycle_finished(self):
+        """
+        Check the memory if a whole interval of cycles has finished.
+        """
+        self.cycle += 1
+        if self.cycle % self.interval == 0:
+            self.check()
+
+    def check(self):
+        rss = get_rss()
+        counts = count_objects()
+        metrics.RSS_BYTES.set(rss)
+        metrics.OBJECTS.set(sum(counts.itervalues()))
+
+        growth = []
+        if self.counts is not None:
+            growth = top_growth(self.counts, counts, self.top)
+        self.counts = counts
+        logger.info("Memory after %s cycles", self.cycle,
+                    extra=fields(rss=rss, objects=sum(counts.itervalues()),
+                                 growth=format_growth(growth)))
+
+        if self.trace:
+            snapshot = tracemalloc.take_snapshot()
+            if self.snapshot is not None:
+                for stat in snapshot.compare_to(self.snapshot,
+                                                'lineno')[:self.top]:
+                    logger.info("Allocated since last check: %s", stat)
+            self.snapshot = snapshot
+
+        self.history.append(rss)
+        if self.is_growing():
+            metrics.MEMORY_GROWTH_ALERTS.inc()
+            logger.warn("RSS has grown at each of the last %s checks, from "
+                        "%s to %s bytes. The provisioner may be leaking "
+                        "memory.", self.growth_checks, self.history[0],
+                        self.history[-1])
+
+    def is_growing(self):
+        """
+        Check whether the RSS has grown at every recent check.
+        """
+        if len(self.history) <= self.growth_checks:
+            return False
+        history = list(self.history)
+        return all(b > a for (a, b) in zip(history, history[1:]))
+
+
+def get_rss():
+    """
+    The resident set size of this process in bytes. Where /proc is not
+    available the peak is used.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except IOError:
+        # Linux reports KB, but there is no /proc here so this is probably
+        # BSD or OS X, which report bytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_objects():
+    """
+    Count the objects tracked by the garbage collector by type.
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def top_growth(before, after, top):
+    """
+    The types whose number of objects grew the most, largest first.
+    """
+    growth = [(name, count - before.get(name, 0))
+              for (name, count) in after.iteritems()
+              if count > before.get(name, 0)]
+    growth.sort(key=lambda g: (-g[1], g[0]))
+    return growth[:top]
+
+
+def format_growth(growth):
+    return ",".join("%s+%s" % g for g in growth)
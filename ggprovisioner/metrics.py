@@ -0,0 +1,283 @@
+import threading
+import time
+import BaseHTTPServer
+
+from ggprovisioner import logger
+
+# Metrics are only collected once enabled, so an instrumented call costs a
+# single flag check when they are turned off
+enabled = False
+
+registry = {}
+lock = threading.Lock()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+
+
+class Metric(object):
+    """
+    A named metric holding one value per set of labels.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.values = {}
+        registry[name] = self
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for (labels, value) in sorted(self.values.items()):
+            lines.append("%s%s %s" % (self.name, format_labels(labels),
+                                      value))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. the number of calls made.
+    """
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, e.g. the size of a queue.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, e.g. how long calls take.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[key]
+            for (pos, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][pos] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """
+        Time a block of code and observe its duration in seconds.
+        """
+        if not enabled:
+            return NULL_TIMER
+        return Timer(self, labels)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for (labels, (counts, total, count)) in sorted(self.values.items()):
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                lines.append("%s_bucket%s %s" % (
+                    self.name, format_labels(labels + (('le', bound),)),
+                    bucket_count))
+            lines.append("%s_bucket%s %s" % (
+                self.name, format_labels(labels + (('le', '+Inf'),)),
+                count))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(labels),
+                                          total))
+            lines.append("%s_count%s %s" % (self.name, format_labels(labels),
+                                            count))
+        return lines
+
+
+class Timer(object):
+    """
+    A context manager observing how long its block took.
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class NullTimer(object):
+    """
+    The timer handed out while metrics are disabled. It does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for (k, v) in labels)
+
+
+def render():
+    """
+    Render every metric in the Prometheus text format.
+    """
+    lines = []
+    with lock:
+        for name in sorted(registry.keys()):
+            lines.extend(registry[name].render())
+    return "\n".join(lines) + "\n"
+
+
+PHASE_SECONDS = Histogram(
+    'ggprovisioner_phase_seconds',
+    'Time spent in each phase of a provisioning cycle.')
+EC2_CALLS = Counter(
+    'ggprovisioner_ec2_calls_total',
+    'Calls made to the EC2 API by action and HTTP status.')
+EC2_CALL_SECONDS = Histogram(
+    'ggprovisioner_ec2_call_seconds',
+    'Latency of calls made to the EC2 API by action.')
+DB_QUERIES = Counter(
+    'ggprovisioner_db_queries_total',
+    'Statements executed against the database by kind.')
+DB_QUERY_SECONDS = Histogram(
+    'ggprovisioner_db_query_seconds',
+    'Latency of statements executed against the database by kind.')
+JOBS = Gauge(
+    'ggprovisioner_jobs',
+    'Jobs found in the queue of each tenant.')
+IDLE_JOBS = Gauge(
+    'ggprovisioner_idle_jobs',
+    'Idle jobs left to provision for in each tenant.')
+EC2_THROTTLES = Counter(
+    'ggprovisioner_ec2_throttles_total',
+    'Calls to the EC2 API throttled by action.')
+EC2_CALL_RATE = Gauge(
+    'ggprovisioner_ec2_call_rate',
+    'Calls per second allowed to the EC2 API by kind of call.')
+EC2_LIMITER_WAIT_SECONDS = Histogram(
+    'ggprovisioner_ec2_limiter_wait_seconds',
+    'Time calls to the EC2 API waited on the rate limiter by kind of call.')
+RSS_BYTES = Gauge(
+    'ggprovisioner_rss_bytes',
+    'Resident set size of the provisioner when memory was last checked.')
+OBJECTS = Gauge(
+    'ggprovisioner_objects',
+    'Objects tracked by the garbage collector when memory was last '
+    'checked.')
+MEMORY_GROWTH_ALERTS = Counter(
+    'ggprovisioner_memory_growth_alerts_total',
+    'Checks finding that memory had grown at every recent check.')
+REPLICAS = Gauge(
+    'ggprovisioner_replicas',
+    'Provisioner replicas with a live lease.')
+HELD_TENANTS = Gauge(
+    'ggprovisioner_held_tenants',
+    'Tenants this replica holds the lock of and processes.')
+OUTBOX_PENDING = Gauge(
+    'ggprovisioner_outbox_pending',
+    'Launches queued for the launch workers.')
+OUTBOX_LAUNCHES = Counter(
+    'ggprovisioner_outbox_launches_total',
+    'Launches made from the outbox by result.')
+PRICE_CACHE_READS = Counter(
+    'ggprovisioner_price_cache_reads_total',
+    'Spot prices looked up in the shared price table by result.')
+
+
+def instrument_engine(engine):
+    """
+    Count and time every statement executed by a SQLAlchemy engine.
+    Statements that fail aren't counted.
+    """
+    from sqlalchemy import event
+
+    # The start time is kept on the statement's execution context, which
+    # is dropped with it, so a statement that fails leaves nothing behind
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if context is not None:
+            context._metrics_start = time.time()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        kind = statement.split(None, 1)[0].lower() if statement else ''
+        DB_QUERIES.inc(kind=kind)
+        start = getattr(context, '_metrics_start', None)
+        if start is not None:
+            DB_QUERY_SECONDS.observe(time.time() - start, kind=kind)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the metrics on /metrics.
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't write every scrape to stderr
+        pass
+
+
+def start_server(port, engine=None):
+    """
+    Turn on metrics collection and serve them over HTTP from a background
+    thread.
+    """
+    global enabled
+    enabled = True
+    if engine is not None:
+        instrument_engine(engine)
+
+    server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port %s." % port)
+    return server
@@ -0,0 +1,88 @@
+"""
+Pack idle jobs onto instances, so several small jobs can share one larger
+instance rather than each launching their own.
+"""
+
+
+def pack_jobs(jobs, max_price, subnets):
+    """
+    Pack jobs onto instances with first fit decreasing. The largest job
+    left opens a new instance, choosing the instance type that costs the
+    least per job once it is filled with the jobs left, largest first. Only
+    spot options cheaper than max_price in zones with one of the subnets
+    are used, and a job is only packed onto instance types in its
+    launch_options.
+    Returns a list of (candidate, jobs) pairs, cheapest zone of each type.
+    """
+    remaining = sorted(jobs, key=job_size, reverse=True)
+    # Jobs with the same eligible instances share their options, so the
+    # cheapest option of each type is only worked out once per list
+    cheapest = {}
+    for job in remaining:
+        if id(job.launch_options) not in cheapest:
+            cheapest[id(job.launch_options)] = cheapest_by_type(
+                job.launch_options, max_price, subnets)
+
+    bins = []
+    while len(remaining) > 0:
+        first = remaining[0]
+        best = None
+        for (db_id, option) in cheapest[id(first.launch_options)].iteritems():
+            packed = fill(option.instance, remaining, cheapest)
+            if len(packed) == 0 or packed[0] is not first:
+                continue
+            cost = float(option.price) / len(packed)
+            # Prefer the smaller instance when the cost per job is the same
+            if (best is None or cost < best[0] or
+                    (cost == best[0] and
+                     int(option.instance.cpus) < int(best[1].instance.cpus))):
+                best = (cost, option, packed)
+        if best is None:
+            # Nothing affordable, leave it to launch on its own
+            remaining.pop(0)
+            continue
+        bins.append((best[1], best[2]))
+        placed = set(id(job) for job in best[2])
+        remaining = [job for job in remaining if id(job) not in placed]
+    return bins
+
+
+def fill(instance, jobs, cheapest):
+    """
+    Fill an instance with jobs, taken in order, that fit in what is left of
+    it and can be launched on its type.
+    """
+    cpus = int(instance.cpus)
+    memory = int(instance.memory)
+    packed = []
+    for job in jobs:
+        if instance.db_id not in cheapest[id(job.launch_options)]:
+            continue
+        (req_cpus, req_mem) = job_size(job)
+        if req_cpus <= cpus and req_mem <= memory:
+            packed.append(job)
+            cpus -= req_cpus
+            memory -= req_mem
+            if cpus == 0:
+                break
+    return packed
+
+
+def cheapest_by_type(options, max_price, subnets):
+    """
+    Find the cheapest affordable spot option of each instance type, in the
+    zones there is a subnet to launch in.
+    """
+    cheapest = {}
+    # The options are sorted by price, so the first of each type is cheapest
+    for option in options:
+        if (option.ondemand or option.price >= max_price or
+                option.zone not in subnets):
+            continue
+        if option.instance.db_id not in cheapest:
+            cheapest[option.instance.db_id] = option
+    return cheapest
+
+
+def job_size(job):
+    return (int(job.req_cpus), int(job.req_mem))
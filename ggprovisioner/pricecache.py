@@ -0,0 +1,253 @@
+import collections
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+from ggprovisioner import logger, metrics
+
+MAGIC = 'GGPRICE2'
+
+# The magic, the sequence number, the capacity and number of entries, and
+# when the prices were last refreshed
+HEADER = struct.Struct('<8sQIId')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+
+# The instance type, zone and region of a price, the price and when it
+# was fetched. An entry with no zone marks an instance type as fetched, so
+# types with no spot prices are known to be up to date too.
+ENTRY = struct.Struct('<32s32s24sdd')
+
+# Reads are retried while a write is in progress, then given up on
+READ_ATTEMPTS = 100
+
+PriceEntry = collections.namedtuple('PriceEntry',
+                                    'instance_type zone region price time')
+
+
+class PriceCache(object):
+    """
+    A table of spot prices in a memory-mapped file, shared by every
+    provisioner process on a host, so the prices are fetched from EC2 once
+    per host rather than once per process.
+    The table has a fixed layout: a header followed by an entry for each
+    instance type fetched and one for each of its zones. Any number of
+    processes read it without a lock.
+    A writer makes the sequence number in the header odd while it writes
+    and even again when done, and a reader retries if the sequence number
+    was odd or changed while it read. Writers take a lock file, so when the
+    prices are stale only one process fetches them and the others wait
+    for it and read what it wrote. A table too small for the prices is
+    replaced by a bigger one, which readers map when they see the file
+    has changed.
+    """
+    def __init__(self, path, max_age=300, capacity=4096):
+        self.path = path
+        self.max_age = max_age
+        self.capacity = capacity
+        self.map = None
+        self.inode = None
+
+    def refresh(self, instances, fetch):
+        """
+        Set the spot prices of instance types from the table if it is
+        fresh. Otherwise fetch them with the function given and write them
+        to the table, unless another process refreshes it first.
+        """
+        if self.read(instances):
+            metrics.PRICE_CACHE_READS.inc(result='hit')
+            return
+        try:
+            with self.writing():
+                # Another process may have refreshed the table while this
+                # one waited for the lock
+                if self.read(instances):
+                    metrics.PRICE_CACHE_READS.inc(result='waited')
+                    return
+                fetch()
+                self.write(instances)
+                metrics.PRICE_CACHE_READS.inc(result='refreshed')
+        except (IOError, OSError):
+            logger.exception("Failed to refresh the price table %s." %
+                             self.path)
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        Hold the lock writers take while refreshing the table.
+        """
+        with open('%s.lock' % self.path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self, instances):
+        """
+        Set the spot prices of instance types from the table. Returns
+        False, leaving them as they were, if the table is missing or stale
+        or some of the instance types weren't fetched for it.
+        """
+        table = self.snapshot()
+        if table is None:
+            return False
+        (refreshed, entries) = table
+        if time.time() - refreshed > self.max_age:
+            return False
+        wanted = set(ins.type for ins in instances)
+        fetched = set()
+        spot = collections.defaultdict(dict)
+        for entry in entries:
+            if entry.instance_type not in wanted:
+                continue
+            if entry.zone:
+                spot[entry.instance_type][entry.zone] = entry.price
+            else:
+                fetched.add(entry.instance_type)
+        if len(fetched) < len(wanted):
+            return False
+        for ins in instances:
+            ins.spot.update(spot[ins.type])
+        return True
+
+    def entries(self):
+        """
+        When the table was refreshed and the PriceEntries of its prices, or
+        None if there is no table or it couldn't be read.
+        """
+        table = self.snapshot()
+        if table is None:
+            return None
+        (refreshed, entries) = table
+        return (refreshed, [entry for entry in entries if entry.zone])
+
+    def snapshot(self):
+        """
+        When the table was refreshed and all of its entries, read without
+        a lock, or None if there is no table or a consistent read could
+        not be made.
+        """
+        if not self.open():
+            return None
+        for attempt in range(READ_ATTEMPTS):
+            sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+            if sequence % 2 == 1:
+                # A write is in progress
+                time.sleep(0.001)
+                continue
+            (magic, x, capacity, count, refreshed) = HEADER.unpack_from(
+                self.map, 0)
+            entries = [read_entry(self.map, i)
+                       for i in xrange(min(count, capacity))]
+            if SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] == sequence:
+                return (refreshed, entries)
+        logger.warning("Gave up reading the price table %s while it was "
+                       "being written.", self.path)
+        return None
+
+    def open(self):
+        """
+        Map the table for reading, mapping it again if it has been
+        replaced. Returns whether there is a table mapped.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return False
+        if inode == self.inode:
+            return True
+        self.close()
+        try:
+            with open(self.path, 'rb') as f:
+                table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error):
+            logger.exception("Failed to map the price table %s." % self.path)
+            return False
+        if len(table) < HEADER.size or table[:len(MAGIC)] != MAGIC:
+            # It is replaced by the next refresh
+            logger.error("%s is not a price table of this version." %
+                         self.path)
+            table.close()
+            return False
+        self.map = table
+        self.inode = inode
+        return True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.inode = None
+
+    def write(self, instances, now=None):
+        """
+        Write the spot prices of instance types to the table. This must
+        only be done holding the writers' lock.
+        """
+        # This is imported here so reading the table doesn't import boto
+        from ggprovisioner.cloud.aws.connection import region_of
+
+        if now is None:
+            now = time.time()
+        entries = []
+        for ins in instances:
+            entries.append(PriceEntry(ins.type, '', '', 0.0, now))
+            entries.extend(PriceEntry(ins.type, zone, region_of(zone) or '',
+                                      float(price), now)
+                           for (zone, price) in sorted(ins.spot.iteritems()))
+        capacity = self.table_capacity()
+        if capacity is None or capacity < len(entries):
+            self.create(max(self.capacity, 2 * len(entries)))
+
+        with open(self.path, 'r+b') as f:
+            table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            sequence = SEQUENCE.unpack_from(table, SEQUENCE_OFFSET)[0]
+            SEQUENCE.pack_into(table, SEQUENCE_OFFSET, sequence + 1)
+            for (i, entry) in enumerate(entries):
+                ENTRY.pack_into(table, HEADER.size + i * ENTRY.size,
+                                entry.instance_type, entry.zone,
+                                entry.region, entry.price, entry.time)
+            (magic, x, capacity, count, refreshed) = HEADER.unpack_from(
+                table, 0)
+            HEADER.pack_into(table, 0, MAGIC, sequence + 1, capacity,
+                             len(entries), now)
+            SEQUENCE.pack_into(table, SEQUENCE_OFFSET, sequence + 2)
+            table.flush()
+        finally:
+            table.close()
+        logger.debug("Wrote the prices of %s instance types to the price "
+                     "table %s.", len(instances), self.path)
+
+    def table_capacity(self):
+        """
+        The number of entries the table has room for, or None if there
+        is no table.
+        """
+        if not self.open():
+            return None
+        return HEADER.unpack_from(self.map, 0)[2]
+
+    def create(self, capacity):
+        """
+        Make an empty table, replacing any there is in one step so readers
+        never see a partly made one.
+        """
+        temp = '%s.tmp' % self.path
+        with open(temp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 0, capacity, 0, 0))
+            f.truncate(HEADER.size + capacity * ENTRY.size)
+        os.rename(temp, self.path)
+        logger.info("Made a price table for %s prices at %s.", capacity,
+                    self.path)
+
+
+def read_entry(table, index):
+    (ins_type, zone, region, price, fetched) = ENTRY.unpack_from(
+        table, HEADER.size + index * ENTRY.size)
+    return PriceEntry(ins_type.rstrip('\0'), zone.rstrip('\0'),
+                      region.rstrip('\0'), price, fetched)
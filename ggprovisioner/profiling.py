@@ -0,0 +1,140 @@
+import contextlib
+import cProfile
+import os
+import signal
+
+from ggprovisioner import logger
+
+
+class PhaseProfiler(object):
+    """
+    Profile each phase of a cycle separately with cProfile. Profiling only
+    happens while the profiler is active, so an idle profiler can be left
+    in place on a live process.
+    The profile of each phase is written out as <phase>.pstats.
+    """
+    def __init__(self):
+        self.active = False
+        self.profiles = {}
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        self.active = False
+
+    def reset(self):
+        self.profiles = {}
+
+    @contextlib.contextmanager
+    def profile(self, phase):
+        """
+        Profile a block of code as part of a phase.
+        """
+        if not self.active:
+            yield
+            return
+        prof = self.profiles.setdefault(phase, cProfile.Profile())
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+
+    def dump(self, directory):
+        """
+        Write a pstats file for each phase that has been profiled.
+        """
+        make_directory(directory)
+        for (phase, prof) in self.profiles.iteritems():
+            path = os.path.join(directory, '%s.pstats' % phase)
+            prof.dump_stats(path)
+            logger.info("Wrote profile of %s to %s" % (phase, path))
+
+
+class StackSampler(object):
+    """
+    A low overhead sampling profiler. The stack is sampled every interval
+    of CPU time and the samples are written out per phase as
+    <phase>.folded, in the collapsed format used by flamegraph.pl.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.active = False
+        self.phase = None
+        self.stacks = {}
+
+    def start(self):
+        self.active = True
+        signal.signal(signal.SIGPROF, self.sample)
+        # Restart system calls interrupted by a sample rather than failing
+        # them, e.g. reads from condor_q
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        self.active = False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def reset(self):
+        self.stacks = {}
+
+    @contextlib.contextmanager
+    def profile(self, phase):
+        """
+        Attribute the samples taken during a block of code to a phase.
+        """
+        self.phase = phase
+        try:
+            yield
+        finally:
+            self.phase = None
+
+    def sample(self, signum, frame):
+        if self.phase is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%s)" % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        counts = self.stacks.setdefault(self.phase, {})
+        counts[key] = counts.get(key, 0) + 1
+
+    def dump(self, directory):
+        """
+        Write the collapsed stacks of each phase that has been sampled.
+        """
+        make_directory(directory)
+        for (phase, counts) in self.stacks.iteritems():
+            path = os.path.join(directory, '%s.folded' % phase)
+            with open(path, 'w') as f:
+                for (stack, count) in sorted(counts.iteritems()):
+                    f.write("%s %s\n" % (stack, count))
+            logger.info("Wrote stack samples of %s to %s" % (phase, path))
+
+
+def make_directory(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def install_toggle(profiler, directory, signum=signal.SIGUSR1):
+    """
+    Let a signal turn profiling on and off in a running process. When
+    profiling is turned off, the results are written to the directory.
+    e.g. kill -USR1 <pid>
+    """
+    def toggle(signum, frame):
+        if profiler.active:
+            profiler.stop()
+            profiler.dump(directory)
+            profiler.reset()
+        else:
+            logger.info("Profiling started.")
+            profiler.start()
+
+    signal.signal(signum, toggle)
@@ -1,9 +1,16 @@
 import psycopg2
+import contextlib
+import logging
 import datetime
 import calendar
 import time
 
-from ggprovisioner import logger, ProvisionerConfig, tenant, scheduler
+from ggprovisioner import (logger, ProvisionerConfig, tenant, scheduler,
+                           checkpoint, memory, metrics, packing,
+                           pricecache, sharding)
+from ggprovisioner.forecast import Forecaster
+from ggprovisioner.log import LazyRepr, fields
+from ggprovisioner.profiling import PhaseProfiler
 from ggprovisioner.cloud import aws
 from ggprovisioner.scheduler.condor.condor_scheduler import CondorScheduler
 
@@ -13,55 +20,162 @@ class Provisioner(object):
     A provisioner for cloud resources.
     Cost effectively acquires and manages instances.
     """
-    def __init__(self):
+    def __init__(self, profiler=None, scheduler=None):
         self.tenants = []
 
-        # Read in any config data and set up the database connection
-        ProvisionerConfig()
+        # Every launch option for this cycle, sorted by price, and the
+        # options for each set of eligible instance types
+        self.candidates = []
+        self.candidate_cache = {}
+
+        # Phases are profiled while the profiler is active
+        self.profiler = profiler
+        if self.profiler is None:
+            self.profiler = PhaseProfiler()
+
+        # Jobs are read from condor unless another scheduler is given
+        self.scheduler = scheduler
+        if self.scheduler is None:
+            self.scheduler = CondorScheduler()
 
-    def run(self):
+        # Read in any config data and set up the database connection
+        config = ProvisionerConfig()
+
+        # Memory is checked for leaks after each cycle if asked to
+        self.memory = None
+        if config.memory_monitor:
+            self.memory = memory.MemoryMonitor(
+                config.memory_interval, config.memory_growth_checks,
+                config.memory_top, config.memory_trace)
+
+        # With several replicas, each processes the tenants it holds
+        self.shards = None
+        if config.sharding:
+            self.shards = sharding.ShardCoordinator(config.replica_id,
+                                                    config.lease_timeout)
+
+        # When the spot prices were last fetched, and the version of the
+        # catalog whose prices were restored from a checkpoint, if any
+        self.prices_time = 0
+        self.restored_prices = None
+
+        # The caches are saved to a checkpoint to warm start from
+        self.checkpoint = None
+        if config.checkpoint:
+            self.checkpoint = checkpoint.Checkpoint(
+                config.checkpoint_path, config.checkpoint_interval,
+                config.checkpoint_max_age, config.checkpoint_price_age)
+
+        # Spot prices are shared with the other processes on the host
+        self.price_cache = None
+        if config.price_cache:
+            self.price_cache = pricecache.PriceCache(
+                config.price_cache_path, config.price_cache_max_age,
+                config.price_cache_capacity)
+
+        # Launches are made by a pool of workers from the outbox if asked to
+        self.outbox = None
+        if config.launch_outbox:
+            self.outbox = aws.outbox.LaunchOutbox(
+                config.launch_workers, config.launch_attempts,
+                config.launch_stale_timeout)
+
+    def run(self, cycles=None):
         """
         Run the provisioner. This should execute periodically and
-        determine what actions need to be taken.
+        determine what actions need to be taken. If a number of cycles is
+        given, stop after running that many.
+        """
+        cycle = 0
+        if self.memory is not None:
+            self.memory.start()
+        if self.checkpoint is not None:
+            self.checkpoint.load(self)
+        try:
+            while True:
+                self.run_cycle()
+                if self.memory is not None:
+                    self.memory.cycle_finished()
+                if self.checkpoint is not None:
+                    self.checkpoint.cycle_finished(self)
+
+                cycle += 1
+                if cycles is not None and cycle >= cycles:
+                    break
+
+                # wait "run_rate" seconds before trying again
+                time.sleep(ProvisionerConfig().run_rate)
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.save(self)
+            # Launches not yet made are resumed by the next run
+            if self.outbox is not None:
+                self.outbox.stop(wait=False)
+            # Hand this replica's tenants over to the others
+            if self.shards is not None:
+                self.shards.close(leave=True)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time and profile a phase of a cycle.
         """
+        with metrics.PHASE_SECONDS.time(phase=name):
+            with self.profiler.profile(name):
+                yield
 
-        while True:
-            # Get the tenants from the database and process the current
-            # condor_q. Also assign those jobs to each tenant.
+    def run_cycle(self):
+        """
+        Run a single provisioning cycle, timing each of its phases.
+        """
+        # Get the tenants from the database and process the current
+        # condor_q. Also assign those jobs to each tenant.
+        with self.phase('load_tenants_and_jobs'):
             self.load_tenants_and_jobs()
 
-            # provisioning will fail if there are no tenants
-            if len(self.tenants) > 0:
-                # Handle all of the existing requests. This will cancel or
-                # migrate excess requests and update the database to reflect
-                # the state of the environment
+        # provisioning will fail if there are no tenants
+        if len(self.tenants) > 0:
+            # Handle all of the existing requests. This will cancel or
+            # migrate excess requests and update the database to reflect
+            # the state of the environment
+            with self.phase('manage_resources'):
                 self.manage_resources()
 
-                # Work out the price for each instance type and acquire
-                # resources for jobs
+            # Work out the price for each instance type and acquire
+            # resources for jobs
+            with self.phase('provision_resources'):
                 self.provision_resources()
 
-            # wait "run_rate" seconds before trying again
-            time.sleep(ProvisionerConfig().run_rate)
-
     def load_tenants_and_jobs(self):
         """
         Get all of the tenants from the database and then read the condor
         queue to get their respective jobs.
         """
-        # Load all of the tenants
-        self.tenants = tenant.load_from_db()
+        # Load all of the tenants. These are cached between cycles and only
+        # reloaded when the tenant tables change.
+        tenants = tenant.TenantRegistry().get_tenants()
+        # Other replicas may be processing some of them
+        if self.shards is not None:
+            tenants = self.shards.claim(tenants)
+        self.tenants = tenants
 
         # Load all of the jobs from condor and associate them with the tenants.
         # This will also remove jobs that should not be processed (e.g. an
         # instance has been fulfilled for them already).
-        sched = CondorScheduler()
-        sched.load_jobs(self.tenants)
+        self.scheduler.load_jobs(self.tenants)
+
+        # Learn how jobs arrive, for sizing the warm pool
+        if ProvisionerConfig().warm_pool:
+            forecaster = Forecaster()
+            for t in self.tenants:
+                forecaster.record(t)
 
         # Print out what we found
         logger.debug("Found the following tenants:")
         for t in self.tenants:
-            logger.debug(repr(t))
+            logger.debug("%s", LazyRepr(t))
+            metrics.JOBS.set(len(t.jobs), tenant=t.name)
+            metrics.IDLE_JOBS.set(len(t.idle_jobs), tenant=t.name)
 
     def manage_resources(self):
         """
@@ -76,60 +190,79 @@ class Provisioner(object):
 
         scheduler.base_scheduler.ignore_fulfilled_jobs(self.tenants)
 
+        # Terminate any workers that have been left idle for too long
+        if ProvisionerConfig().scale_in:
+            aws.scaler.scale_in(self.tenants)
+
     def provision_resources(self):
         # This passes tenant[0] (a test tenant with my credentials) to use its
         # credentials to query the AWS API for price data
-        # price data is stored in the Instance objects
-        aws.api.get_spot_prices(ProvisionerConfig().instance_types,
-                                self.tenants[0])
+        # price data is stored in the Instance objects. Prices restored from
+        # a checkpoint stand in for the first fetch, unless the catalog they
+        # were restored with has since been reloaded.
+        config = ProvisionerConfig()
+        if self.restored_prices != config.catalog.version:
+            aws.api.get_spot_prices(config.instance_types, self.tenants[0],
+                                    self.price_cache)
+            self.prices_time = time.time()
+        self.restored_prices = None
 
         # Select a request to make for each job
         self.select_instance_type(ProvisionerConfig().instance_types)
-        # Make the requests for the resources
+        # Make the requests for the resources. Launches left in the outbox
+        # by earlier cycles are retried first
+        if self.outbox is not None:
+            self.outbox.resume(self.tenants)
         for t in self.tenants:
-            aws.api.request_resources(t)
+            if ProvisionerConfig().launch_mode == 'fleet':
+                aws.fleet.request_fleets(t)
+            elif self.outbox is not None:
+                self.outbox.enqueue(t)
+            else:
+                aws.api.request_resources(t)
+
+        # Have workers ready for the jobs expected to arrive soon
+        aws.scaler.scale_out_warm(self.tenants, self.candidates)
+
+    def load_candidates(self, instances):
+        """
+        Make the sorted list of <type,zone> and <type,ondemand> options
+        that every job picks from this cycle.
+        """
+        self.candidates = aws.request.make_candidates(instances)
+        self.candidate_cache = {}
 
     def get_potential_instances(self, eligible_instances, job):
         """
-        Make a list of all <type,zone> and <type,ondemand> pairs then order
-        them.
+        Get the options a job can be launched with, cheapest first. Jobs
+        with the same eligible instances share the same list, so it must
+        not be modified.
         """
-        unsorted_instances = []
-        # Add an entry for each instance type as ondemand, or each spot price
-        # so we can sort everything and pick the cheapest.
-        for ins in eligible_instances:
-            unsorted_instances.append(aws.Request(
-                ins, ins.type, "", ins.ami, 1, 0, True,
-                ins.ondemand, ins.ondemand))
-            # Don't bother adding spot prices if it is an ondemand request:
-            if not job.ondemand:
-                for zone, price in ins.spot.iteritems():
-                    unsorted_instances.append(aws.Request(
-                        ins, ins.type, zone, ins.ami, 1, 0, False, 
-                        ins.ondemand, price))
-        
-        # Now sort all of these instances by price
-        sorted_instances = sorted(unsorted_instances, key=lambda k: k.price)
-
-        return sorted_instances
+        key = (tuple(ins.db_id for ins in eligible_instances), job.ondemand)
+        if key not in self.candidate_cache:
+            eligible = set(key[0])
+            # Don't bother with spot prices if it is an ondemand request
+            self.candidate_cache[key] = [
+                c for c in self.candidates
+                if c.instance.db_id in eligible and
+                (c.ondemand or not job.ondemand)]
+        return self.candidate_cache[key]
 
     def print_cheapest_options(self, sorted_instances):
         # Print out the top three
-        logger.info("Top three to select from:")
-        top_three = 3
-        for ins in sorted_instances:
-            if top_three == 0:
-                break
-            logger.info("    %s %s %s" %
-                        (ins.instance_type, ins.zone, ins.price))
-            top_three = top_three - 1
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info("Top three to select from: %s",
+                    ", ".join("%s %s %s" % (ins.instance_type, ins.zone,
+                                            ins.price)
+                              for ins in sorted_instances[:3]))
 
     def get_timeout_ondemand(self, job, tenant, instances):
         """
         Check to see if the job now requires an ondemand instance due to
         timing out.
         """
-        cur_time = datetime.datetime.now()
+        cur_time = datetime.datetime.fromtimestamp(time.time())
         cur_time = calendar.timegm(cur_time.timetuple())
 
         time_idle = cur_time - int(job.req_time)
@@ -140,8 +273,7 @@ class Provisioner(object):
         if tenant.timeout > 0 and time_idle > tenant.timeout:
             # sort the eligibile instances by their ondemand price (odp)
             sorted_instances = sorted(instances, key=lambda k: k.odp)
-            logger.debug("Selecting ondemand instance: %s" %
-                         str(job.launch))
+            logger.debug("Selecting ondemand instance: %s", job.launch)
             res_instance = sorted_instances[0]
         return res_instance
 
@@ -156,10 +288,10 @@ class Provisioner(object):
         if (launch_instance is not None and
                 launch_instance.odp < tenant.max_bid_price):
             job.launch = aws.Request(
-                launch_instance, launch_instance.type, "", launch_instance.ami,
-                1, launch_instance.odp, True)
-            logger.debug("Selected to launch on demand due to timeout: %s" %
-                         str(job.launch))
+                launch_instance.instance, launch_instance.instance_type, "",
+                launch_instance.ami, 1, launch_instance.odp, True)
+            logger.debug("Selected to launch on demand due to timeout: %s",
+                         job.launch)
             needed = True
 
         # check if the job is flagged as needing on-demand
@@ -168,9 +300,9 @@ class Provisioner(object):
 
         # if the cheapest option is ondemand
         elif cheapest.ondemand and cheapest.odp < tenant.max_bid_price:
-            job.launch = cheapest
-            logger.debug("Selected to launch on demand due to ondemand " +
-                         "being cheapest: %s" % repr(cheapest))
+            job.launch = cheapest.request()
+            logger.debug("Selected to launch on demand due to ondemand "
+                         "being cheapest: %r", cheapest)
             needed = True
 
         # or if the cheapest option close in price to ondemand, then use
@@ -179,10 +311,9 @@ class Provisioner(object):
                 (ProvisionerConfig().ondemand_price_threshold *
                     float(cheapest.odp)) and
                 cheapest.price < tenant.max_bid_price):
-            job.launch = cheapest
-            logger.debug("Selected to launch on demand due to spot price " +
-                         "being close to ondemand price: %s" %
-                         repr(cheapest))
+            job.launch = cheapest.request()
+            logger.debug("Selected to launch on demand due to spot price "
+                         "being close to ondemand price: %r", cheapest)
             needed = True
 
         return needed
@@ -191,7 +322,10 @@ class Provisioner(object):
         """
         Select the instance to launch for each idle job.
         """
+        self.load_candidates(instances)
         for tenant in self.tenants:
+            # Spot jobs with no requests yet, which could share an instance
+            packable = []
             for job in list(tenant.idle_jobs):
                 # Get the set of instance types that can be used for this job
                 eligible_instances = self.restrict_instances(job)
@@ -201,6 +335,7 @@ class Provisioner(object):
                 # get all potential pairs and sort them
                 sorted_instances = self.get_potential_instances(
                     eligible_instances, job)
+                job.launch_options = sorted_instances
                 if len(sorted_instances) == 0:
                     logger.error("Failed to find any sorted instances for job %s" % job)
                     continue
@@ -215,10 +350,11 @@ class Provisioner(object):
                 if job.ondemand:
                     sorted_instances = self.get_potential_instances(
                         eligible_instances, job)
+                    job.launch_options = sorted_instances
 
-                    job.launch = sorted_instances[0]
-                    logger.debug("Launching ondemand for this job. %s" %
-                                 str(job.launch))
+                    job.launch = sorted_instances[0].request()
+                    logger.debug("Launching ondemand for this job. %s",
+                                 job.launch)
                     continue
 
                 # otherwise we are now looking at launching a spot request
@@ -227,41 +363,68 @@ class Provisioner(object):
                 # filter out a job if it has had too many requests made
                 existing_requests = self.get_existing_requests(tenant, job)
                 if len(existing_requests) >= ProvisionerConfig().max_requests:
-                    logger.debug(("Too many requests already exist " +
-                                  "for this job: %s") % job.id)
+                    logger.debug("Too many requests already exist "
+                                 "for this job", extra=fields(job=job.id))
                     tenant.idle_jobs.remove(job)
                     continue
 
                 # Find the top request that hasn't already been requested
                 # (e.g. zone+type pair is not in existing_requests)
+                existing = set((r.instance_type, r.zone)
+                               for r in existing_requests)
                 for req in sorted_instances:
-                    if len(existing_requests) > 0:
-                        # Skip this type if a matching request already
-                        # exists
-                        exists = False
-                        for existing in existing_requests:
-                            logger.debug("Comparing existing requests:")
-                            logger.debug("%s vs %s" % (req.instance_type, 
-                                                       existing.instance_type))
-                            logger.debug("%s vs %s" % (req.zone, 
-                                                       existing.zone))
-                            if (req.instance_type == existing.instance_type and
-                                    req.zone == existing.zone):
-                                exists = True
-                        if exists:
-                            continue
+                    # Zones in other regions may have no subnet of the
+                    # tenant's to launch in
+                    if not req.ondemand and req.zone not in tenant.subnets:
+                        continue
+                    # Skip this type if a matching request already exists
+                    if (req.instance_type, req.zone) in existing:
+                        logger.debug("Request already exists",
+                                     extra=fields(job=job.id,
+                                                  type=req.instance_type,
+                                                  zone=req.zone))
+                        continue
                     # Launch this type. 
                     if req.price < tenant.max_bid_price:
-                        req.bid = self.get_bid_price(job, tenant, req)
-                        job.launch = req
-                        logger.debug("Selecting instance: %s" %
-                                     str(job.launch))
+                        job.launch = req.request(
+                            self.get_bid_price(job, tenant, req))
+                        logger.debug("Selecting instance: %s", job.launch)
+                        if len(existing_requests) == 0:
+                            packable.append(job)
                         break
                     else:
                         logger.error(("Unable to launch request %s as " +
                                       "the bid is higher than max bid " +
                                       "%s.") % (str(req), tenant.max_bid_price))
 
+            # Fleets choose their own instance types, so they launch an
+            # instance per job
+            config = ProvisionerConfig()
+            if (config.packing and config.launch_mode != 'fleet' and
+                    len(packable) > 1):
+                self.pack_jobs(tenant, packable)
+
+    def pack_jobs(self, tenant, jobs):
+        """
+        Pack jobs onto shared instances where that costs less per job than
+        the instances selected for each of them. The jobs packed onto an
+        instance share its request.
+        """
+        for (option, packed) in packing.pack_jobs(jobs,
+                                                  tenant.max_bid_price,
+                                                  tenant.subnets):
+            if len(packed) < 2:
+                continue
+            req = option.request(self.get_bid_price(packed[0], tenant,
+                                                    option))
+            req.packed = [(job.id, int(job.req_cpus)) for job in packed]
+            for job in packed:
+                job.launch = req
+            logger.debug("Packed %s jobs onto one instance",
+                         len(packed), extra=fields(
+                             type=option.instance_type, zone=option.zone,
+                             jobs=",".join(str(j.id) for j in packed)))
+
     def get_existing_requests(self, tenant, job):
         # Get all of the outstanding requests from the db for this instance
         existing_requests = []
@@ -271,8 +434,9 @@ class Provisioner(object):
                  "instance_request.request_type, " +
                  "instance_type.type, " +
                  "instance_request.subnet, subnet_mapping.zone " +
-                 "from instance_request, subnet_mapping, instance_type " +
-                 "where job_runner_id = %s and " +
+                 "from job_request, instance_request, subnet_mapping, " +
+                 "instance_type where job_request.job_runner_id = %s and " +
+                 "job_request.request = instance_request.id and " +
                  "instance_request.tenant = %s and " +
                  "instance_request.instance_type = instance_type.id and "
                  "subnet_mapping.id = instance_request.subnet") %
@@ -293,19 +457,17 @@ class Provisioner(object):
         """
         eligible_instances = []
 
-        # Check if the instance is viable for the job
-        instance_types = ProvisionerConfig().instance_types
-        for instance in instance_types:
-            # logger.debug("type:%s cpus:%s mem:%s -- req cpus:%s req_mem:%s" %
-                         # (instance.type, instance.cpus, instance.memory,
-                          # job.req_cpus, job.req_mem))
+        # Only look at the instance types large enough for the job, then
+        # check if the instance is viable for the job
+        catalog = ProvisionerConfig().catalog
+        for instance in catalog.fitting(job.req_cpus, job.req_mem):
             if aws.manager.check_requirements(instance, job):
                 eligible_instances.append(instance)
 
         # Print out the eligible instances
-        logger.debug("Eligibile instances:")
-        for ins in eligible_instances:
-            logger.debug(ins.type)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Eligibile instances: %s",
+                         ", ".join(ins.type for ins in eligible_instances))
 
         return eligible_instances
 
@@ -0,0 +1,700 @@
+import collections
+import datetime
+import decimal
+import gzip
+import json
+import subprocess
+import threading
+import time
+from StringIO import StringIO
+
+import boto.exception
+import psycopg2
+import sqlalchemy.exc
+
+from ggprovisioner import logger, Provisioner, ProvisionerConfig
+from ggprovisioner.cloud.aws import connection
+from ggprovisioner.listener import ChangeListener
+from ggprovisioner.scheduler.condor import condor_scheduler
+
+TRACE_VERSION = 1
+
+# Attributes of boto objects that are not recorded, as they lead back to
+# the connection
+SKIPPED_ATTRIBUTES = set(['connection', 'region'])
+
+# Call arguments left out of the key an EC2 response is found by. Times
+# follow the clock, and the cloudinit script may hold secrets
+UNKEYED_ARGUMENTS = set(['start_time', 'end_time', 'user_data'])
+
+# Columns whose values are never written to a trace
+REDACTED_COLUMNS = set(['secret_key'])
+
+
+class TraceMismatch(Exception):
+    """
+    A replayed cycle made a call that was not recorded.
+    """
+    pass
+
+
+class Recorded(object):
+    """
+    An object read back from a trace, with the attributes it was recorded
+    with.
+    """
+    def __init__(self, attrs):
+        self.__dict__.update(attrs)
+
+    def __repr__(self):
+        return '<Recorded %s>' % ', '.join(
+            '%s=%r' % item for item in sorted(self.__dict__.iteritems()))
+
+
+class RecordedList(list):
+    """
+    A list read back from a trace that had attributes, e.g. a page of boto
+    results with its next_token.
+    """
+    pass
+
+
+class FixedOffset(datetime.tzinfo):
+    def __init__(self, seconds):
+        self.offset = datetime.timedelta(seconds=seconds)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+
+def encode(value, stack=()):
+    """
+    Turn a value into something JSON can hold. Objects keep their public
+    attributes and properties, so boto results can be read back without
+    boto's classes.
+    """
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        if offset is not None:
+            offset = offset.days * 86400 + offset.seconds
+        return {'__datetime__': [value.year, value.month, value.day,
+                                 value.hour, value.minute, value.second,
+                                 value.microsecond, offset]}
+    if isinstance(value, datetime.date):
+        return {'__date__': [value.year, value.month, value.day]}
+    if id(value) in stack:
+        return None
+    stack = stack + (id(value),)
+    if isinstance(value, dict):
+        return {'__map__': sorted([encode(k, stack), encode(v, stack)]
+                                  for (k, v) in value.iteritems())}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [encode(v, stack) for v in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        attrs = getattr(value, '__dict__', None)
+        if attrs:
+            return {'__list__': items, 'attrs': encode_attrs(value, stack)}
+        return items
+    if hasattr(value, '__dict__'):
+        return {'__object__': encode_attrs(value, stack)}
+    return repr(value)
+
+
+def encode_attrs(value, stack):
+    attrs = {}
+    names = [n for n in vars(value) if not n.startswith('_')]
+    for cls in type(value).__mro__:
+        names.extend(n for (n, v) in vars(cls).iteritems()
+                     if isinstance(v, property) and not n.startswith('_'))
+    for name in names:
+        if name in SKIPPED_ATTRIBUTES or name in attrs:
+            continue
+        try:
+            attr = getattr(value, name)
+        except Exception:
+            continue
+        if not callable(attr):
+            attrs[name] = encode(attr, stack)
+    return attrs
+
+
+def decode(value):
+    """
+    Read back a value written by encode.
+    """
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__decimal__' in value:
+        return decimal.Decimal(value['__decimal__'])
+    if '__datetime__' in value:
+        parts = value['__datetime__']
+        tz = FixedOffset(parts[7]) if parts[7] is not None else None
+        return datetime.datetime(*parts[:7], tzinfo=tz)
+    if '__date__' in value:
+        return datetime.date(*value['__date__'])
+    if '__map__' in value:
+        return dict((make_hashable(decode(k)), decode(v))
+                    for (k, v) in value['__map__'])
+    if '__list__' in value:
+        items = RecordedList(decode(v) for v in value['__list__'])
+        items.__dict__.update(decode_attrs(value['attrs']))
+        return items
+    if '__object__' in value:
+        return Recorded(decode_attrs(value['__object__']))
+    return dict((k, decode(v)) for (k, v) in value.iteritems())
+
+
+def decode_attrs(attrs):
+    return dict((str(k), decode(v)) for (k, v) in attrs.iteritems())
+
+
+def make_hashable(value):
+    if isinstance(value, list):
+        return tuple(make_hashable(v) for v in value)
+    return value
+
+
+def make_key(*parts):
+    """
+    The canonical form of a call, that a replayed call is matched on.
+    """
+    return json.dumps(encode(parts), sort_keys=True)
+
+
+def encode_error(e):
+    """
+    Record an error raised by a call, so the replayed call raises it too.
+    Returns None for errors that are not recorded.
+    """
+    if isinstance(e, boto.exception.BotoServerError):
+        return {'error': 'ec2', 'status': e.status, 'reason': e.reason,
+                'body': e.body}
+    if isinstance(e, boto.exception.BotoClientError):
+        return {'error': 'boto', 'message': e.reason}
+    if isinstance(e, (psycopg2.Error, sqlalchemy.exc.DBAPIError)):
+        return {'error': 'db', 'message': str(e)}
+    if isinstance(e, OSError):
+        return {'error': 'os', 'errno': e.errno, 'message': e.strerror}
+    return None
+
+
+def raise_error(error):
+    if error['error'] == 'ec2':
+        raise boto.exception.EC2ResponseError(error['status'],
+                                              error['reason'], error['body'])
+    if error['error'] == 'boto':
+        raise boto.exception.BotoClientError(error['message'])
+    if error['error'] == 'db':
+        raise psycopg2.Error(error['message'])
+    raise OSError(error['errno'], error['message'])
+
+
+class RecordedResult(object):
+    """
+    The result of a statement, held in memory, with the parts of a
+    SQLAlchemy result the provisioner uses.
+    """
+    def __init__(self, keys, rows, rowcount):
+        self.columns = keys
+        self.index = dict((k, i) for (i, k) in enumerate(keys))
+        self.rows = [RecordedRow(self.index, r) for r in rows]
+        self.rowcount = rowcount
+        self.returns_rows = len(keys) > 0
+        self.position = 0
+
+    def keys(self):
+        return list(self.columns)
+
+    def __iter__(self):
+        while self.position < len(self.rows):
+            self.position += 1
+            yield self.rows[self.position - 1]
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def first(self):
+        row = self.fetchone()
+        self.close()
+        return row
+
+    def scalar(self):
+        row = self.first()
+        return row[0] if row is not None else None
+
+    def close(self):
+        self.position = len(self.rows)
+
+
+class RecordedRow(tuple):
+    """
+    A row that can be read by column name, position or attribute.
+    """
+    def __new__(cls, index, values):
+        row = tuple.__new__(cls, values)
+        row.index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self.index[key]
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        try:
+            return self[self.index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def keys(self):
+        return sorted(self.index, key=self.index.get)
+
+
+class RecordedProcess(object):
+    """
+    A finished process, with the parts of a Popen the scheduler uses.
+    """
+    def __init__(self, output, returncode):
+        self.stdout = StringIO(output)
+        self.output = output
+        self.returncode = returncode
+
+    def communicate(self, input=None):
+        return (self.output, '')
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class RecordedResponse(object):
+    """
+    A response to a raw query API call, as made for fleets.
+    """
+    def __init__(self, status, reason, body):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class Recorder(object):
+    """
+    Record every input of the cycles of a Provisioner into a trace file:
+    the output of condor commands, the responses of EC2, the results of
+    database statements and the notifications of the change listener,
+    along with the settings and the time each cycle started.
+    The trace is gzipped JSON, one event per line. Secret keys are
+    redacted and cloudinit scripts are not written.
+    """
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wb')
+        self.cycle = 0
+        self.lock = threading.Lock()
+
+    def attach(self, prov):
+        """
+        Start recording the inputs of a provisioner's cycles.
+        """
+        config = ProvisionerConfig()
+        # Launches are made inline so their statements go through the
+        # recorded connection rather than the workers' own
+        config.launch_workers = 0
+        if prov.outbox is not None:
+            prov.outbox.workers = 0
+        # Cycles start from nothing, as they do when replayed
+        config.checkpoint = False
+        prov.checkpoint = None
+        # Prices must be fetched to be recorded
+        config.price_cache = False
+        prov.price_cache = None
+        self.write({'version': TRACE_VERSION,
+                    'settings': get_settings(config)})
+
+        real_factory = connection.factory
+
+        def factory(access_key, secret_key, **kwargs):
+            return RecordingConnection(
+                self, real_factory(access_key, secret_key, **kwargs),
+                kwargs.get('region'))
+        connection.factory = factory
+        connection.connections.clear()
+
+        condor_scheduler.popen = self.popen
+        config.dbconn = RecordingDatabase(self, config.dbconn)
+        listener = ChangeListener()
+        listener.changed = self.record_changed(listener.changed)
+        if prov.shards is not None:
+            prov.shards.claim = self.record_claim(prov.shards.claim)
+
+        run_cycle = prov.run_cycle
+
+        def record_cycle():
+            self.cycle += 1
+            self.write({'cycle': self.cycle, 'clock': time.time()})
+            try:
+                run_cycle()
+            finally:
+                self.file.flush()
+        prov.run_cycle = record_cycle
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        # Regions are called from several threads at once
+        with self.lock:
+            self.file.write(line)
+
+    def record(self, channel, key, value=None, error=None):
+        event = {'channel': channel, 'key': key}
+        if error is not None:
+            event['error'] = error
+        else:
+            event['value'] = encode(value)
+        self.write(event)
+
+    def record_changed(self, changed):
+        def recorded(channel):
+            result = changed(channel)
+            self.record('notify', make_key(channel), result)
+            return result
+        return recorded
+
+    def record_claim(self, claim):
+        """
+        Record which tenants the replica held, as the locks are taken
+        outside of the recorded database connection.
+        """
+        def recorded(tenants):
+            held = claim(tenants)
+            self.record('shards', make_key([t.db_id for t in tenants]),
+                        [t.db_id for t in held])
+            return held
+        return recorded
+
+    def popen(self, cmd, **kwargs):
+        key = make_key(cmd)
+        try:
+            proc = subprocess.Popen(cmd, **kwargs)
+        except OSError, e:
+            self.record('command', key, error=encode_error(e))
+            raise
+        output = proc.communicate()[0]
+        self.record('command', key, {'output': output,
+                                     'returncode': proc.returncode})
+        return RecordedProcess(output, proc.returncode)
+
+    def close(self):
+        self.file.close()
+
+
+class RecordingConnection(object):
+    """
+    Wrap an EC2 connection to record the response to every call.
+    """
+    def __init__(self, recorder, conn, region=None):
+        self.__dict__['recorder'] = recorder
+        self.__dict__['conn'] = conn
+        self.__dict__['region'] = region
+
+    def __setattr__(self, name, value):
+        # e.g. the limiter, which the wrapped connection waits on
+        setattr(self.conn, name, value)
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name.startswith('_') or isinstance(attr, type) or not callable(
+                attr):
+            return attr
+
+        def call(*args, **kwargs):
+            key = ec2_key(name, args, kwargs, self.region)
+            try:
+                result = attr(*args, **kwargs)
+            except Exception, e:
+                error = encode_error(e)
+                if error is not None:
+                    self.recorder.record('ec2', key, error=error)
+                raise
+            if name == 'make_request':
+                body = result.read()
+                self.recorder.record('ec2', key, {
+                    'status': result.status, 'reason': result.reason,
+                    'body': body})
+                return RecordedResponse(result.status, result.reason, body)
+            self.recorder.record('ec2', key, result)
+            return result
+        return call
+
+
+def ec2_key(name, args, kwargs, region=None):
+    """
+    The key of an EC2 call. Regions are called at the same time, so calls
+    in a region other than the default are kept apart by the region.
+    """
+    if name == 'make_request' and len(args) > 1 and args[1] is not None:
+        # The parameters of a raw query call, e.g. launch template data
+        params = dict((k, v) for (k, v) in args[1].iteritems()
+                      if not k.endswith('UserData'))
+        args = (args[0], params) + tuple(args[2:])
+    if region is not None:
+        name = '%s:%s' % (region, name)
+    return make_key(name, args, dict(
+        (k, v) for (k, v) in kwargs.iteritems()
+        if k not in UNKEYED_ARGUMENTS))
+
+
+class RecordingDatabase(object):
+    """
+    Wrap a database connection to record the result of every statement.
+    Everything else is passed through.
+    """
+    def __init__(self, recorder, conn):
+        self.recorder = recorder
+        self.conn = conn
+
+    def execute(self, statement, *args, **kwargs):
+        key = make_key(str(statement), args, kwargs)
+        try:
+            result = self.conn.execute(statement, *args, **kwargs)
+        except Exception, e:
+            error = encode_error(e)
+            if error is not None:
+                self.recorder.record('db', key, error=error)
+            raise
+        keys = []
+        rows = []
+        if result.returns_rows:
+            keys = list(result.keys())
+            rows = [tuple(r) for r in result.fetchall()]
+        self.recorder.record('db', key, {
+            'keys': keys, 'rows': redact(keys, rows),
+            'rowcount': result.rowcount})
+        return RecordedResult(keys, rows, result.rowcount)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def redact(keys, rows):
+    secret = [i for (i, k) in enumerate(keys) if k in REDACTED_COLUMNS]
+    if len(secret) == 0:
+        return rows
+    redacted = []
+    for row in rows:
+        row = list(row)
+        for i in secret:
+            row[i] = 'redacted'
+        redacted.append(row)
+    return redacted
+
+
+def get_settings(config):
+    return dict((k, v) for (k, v) in vars(config).iteritems()
+                if isinstance(v, (bool, int, long, float, basestring)))
+
+
+class Trace(object):
+    """
+    A trace read back from a file: the settings it was recorded with and,
+    for each cycle, the time it started and its events.
+    """
+    def __init__(self, path):
+        self.settings = {}
+        self.cycles = []
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'version' in entry:
+                    if entry['version'] != TRACE_VERSION:
+                        raise ValueError("Unsupported trace version %s." %
+                                         entry['version'])
+                    self.settings = entry['settings']
+                elif 'cycle' in entry:
+                    self.cycles.append((entry['clock'], []))
+                else:
+                    self.cycles[-1][1].append(entry)
+
+
+class Replayer(object):
+    """
+    Run a provisioner's cycles again from a trace, with no condor, EC2 or
+    database. Each call is answered with the response recorded for the
+    same call in the same cycle, in the order they were recorded, and the
+    clock runs from the time the cycle was recorded at. The cycles can be
+    profiled, and replaying with strict checks shows whether a change to
+    the provisioner still makes the calls it recorded.
+    """
+    def __init__(self, path, strict=False):
+        self.trace = Trace(path)
+        self.strict = strict
+        self.events = {}
+        # The calls made that were not recorded, and the recorded calls
+        # that were not made, in each cycle
+        self.missing = []
+        self.unused = []
+
+    def install(self):
+        """
+        Answer the provisioner's calls from the trace. The config is made
+        without connecting to the database, so this must be done before
+        anything else makes it.
+        """
+        config = ProvisionerConfig(connect=False)
+        for (name, value) in self.trace.settings.iteritems():
+            setattr(config, str(name), value)
+        config.metrics_enabled = False
+        config.memory_monitor = False
+        config.checkpoint = False
+        config.price_cache = False
+        config.dbconn = ReplayDatabase(self)
+
+        connection.factory = lambda access_key, secret_key, region=None: (
+            ReplayConnection(self, region))
+        connection.connections.clear()
+
+        condor_scheduler.popen = self.popen
+        ChangeListener().changed = lambda channel: self.play(
+            'notify', make_key(channel))
+
+    def run(self, profiler=None, cycles=None):
+        """
+        Replay the recorded cycles, or the first few of them. Returns the
+        number of calls that did not match in each cycle.
+        """
+        self.install()
+        prov = Provisioner(profiler)
+        if prov.shards is not None:
+            prov.shards = ReplayShards(self)
+        recorded = self.trace.cycles[:cycles]
+        real_time = time.time
+        try:
+            for (n, (clock, events)) in enumerate(recorded):
+                self.load(events)
+                start = real_time()
+                time.time = lambda: clock + (real_time() - start)
+                try:
+                    prov.run_cycle()
+                finally:
+                    time.time = real_time
+                self.unused.append(sum(len(q) for q in
+                                       self.events.itervalues()))
+                logger.info("Replayed cycle %s of %s.", n + 1,
+                            len(recorded))
+        finally:
+            time.time = real_time
+        return {'cycles': len(recorded), 'missing': self.missing,
+                'unused': self.unused}
+
+    def load(self, events):
+        self.events = {}
+        self.missing.append(0)
+        for event in events:
+            self.events.setdefault(
+                (event['channel'], event['key']),
+                collections.deque()).append(event)
+
+    def play(self, channel, key):
+        """
+        Answer a call with the next response recorded for it.
+        """
+        queue = self.events.get((channel, key))
+        if not queue:
+            self.missing[-1] += 1
+            if self.strict or channel != 'db':
+                raise TraceMismatch("No recorded %s call %s." %
+                                    (channel, key))
+            logger.warn("No recorded result for %s, replaying no rows.",
+                        key)
+            return {'keys': [], 'rows': [], 'rowcount': 0}
+        event = queue.popleft()
+        if 'error' in event:
+            raise_error(event['error'])
+        return decode(event['value'])
+
+    def popen(self, cmd, **kwargs):
+        result = self.play('command', make_key(cmd))
+        return RecordedProcess(result['output'], result['returncode'])
+
+
+class ReplayShards(object):
+    """
+    Hold the tenants a replica held when its cycles were recorded.
+    """
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def claim(self, tenants):
+        held = set(self.replayer.play(
+            'shards', make_key([t.db_id for t in tenants])))
+        return [t for t in tenants if t.db_id in held]
+
+    def close(self, leave=False):
+        pass
+
+
+class ReplayConnection(object):
+    """
+    An EC2 connection answered from a trace.
+    """
+    limiter = None
+    ResponseError = boto.exception.EC2ResponseError
+
+    def __init__(self, replayer, region=None):
+        self.replayer = replayer
+        self.region = region
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            result = self.replayer.play('ec2', ec2_key(name, args, kwargs,
+                                                       self.region))
+            if name == 'make_request':
+                return RecordedResponse(result['status'], result['reason'],
+                                        result['body'])
+            return result
+        return call
+
+
+class ReplayDatabase(object):
+    """
+    A database connection answered from a trace.
+    """
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def execute(self, statement, *args, **kwargs):
+        result = self.replayer.play('db', make_key(str(statement), args,
+                                                   kwargs))
+        return RecordedResult(result['keys'], result['rows'],
+                              result['rowcount'])
+
+    def close(self):
+        pass
@@ -1,2 +1,3 @@
 from ggprovisioner.scheduler.job import Job
+from ggprovisioner.scheduler.slot import Slot
 from ggprovisioner.scheduler import base_scheduler
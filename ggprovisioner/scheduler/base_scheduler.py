@@ -1,19 +1,23 @@
 import subprocess
+import bisect
 import datetime
 import calendar
 import boto
 import psycopg2
+import sqlalchemy
 
 from ggprovisioner import logger, ProvisionerConfig
 from ggprovisioner.cloud import aws
 from ggprovisioner.scheduler import Job
+from ggprovisioner.log import LazyRepr
 
 class BaseScheduler():
 
-    def load_jobs(self, tenants):
+    def load_jobs(self, tenants, migrate=True):
         """
         Read in the condor queue and manage the removal of jobs that should
-        not be processed.
+        not be processed. Finished workers are only handed to idle jobs if
+        migrate is set, so the queue can be looked at without changing it.
         """
         # Assess the global queue
         all_jobs = self.get_global_queue()
@@ -29,6 +33,14 @@ class BaseScheduler():
         # Stop resources being requested too frequently
         stop_over_requesting(tenants)
 
+        # Poll each pool's collector, hand any workers that have finished
+        # their jobs to idle jobs, and drop any jobs that will fit in to the
+        # unclaimed slots that are left
+        self.load_status(tenants)
+        if migrate:
+            aws.manager.migrate_instances(tenants)
+        subtract_free_capacity(tenants)
+
 
     def get_global_queue(self):
         """
@@ -40,9 +52,17 @@ class BaseScheduler():
     def get_status(self, pool):
         """
         Poll the collector of a pool to get the status, describing the
-        resources in the pool.
+        resources in the pool. Returns a list of Slots.
+        """
+        return []
+
+    def load_status(self, tenants):
+        """
+        Poll the collector of each tenant's pool and store the slots it
+        reports on the tenant.
         """
-        return ""
+        for tenant in tenants:
+            tenant.slots = self.get_status(tenant.public_ip)
 
 
     def process_global_queue(self, jobs, tenants):
@@ -63,52 +83,39 @@ def ignore_fulfilled_jobs(tenants):
     """
 
     for tenant in tenants:
+        if len(tenant.idle_jobs) == 0:
+            continue
+        jobs = dict((int(job.id), job) for job in tenant.idle_jobs)
         # Check to see if any entries have been made in the instance table
         # this indicates an instance has been fulfilled for a request.
-        # Restrict the query to only looking at requests for a specific job
-        for job in list(tenant.idle_jobs):
-            rows = ProvisionerConfig().dbconn.execute(
-                   ("select instance_request.job_runner_id, " +
-                    "instance_type.cpus from instance_request, " +
-                    "instance_type, instance where " +
-                    "instance_type.id = instance_request.instance_type " +
-                    "and instance.request_id = instance_request.id " +
-                    "and instance_request.job_runner_id = %s " +
-                    "and tenant = %s") % (job.id, tenant.db_id))
-            logger.debug(("select instance_request.job_runner_id, " +
-                    "instance_type.cpus from instance_request, " +
-                    "instance_type, instance where " +
-                    "instance_type.id = instance_request.instance_type " +
-                    "and instance.request_id = instance_request.id " +
-                    "and instance_request.job_runner_id = %s " +
-                    "and tenant = %s") % (job.id, tenant.db_id))
-
-            fulfilled_cpus = 0
-            # Iterate over the fulfilled instance requests for this job
-            for row in rows:
-                # Work out how many cpus this instance type has
-                fulfilled_cpus = fulfilled_cpus + int(row['cpus'])
-              
-            # If enough cpus have been acquired, flag the job as fulfilled
-            if fulfilled_cpus >= int(job.req_cpus):
-                job.fulfilled = True
-
+        # Several jobs packed onto one instance share its request, each
+        # with its share of the cpus, so look through job_request
+        query = ("select job_request.job_runner_id, " +
+                 "sum(job_request.cpus) as cpus, " +
+                 "bool_or(job_request.request_type = 'ondemand') " +
+                 "as ondemand from job_request, instance where " +
+                 "instance.request_id = job_request.request " +
+                 "and job_request.job_runner_id in (%s) " +
+                 "and job_request.tenant = %s " +
+                 "group by job_request.job_runner_id") % (
+                     ", ".join(str(job_id) for job_id in jobs),
+                     tenant.db_id)
+        logger.debug("%s", query)
+        rows = ProvisionerConfig().dbconn.execute(query)
+
+        for row in rows:
+            job = jobs[int(row['job_runner_id'])]
+            # If enough cpus have been acquired, flag the job as fulfilled.
             # Also remove any that have an ondemand instance fulfilled
-            rows = ProvisionerConfig().dbconn.execute(
-                   ("select instance_request.job_runner_id " +
-                    "from instance_request, instance where " +
-                    "instance.request_id = instance_request.id " +
-                    "and instance_request.job_runner_id = %s " +
-                    "and tenant = %s and instance_request.request_type = " +
-                    "'ondemand'") % (job.id, tenant.db_id))
-            for row in rows:
+            if row['ondemand'] or int(row['cpus']) >= int(job.req_cpus):
                 job.fulfilled = True
+
         # Remove any jobs that have been set as fulfilled from the idle
         # queue
         for job in list(tenant.idle_jobs):
             if job.fulfilled:
-                logger.debug("Removing job from idle jobs: %s" %
-                             repr(job))
+                logger.debug("Removing job from idle jobs: %s",
+                             LazyRepr(job))
                 tenant.idle_jobs.remove(job)
 
 def stop_over_requesting(tenants):
@@ -120,44 +127,115 @@ def stop_over_requesting(tenants):
     """
     for tenant in tenants:
         # Stop excess instances being requested in a five minute round
-        logger.debug("Tenant: %s. Request rate: %s" %
-                     (tenant.name, tenant.request_rate))
+        logger.debug("Tenant: %s. Request rate: %s",
+                     tenant.name, tenant.request_rate)
+        if len(tenant.idle_jobs) == 0:
+            continue
+        # Count the requests made for each job, including the requests
+        # shared by jobs packed onto one instance
+        counts = {}
+        try:
+            rows = ProvisionerConfig().dbconn.execute(
+                ("select job_runner_id, count(*) as total, " +
+                 "sum(case when request_time >= Now() - " +
+                 "'%s second'::interval then 1 else 0 end) as recent " +
+                 "from job_request where job_runner_id in (%s) and " +
+                 "tenant = %s group by job_runner_id;") %
+                (tenant.request_rate,
+                 ", ".join(str(job.id) for job in tenant.idle_jobs),
+                 tenant.db_id))
+            for row in rows:
+                counts[int(row['job_runner_id'])] = (row['total'],
+                                                     row['recent'])
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Error getting number of outstanding " +
+                             "requests.")
+
         for job in list(tenant.idle_jobs):
+            (count, recent) = counts.get(int(job.id), (0, 0))
             # check to see if we are requesting too frequently
-            count = 0
-            try:
-                rows = ProvisionerConfig().dbconn.execute(
-                    ("select count(*) from instance_request " +
-                     "where job_runner_id = %s and " +
-                     "request_time >= Now() - " +
-                     "'%s second'::interval and tenant = %s;") %
-                    (job.id, tenant.request_rate, tenant.db_id))
-                for row in rows:
-                    count = row['count']
-            except psycopg2.Error:
-                logger.exception("Error getting number of outstanding " +
-                                 "requests within time frame.")
-            logger.debug("Checking for valid outstanding requests. " +
-                         "Count of requests in db = %s" % count)
-            if count > 0:
+            logger.debug("Checking for valid outstanding requests. "
+                         "Count of requests in db = %s", recent)
+            if recent > 0:
                 tenant.idle_jobs.remove(job)
-                logger.debug("Removed job %s" % job.id)
+                logger.debug("Removed job %s", job.id)
                 continue
 
             # now check to see if we already have too many requests for
             # this job
-            try:
-                rows = ProvisionerConfig().dbconn.execute(
-                    ("select count(*) from instance_request " +
-                     "where job_runner_id = %s and tenant = %s;") %
-                    (job.id, tenant.db_id))
-                count = 0
-                for row in rows:
-                    count = row['count']
-                if count > ProvisionerConfig().max_requests:
-                    logger.warn("Too many outstanding requests, " +
-                                "removing idle job: %s" % repr(job))
-                    tenant.idle_jobs.remove(job)
-            except psycopg2.Error:
-                logger.exception("Error getting number of outstanding " +
-                                 "requests.")
+            if count > ProvisionerConfig().max_requests:
+                logger.warn("Too many outstanding requests, "
+                            "removing idle job: %s", LazyRepr(job))
+                tenant.idle_jobs.remove(job)
+
+
+def index_free_slots(slots):
+    """
+    Build an index of the unclaimed capacity in a pool. The index maps each
+    (cpus, memory) shape to the machines offering a slot of that shape.
+    """
+    index = {}
+    for slot in slots:
+        if slot.is_free() and int(slot.cpus) > 0:
+            index.setdefault((int(slot.cpus), int(slot.memory)),
+                             []).append(slot)
+    return index
+
+
+def find_free_shape(shapes, job):
+    """
+    Find the smallest shape in a sorted list of (cpus, memory) shapes that
+    can fit a job. Returns None if nothing fits.
+    """
+    req_cpus = int(job.req_cpus)
+    req_mem = int(job.req_mem)
+    # Skip straight to the shapes that have enough cpus
+    for pos in xrange(bisect.bisect_left(shapes, (req_cpus,)), len(shapes)):
+        if shapes[pos][1] >= req_mem:
+            return shapes[pos]
+    return None
+
+
+def subtract_free_capacity(tenants):
+    """
+    Remove idle jobs that can run on the unclaimed slots already in a
+    tenant's pool so instances are not launched for them. The machines
+    whose capacity is reserved this way are recorded on the tenant.
+    """
+    for tenant in tenants:
+        # Workers that have already been handed to a job are not free
+        index = index_free_slots(
+            [s for s in tenant.slots
+             if s.machine not in tenant.reserved_machines])
+        if len(index) == 0:
+            continue
+        shapes = sorted(index.keys())
+
+        # Place the largest jobs first so small jobs don't fragment the
+        # large slots
+        jobs = sorted(tenant.idle_jobs,
+                      key=lambda j: (int(j.req_cpus), int(j.req_mem)),
+                      reverse=True)
+        for job in jobs:
+            shape = find_free_shape(shapes, job)
+            if shape is None:
+                continue
+            slot = index[shape].pop()
+            if len(index[shape]) == 0:
+                del index[shape]
+                shapes.remove(shape)
+
+            # A partitionable slot keeps whatever is left over after the
+            # job has been carved out of it
+            if slot.is_partitionable():
+                remaining = (shape[0] - int(job.req_cpus),
+                             shape[1] - int(job.req_mem))
+                if remaining[0] > 0 and remaining[1] >= 0:
+                    if remaining not in index:
+                        bisect.insort(shapes, remaining)
+                    index.setdefault(remaining, []).append(slot)
+
+            logger.debug("Job %s fits in free slot %s, not provisioning.",
+                         job.id, slot.name)
+            tenant.idle_jobs.remove(job)
+            tenant.reserved_machines.add(slot.machine)
@@ -1,14 +1,21 @@
+import os
 import subprocess
 import datetime
 import calendar
 import boto
 import psycopg2
 import sys
+import logging
+import time
 
 from ggprovisioner import logger, ProvisionerConfig
 from ggprovisioner.cloud import aws
 from ggprovisioner.scheduler.base_scheduler import BaseScheduler
-from ggprovisioner.scheduler import Job
+from ggprovisioner.scheduler import Job, Slot
+from ggprovisioner.log import LazyRepr
+
+# Starts the condor commands. Recording and replaying cycles replaces this
+popen = subprocess.Popen
 
 
 class CondorScheduler(BaseScheduler):
@@ -29,7 +36,7 @@ class CondorScheduler(BaseScheduler):
                '-format', '%s\n', 'ExitStatus']
 
         #output = subprocess.check_output(cmd)
-        output = subprocess.Popen( cmd, stdout=subprocess.PIPE ).communicate()[0]
+        output = popen(cmd, stdout=subprocess.PIPE).communicate()[0]
         queue = output.split("\n")
         queue = filter(None, queue)
 
@@ -48,19 +55,13 @@ class CondorScheduler(BaseScheduler):
                     # requested memory, so check if it is a number
                     req_memory = 0
                     try:
-                        req_memory = int(split[5])
-                        if req_memory > 1024:
-                            # change it to use GB like instance types.
-                            req_memory = req_memory / 1024
+                        req_memory = convert_to_gb(int(split[5]))
                     except Exception, e:
                         pass
                     # Req disk is the same as memory. Again it is in mb I believe
                     req_disk = 0
                     try:
-                        req_disk = int(split[6])
-                        if req_disk > 1024:
-                            # change it to use GB like instance types.
-                            req_disk = req_disk / 1024
+                        req_disk = convert_to_gb(int(split[6]))
                     except Exception, e:
                         pass
                     # Decipher the description of the job as well (name, etc.)
@@ -77,9 +78,10 @@ class CondorScheduler(BaseScheduler):
                                      "the job queue.")
                     raise e
 
-        logger.debug("Found the following jobs:")
-        for job in jobs:
-            logger.debug(repr(job))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found the following jobs:")
+            for job in jobs:
+                logger.debug("%s", LazyRepr(job))
         return jobs
 
 
@@ -96,12 +98,68 @@ class CondorScheduler(BaseScheduler):
                 description[key] = True
         return description
 
+    def get_status(self, pool):
+        """
+        Poll the collector of a pool to get the status, describing the
+        resources in the pool.
+        """
+        return self.get_condor_status(pool)
+
     def get_condor_status(self, pool):
         """
         Poll the collector of a pool to get the condor_status, describing the
-        resources in the pool.
+        resources in the pool. The output is parsed as it streams from
+        condor_status so large pools are never held in memory as one string.
         """
-        return ""
+        cmd = ['condor_status', '-pool', pool,
+               '-format', '%s:', 'Name',
+               '-format', '%s:', 'Machine',
+               '-format', '%s:', 'State',
+               '-format', '%s:', 'Activity',
+               '-format', '%s:', 'SlotType',
+               '-format', '%s:', 'Cpus',
+               '-format', '%s:', 'Memory',
+               '-format', '%s\n', 'EnteredCurrentActivity']
+
+        slots = []
+        try:
+            # Errors are discarded, as a pipe that is never read could fill
+            # and block condor_status. Failures are found by its exit code.
+            with open(os.devnull, 'w') as null:
+                proc = popen(cmd, stdout=subprocess.PIPE, stderr=null)
+        except OSError:
+            logger.exception("Failed to run condor_status for pool %s." %
+                             pool)
+            return slots
+
+        for line in iter(proc.stdout.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            split = line.split(":")
+            if len(split) < 8:
+                logger.warn("Skipping malformed condor_status line: %s",
+                            line)
+                continue
+            try:
+                # Collectors report memory in MB, convert it so it can be
+                # compared with the requirements of a job. Unlike a job's
+                # request, a slot's memory is always in MB, however small
+                slots.append(Slot(split[0], split[1], split[2], split[3],
+                                  split[4], int(split[5]),
+                                  int(split[6]) / 1024.0,
+                                  int(split[7])))
+            except ValueError:
+                logger.warn("Skipping unparsable condor_status line: %s",
+                            line)
+        proc.stdout.close()
+        returncode = proc.wait()
+        if returncode != 0:
+            logger.error("condor_status for pool %s exited with %s, its "
+                         "slots may be missing.", pool, returncode)
+
+        logger.debug("Found %s slots in pool %s.", len(slots), pool)
+        return slots
 
 
     def process_global_queue(self, jobs, tenants):
@@ -112,7 +170,7 @@ class CondorScheduler(BaseScheduler):
         for tenant in tenants:
             # Get the necessary time a job must be idle as a timestamp for
             # each tenant
-            idle_time = (datetime.datetime.now() -
+            idle_time = (datetime.datetime.fromtimestamp(time.time()) -
                          datetime.timedelta(seconds=tenant.idle_time))
             idle_time = calendar.timegm(idle_time.timetuple())
 
@@ -132,3 +190,13 @@ class CondorScheduler(BaseScheduler):
                     #     logger.debug("TODO, remove this part -- adding all jobs " +
                     #                  "regardless of idle state.")
                     #     tenant.idle_jobs.append(job)
+
+
+def convert_to_gb(value):
+    """
+    Condor reports memory and disk in MB. Anything large enough is changed
+    to use GB like instance types.
+    """
+    if value > 1024:
+        value = value / 1024
+    return value
@@ -5,6 +5,11 @@ class Job(SimpleStringifiable):
     """
     A class to represent and maintain jobs.
     """
+    # A queue can hold a very large number of jobs, so keep them compact
+    __slots__ = ('tenant_address', 'id', 'status', 'req_time', 'req_cpus',
+                 'req_mem', 'fulfilled', 'launch', 'launch_options',
+                 'ondemand', 'tool', 'version')
+
     def __init__(self, tenant_addr, id_num, status, req_time=None,
                  req_cpu=None, req_mem=None, req_disk=None,
                  description=None, fulfilled=False):
@@ -16,6 +21,7 @@ class Job(SimpleStringifiable):
         self.req_mem = req_mem
         self.fulfilled = fulfilled
         self.launch = None
+        self.launch_options = None
 
         self.ondemand = False
         self.tool = None
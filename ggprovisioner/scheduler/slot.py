@@ -0,0 +1,32 @@
+from ggprovisioner import SimpleStringifiable
+
+
+class Slot(SimpleStringifiable):
+    """
+    A class to represent a slot advertised to the collector of a pool.
+    """
+    __slots__ = ('name', 'machine', 'state', 'activity', 'slot_type', 'cpus',
+                 'memory', 'entered_activity')
+
+    def __init__(self, name, machine, state, activity, slot_type, cpus,
+                 memory, entered_activity=None):
+        self.name = name
+        self.machine = machine
+        self.state = state
+        self.activity = activity
+        self.slot_type = slot_type
+        self.cpus = cpus
+        self.memory = memory
+        self.entered_activity = entered_activity
+
+    def is_free(self):
+        """
+        A slot is free if nothing has claimed it and it is sitting idle.
+        """
+        return self.state == "Unclaimed" and self.activity == "Idle"
+
+    def is_partitionable(self):
+        """
+        Partitionable slots can be carved up to run several jobs.
+        """
+        return self.slot_type == "Partitionable"
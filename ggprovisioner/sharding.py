@@ -0,0 +1,167 @@
+import hashlib
+import os
+import socket
+
+import psycopg2
+import psycopg2.extensions
+import sqlalchemy.exc
+
+from ggprovisioner import logger, metrics, ProvisionerConfig
+from ggprovisioner.cloud.aws.tracker import InstanceTracker
+
+# The first key of every tenant's advisory lock, so they can't clash with
+# advisory locks taken by anything else using the database
+LOCK_NAMESPACE = 47701
+
+
+class ShardCoordinator(object):
+    """
+    Split the tenants between several provisioner replicas. A replica
+    only processes the tenants it holds a Postgres advisory lock for, so
+    no tenant is ever processed by two replicas at once.
+    Each replica keeps a lease in the provisioner_replica table alive with
+    a heartbeat every cycle. The live replicas each take an equal share of
+    the tenants, preferring tenants by rendezvous hashing so the same
+    replica keeps the same tenants. A replica holding more than its share,
+    e.g. after another has joined, releases the extra tenants for the
+    others to take. The locks are held by the session, so a replica that
+    dies loses its tenants at once, and the others take them over when
+    its lease expires.
+    """
+    def __init__(self, replica_id=None, lease_timeout=180):
+        self.replica_id = replica_id or default_replica_id()
+        self.lease_timeout = lease_timeout
+        # db ids of the tenants this replica holds the lock of
+        self.held = set()
+        self.dbapi_conn = None
+        self.conn = None
+
+    def connect(self):
+        """
+        Open the connection the locks are held by. It is kept out of the
+        pool and in autocommit so the locks live as long as it does.
+        """
+        try:
+            self.dbapi_conn = ProvisionerConfig().engine.raw_connection()
+            self.conn = self.dbapi_conn.connection
+            self.conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        except (psycopg2.Error, sqlalchemy.exc.DBAPIError):
+            logger.exception("Failed to connect to coordinate replicas.")
+            self.close()
+            return False
+        logger.info("Coordinating tenants as replica %s.", self.replica_id)
+        return True
+
+    def execute(self, statement, params=None):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(statement, params)
+            if cursor.description is not None:
+                return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def heartbeat(self):
+        """
+        Renew this replica's lease, and count the replicas whose leases
+        are still live.
+        """
+        self.execute(
+            "insert into provisioner_replica (replica_id, heartbeat) " +
+            "values (%s, now()) on conflict (replica_id) do update set " +
+            "heartbeat = now()", (self.replica_id,))
+        self.execute(
+            "delete from provisioner_replica where heartbeat < now() - " +
+            "%s * interval '1 second'", (self.lease_timeout,))
+        return self.execute("select count(*) from provisioner_replica")[0][0]
+
+    def claim(self, tenants):
+        """
+        Get the tenants this replica should process this cycle, taking or
+        releasing locks to even out the tenants between the replicas.
+        If the replicas can't be coordinated no tenants are processed, as
+        another replica may hold them.
+        """
+        if self.conn is None and not self.connect():
+            return []
+        try:
+            replicas = max(self.heartbeat(), 1)
+            share = -(-len(tenants) // replicas)
+            ranked = sorted(tenants, key=lambda t: self.preference(t.db_id),
+                            reverse=True)
+
+            # Let go of tenants that have gone and, least preferred first,
+            # of any beyond this replica's share
+            current = set(t.db_id for t in tenants)
+            for db_id in list(self.held - current):
+                self.release(db_id)
+            held = [t for t in ranked if t.db_id in self.held]
+            for t in reversed(held[share:]):
+                self.release(t.db_id)
+
+            for t in ranked:
+                if len(self.held) >= share:
+                    break
+                if t.db_id not in self.held:
+                    self.acquire(t.db_id)
+        except psycopg2.Error:
+            logger.exception("Lost the connection coordinating replicas.")
+            self.close()
+            return []
+
+        metrics.REPLICAS.set(replicas)
+        metrics.HELD_TENANTS.set(len(self.held))
+        logger.debug("Processing %s of %s tenants as one of %s replicas.",
+                     len(self.held), len(tenants), replicas)
+        return [t for t in tenants if t.db_id in self.held]
+
+    def preference(self, db_id):
+        """
+        How much this replica wants a tenant. Every replica ranks the
+        tenants differently, so they rarely compete for the same ones.
+        """
+        return hashlib.md5("%s:%s" % (self.replica_id, db_id)).hexdigest()
+
+    def acquire(self, db_id):
+        locked = self.execute("select pg_try_advisory_lock(%s, %s)",
+                              (LOCK_NAMESPACE, db_id))[0][0]
+        if locked:
+            # Anything remembered from the last time this replica held the
+            # tenant is stale, as another replica may have processed it
+            InstanceTracker().forget(db_id)
+            self.held.add(db_id)
+            logger.info("Took over tenant %s.", db_id)
+        return locked
+
+    def release(self, db_id):
+        self.execute("select pg_advisory_unlock(%s, %s)",
+                     (LOCK_NAMESPACE, db_id))
+        self.held.discard(db_id)
+        logger.info("Released tenant %s.", db_id)
+
+    def close(self, leave=False):
+        """
+        Close the connection, which releases every lock. If the replica is
+        leaving, its lease is removed first so the others take over its
+        tenants straight away.
+        """
+        if self.conn is not None and leave:
+            try:
+                self.execute("delete from provisioner_replica where " +
+                             "replica_id = %s", (self.replica_id,))
+            except psycopg2.Error:
+                logger.exception("Failed to remove the lease of replica %s."
+                                 % self.replica_id)
+        if self.dbapi_conn is not None:
+            try:
+                self.dbapi_conn.invalidate()
+            except psycopg2.Error:
+                pass
+        self.dbapi_conn = None
+        self.conn = None
+        self.held = set()
+
+
+def default_replica_id():
+    return '%s-%s' % (socket.gethostname(), os.getpid())
@@ -21,11 +21,25 @@ class SimpleStringifiable(object):
         val1: hello world
         val2: goodnight moon
     """
+    # No __dict__ of its own, so subclasses may use __slots__
+    __slots__ = ()
+
+    def _attributes(self):
+        """
+        The attributes of an object sorted by name, whether they are held in
+        its __dict__ or its __slots__
+        """
+        attrs = dict(getattr(self, '__dict__', ()))
+        for name in slot_names(self.__class__):
+            if hasattr(self, name):
+                attrs[name] = getattr(self, name)
+        return sorted(attrs.iteritems())
+
     def __repr__(self):
         """
         repr of a SimpleStringifiable looks like a constructor invocation
         """
-        key_sorted_dict = sorted(self.__dict__.iteritems())
+        key_sorted_dict = self._attributes()
         strified_dict = ','.join(
             "{0}={1}".format(k, repr(v))
             for (k,v) in key_sorted_dict)
@@ -37,9 +51,26 @@ class SimpleStringifiable(object):
         indented format as a multiline string
         """
         output = "{0}:".format(self.__class__.__name__)
-        key_sorted_dict = sorted(self.__dict__.iteritems())
+        key_sorted_dict = self._attributes()
         for (k,v) in key_sorted_dict:
             output = "{0}\n    {1}: {2}".format(
                 output, k, repr(v))
 
         return output
+
+
+# The slot names of each class, so the class hierarchy is only walked once
+_slot_names = {}
+
+
+def slot_names(cls):
+    if cls not in _slot_names:
+        names = []
+        for klass in cls.__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, basestring):
+                slots = (slots,)
+            names.extend(name for name in slots
+                         if name not in ('__dict__', '__weakref__'))
+        _slot_names[cls] = tuple(names)
+    return _slot_names[cls]
@@ -0,0 +1,5 @@
+from ggprovisioner.simulation.cloud import FakeCloud, FakeEC2Connection
+from ggprovisioner.simulation.scheduler import (SimulatedPool,
+                                                SyntheticScheduler)
+from ggprovisioner.simulation.database import (CountingConnection,
+                                               TemporaryDatabase)
@@ -0,0 +1,246 @@
+import itertools
+import time
+
+from ggprovisioner import SimpleStringifiable
+
+
+class FakeSpotRequest(SimpleStringifiable):
+    """
+    A spot instance request made to the fake cloud.
+    """
+    def __init__(self, request_id, instance_type, subnet_id, price, made):
+        self.id = request_id
+        self.instance_type = instance_type
+        self.subnet_id = subnet_id
+        self.price = price
+        self.state = 'open'
+        self.instance_id = None
+        self.tags = {}
+        # The cycle the request was made in
+        self.made = made
+
+
+class FakeInstance(SimpleStringifiable):
+    """
+    An instance in the fake cloud, with the attributes of a boto instance
+    that the provisioner reads.
+    """
+    def __init__(self, instance_id, instance_type, subnet_id, started,
+                 spot_request_id=None):
+        self.id = instance_id
+        self.instance_type = instance_type
+        self.subnet_id = subnet_id
+        self.spot_instance_request_id = spot_request_id
+        self.state = 'pending'
+        self.tags = {}
+        self.private_dns_name = 'ip-%s.ec2.internal' % instance_id[2:]
+        self.public_dns_name = 'ec2-%s.compute.amazonaws.com' % (
+            instance_id[2:])
+        self.launch_time = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                         time.gmtime())
+        # The cycle the instance last changed state in
+        self.changed = started
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class ResultSet(list):
+    """
+    A page of results, as boto returns them.
+    """
+    next_token = None
+
+
+class FakePrice(object):
+    def __init__(self, zone, price):
+        self.availability_zone = zone
+        self.price = price
+
+
+class FakeCloud(object):
+    """
+    An in-process stand-in for EC2, shared by every tenant's connection.
+    Spot requests are fulfilled after a number of cycles and instances take
+    a number of cycles to boot, as the cloud is advanced once per cycle.
+    Every call is counted by action.
+    """
+    def __init__(self, instance_types, zones, fulfil_cycles=1,
+                 boot_cycles=1, spot_discount=0.3):
+        # instance type -> (cpus, memory, ondemand price)
+        self.instance_types = instance_types
+        self.zones = zones
+        self.fulfil_cycles = fulfil_cycles
+        self.boot_cycles = boot_cycles
+        self.spot_discount = spot_discount
+        self.cycle = 0
+        self.requests = {}
+        self.instances = {}
+        self.calls = {}
+        self.ids = itertools.count(1)
+
+    def connect(self, access_key, secret_key, region=None):
+        return FakeEC2Connection(self)
+
+    def count(self, action):
+        self.calls[action] = self.calls.get(action, 0) + 1
+
+    def total_calls(self):
+        return sum(self.calls.itervalues())
+
+    def new_id(self, prefix):
+        return '%s-%08x' % (prefix, next(self.ids))
+
+    def spot_price(self, instance_type, zone):
+        """
+        A fixed spot price for each type and zone, a little higher in each
+        zone after the first so the zones are not all equal.
+        """
+        ondemand = self.instance_types[instance_type][2]
+        return round(ondemand * (self.spot_discount +
+                                 0.01 * self.zones.index(zone)), 4)
+
+    def launch(self, instance_type, subnet_id, spot_request_id=None):
+        inst = FakeInstance(self.new_id('i'), instance_type, subnet_id,
+                            self.cycle, spot_request_id)
+        self.instances[inst.id] = inst
+        return inst
+
+    def advance(self):
+        """
+        Move the cloud on a cycle: fulfil open spot requests that are old
+        enough, finish booting instances and forget instances that were
+        terminated a cycle ago.
+        """
+        self.cycle += 1
+        for req in self.requests.values():
+            if (req.state == 'open' and
+                    self.cycle - req.made >= self.fulfil_cycles):
+                req.state = 'active'
+                req.instance_id = self.launch(req.instance_type,
+                                              req.subnet_id, req.id).id
+        for inst in self.instances.values():
+            if inst.state == 'pending':
+                if self.cycle - inst.changed >= self.boot_cycles:
+                    inst.state = 'running'
+                    inst.changed = self.cycle
+            elif inst.state == 'shutting-down':
+                inst.state = 'terminated'
+                inst.changed = self.cycle
+            elif (inst.state == 'terminated' and
+                    self.cycle - inst.changed > 1):
+                del self.instances[inst.id]
+
+    def running_instances(self, subnets):
+        """
+        The running instances in a set of subnets.
+        """
+        return [i for i in self.instances.itervalues()
+                if i.state == 'running' and i.subnet_id in subnets]
+
+
+def matches(resource, filters):
+    """
+    Check a request or instance against EC2 style filters.
+    """
+    for (name, wanted) in (filters or {}).iteritems():
+        if not isinstance(wanted, (list, tuple, set)):
+            wanted = [wanted]
+        if name.startswith('tag:'):
+            value = resource.tags.get(name[4:])
+        elif name == 'tag-value':
+            if not any(v in wanted for v in resource.tags.itervalues()):
+                return False
+            continue
+        elif name in ('state', 'instance-state-name'):
+            value = resource.state
+        elif name == 'subnet-id':
+            value = resource.subnet_id
+        else:
+            raise ValueError("Unsupported filter %s" % name)
+        if value not in wanted:
+            return False
+    return True
+
+
+class FakeEC2Connection(object):
+    """
+    A connection to the fake cloud, with the boto calls the provisioner
+    makes. Fleets are not simulated.
+    """
+    limiter = None
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_spot_price_history(self, instance_type=None, **kwargs):
+        self.cloud.count('DescribeSpotPriceHistory')
+        return [FakePrice(zone, self.cloud.spot_price(instance_type, zone))
+                for zone in self.cloud.zones]
+
+    def request_spot_instances(self, price, image_id, count=1,
+                               instance_type=None, subnet_id=None, **kwargs):
+        self.cloud.count('RequestSpotInstances')
+        reqs = []
+        for x in range(count):
+            req = FakeSpotRequest(self.cloud.new_id('sir'), instance_type,
+                                  subnet_id, price, self.cloud.cycle)
+            self.cloud.requests[req.id] = req
+            reqs.append(req)
+        return reqs
+
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      instance_type=None, subnet_id=None, **kwargs):
+        self.cloud.count('RunInstances')
+        return FakeReservation([self.cloud.launch(instance_type, subnet_id)
+                                for x in range(max_count)])
+
+    def create_tags(self, resource_ids, tags):
+        self.cloud.count('CreateTags')
+        for resource_id in resource_ids:
+            resource = (self.cloud.requests.get(resource_id) or
+                        self.cloud.instances.get(resource_id))
+            if resource is not None:
+                resource.tags.update(tags)
+
+    def get_all_spot_instance_requests(self, request_ids=None, filters=None):
+        self.cloud.count('DescribeSpotInstanceRequests')
+        return ResultSet(r for r in self.cloud.requests.itervalues()
+                         if matches(r, filters) and
+                         (request_ids is None or r.id in request_ids))
+
+    def cancel_spot_instance_requests(self, request_ids):
+        self.cloud.count('CancelSpotInstanceRequests')
+        for request_id in request_ids:
+            req = self.cloud.requests.get(request_id)
+            if req is not None and req.state == 'open':
+                req.state = 'cancelled'
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             max_results=None, next_token=None):
+        self.cloud.count('DescribeInstances')
+        found = sorted((i for i in self.cloud.instances.itervalues()
+                        if matches(i, filters) and
+                        (instance_ids is None or i.id in instance_ids)),
+                       key=lambda i: i.id)
+        start = int(next_token or 0)
+        end = len(found)
+        if max_results is not None:
+            end = min(end, start + max_results)
+        page = ResultSet([FakeReservation(found[start:end])])
+        if end < len(found):
+            page.next_token = str(end)
+        return page
+
+    def get_all_instances(self, instance_ids=None, filters=None, **kwargs):
+        return self.get_all_reservations(instance_ids, filters)
+
+    def terminate_instances(self, instance_ids=None):
+        self.cloud.count('TerminateInstances')
+        for instance_id in instance_ids or []:
+            inst = self.cloud.instances.get(instance_id)
+            if inst is not None and inst.state != 'terminated':
+                inst.state = 'shutting-down'
+                inst.changed = self.cloud.cycle
@@ -0,0 +1,194 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+import psycopg2
+import psycopg2.extensions
+
+from ggprovisioner import logger
+
+
+class CountingConnection(object):
+    """
+    Wrap a database connection to count the statements executed through it
+    and the time spent waiting on them. Everything else is passed through.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.queries = 0
+        self.seconds = 0.0
+
+    def execute(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.conn.execute(*args, **kwargs)
+        finally:
+            self.queries += 1
+            self.seconds += time.time() - start
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class TemporaryDatabase(object):
+    """
+    A throwaway Postgres database with the provisioner's schema loaded.
+    The database is made on an existing server if one is given as a dict
+    of user, password, host and port. Otherwise a private server is started
+    with initdb in a temporary directory, listening on localhost only, and
+    is removed again when the database is stopped.
+    """
+    def __init__(self, schema='db-create.sql', server=None):
+        self.schema = schema
+        self.server = server
+        self.name = 'ggprovisioner_sim_%s' % os.getpid()
+        self.directory = None
+
+    def settings(self):
+        """
+        The Database settings to give the provisioner.
+        """
+        settings = dict(self.server)
+        settings['database'] = self.name
+        return settings
+
+    def start(self):
+        if self.server is None:
+            self.start_server()
+        conn = self.connect('postgres')
+        try:
+            conn.cursor().execute('create database %s' % self.name)
+        finally:
+            conn.close()
+        conn = self.connect(self.name)
+        try:
+            cursor = conn.cursor()
+            for statement in open(self.schema).read().split(';\n'):
+                if len(statement.strip()) > 0:
+                    cursor.execute(statement)
+        finally:
+            conn.close()
+        logger.info("Created database %s.", self.name)
+
+    def stop(self):
+        try:
+            conn = self.connect('postgres')
+            try:
+                conn.cursor().execute('drop database if exists %s' %
+                                      self.name)
+            finally:
+                conn.close()
+        except psycopg2.Error:
+            logger.exception("Failed to drop database %s." % self.name)
+        if self.directory is not None:
+            subprocess.call([self.binary('pg_ctl'), '-D',
+                             os.path.join(self.directory, 'data'),
+                             '-m', 'immediate', '-w', 'stop'],
+                            stdout=open(os.devnull, 'w'))
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def connect(self, database):
+        conn = psycopg2.connect(user=self.server['user'],
+                                password=self.server['password'],
+                                host=self.server['host'],
+                                port=self.server['port'], database=database)
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def execute(self, statement):
+        conn = self.connect(self.name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(statement)
+            if cursor.description is not None:
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def binary(self, name):
+        """
+        Find a Postgres server program, on the path or where pg_config says
+        they are installed.
+        """
+        path = find_executable(name)
+        if path is None and find_executable('pg_config') is not None:
+            bindir = subprocess.Popen(['pg_config', '--bindir'],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            path = find_executable(name, bindir.strip())
+        if path is None:
+            raise RuntimeError("Could not find %s. Install the Postgres "
+                               "server or give an existing server to use."
+                               % name)
+        return path
+
+    def start_server(self):
+        """
+        Start a private Postgres server with durability turned off, as its
+        data is thrown away.
+        """
+        self.directory = tempfile.mkdtemp(prefix='ggprovisioner-sim-')
+        data = os.path.join(self.directory, 'data')
+        port = free_port()
+        devnull = open(os.devnull, 'w')
+        subprocess.check_call([self.binary('initdb'), '-D', data, '-U',
+                               'simulation', '-A', 'trust', '-N'],
+                              stdout=devnull)
+        subprocess.check_call(
+            [self.binary('pg_ctl'), '-D', data, '-w', '-l',
+             os.path.join(self.directory, 'postgres.log'), '-o',
+             "-p %s -k %s -c listen_addresses=127.0.0.1 -c fsync=off "
+             "-c synchronous_commit=off -c full_page_writes=off" %
+             (port, self.directory), 'start'], stdout=devnull)
+        self.server = {'user': 'simulation', 'password': '',
+                       'host': '127.0.0.1', 'port': port}
+
+    def seed(self, tenants, instance_types):
+        """
+        Add the simulated tenants and instance types. Each tenant is a dict
+        with the columns of its tenant row, its subnets by zone and its
+        max_bid_price and bid_percent.
+        """
+        for (name, (cpus, memory, price)) in sorted(
+                instance_types.iteritems()):
+            self.execute(
+                ("insert into instance_type (type, ondemand_price, cpus, " +
+                 "memory, disk, ami) values ('%s', %s, %s, %s, 100, " +
+                 "'ami-simulated')") % (name, price, cpus, memory))
+        for t in tenants:
+            creds = self.execute(
+                ("insert into aws_credentials (access_key_id, secret_key, " +
+                 "key_pair) values ('%s', 'secret', 'simulated') " +
+                 "returning id") % t['access_key'])[0][0]
+            tenant_id = self.execute(
+                ("insert into tenant (name, public_address, condor_address, " +
+                 "public_ip, zone, vpc, security_group, domain, " +
+                 "credentials) values ('%s', '%s', '%s', '%s', '%s', " +
+                 "'vpc-simulated', 'sg-simulated', 'simulated', %s) " +
+                 "returning id") %
+                (t['name'], t['public_address'], t['condor_address'],
+                 t['public_ip'], t['zone'], creds))[0][0]
+            for (zone, subnet) in sorted(t['subnets'].iteritems()):
+                self.execute(
+                    ("insert into subnet_mapping (tenant, zone, subnet) " +
+                     "values (%s, '%s', '%s')") % (tenant_id, zone, subnet))
+            self.execute(
+                ("insert into tenant_settings (tenant, max_bid_price, " +
+                 "bid_percent) values (%s, %s, %s)") %
+                (tenant_id, t['max_bid_price'], t['bid_percent']))
+
+
+def free_port():
+    """
+    Find a port nothing is listening on.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
@@ -0,0 +1,248 @@
+import argparse
+import ConfigParser
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from ggprovisioner import logger, log, Provisioner, ProvisionerConfig
+from ggprovisioner.cloud.aws import connection
+from ggprovisioner.simulation.cloud import FakeCloud
+from ggprovisioner.simulation.database import (CountingConnection,
+                                               TemporaryDatabase)
+from ggprovisioner.simulation.scheduler import (SimulatedPool,
+                                                SyntheticScheduler)
+
+# instance type -> (cpus, memory in GB, ondemand price)
+INSTANCE_TYPES = {
+    'm4.large': (2, 8, 0.1),
+    'm4.xlarge': (4, 16, 0.2),
+    'm4.2xlarge': (8, 32, 0.4),
+    'm4.4xlarge': (16, 64, 0.8),
+    'c4.xlarge': (4, 7, 0.199),
+    'r4.xlarge': (4, 30, 0.266)}
+
+ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c']
+
+
+class PhaseRecorder(object):
+    """
+    Stands in for the profiler of a Provisioner, recording the time, the
+    database round trips and the EC2 calls of each phase of each cycle.
+    """
+    active = False
+
+    def __init__(self, dbconn, cloud):
+        self.dbconn = dbconn
+        self.cloud = cloud
+        self.cycles = []
+
+    def new_cycle(self):
+        self.cycles.append({})
+
+    @contextlib.contextmanager
+    def profile(self, phase):
+        queries = self.dbconn.queries
+        db_seconds = self.dbconn.seconds
+        calls = self.cloud.total_calls()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.cycles[-1][phase] = {
+                'seconds': time.time() - start,
+                'queries': self.dbconn.queries - queries,
+                'db_seconds': self.dbconn.seconds - db_seconds,
+                'api_calls': self.cloud.total_calls() - calls}
+
+    def summary(self):
+        """
+        The mean and worst of each measurement of each phase over the
+        cycles.
+        """
+        phases = {}
+        for cycle in self.cycles:
+            for (phase, measured) in cycle.iteritems():
+                for (name, value) in measured.iteritems():
+                    phases.setdefault(phase, {}).setdefault(
+                        name, []).append(value)
+        return dict(
+            (phase, dict((name, {'mean': sum(values) / len(values),
+                                 'max': max(values)})
+                         for (name, values) in measured.iteritems()))
+            for (phase, measured) in phases.iteritems())
+
+
+def make_tenants(count):
+    """
+    Make the tenants to simulate, each with a subnet in every zone.
+    """
+    tenants = []
+    for n in range(1, count + 1):
+        name = 'sim%s' % n
+        tenants.append({
+            'name': name,
+            'public_address': '%s.simulated' % name,
+            'condor_address': '%s.simulated' % name,
+            'public_ip': '10.%s.%s.1' % (n / 256, n % 256),
+            'zone': ZONES[0],
+            'subnets': dict((zone, 'subnet-%s-%s' % (name, zone[-1]))
+                            for zone in ZONES),
+            'access_key': 'AKIASIMULATED%s' % n,
+            'max_bid_price': 1.0,
+            'bid_percent': 80})
+    return tenants
+
+
+def write_config(base, database, directory):
+    """
+    Write a config file using a database and with the metrics server off,
+    keeping every other setting from a base config file.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(base)
+    for (key, value) in database.iteritems():
+        config.set('Database', key, str(value))
+    config.set('Metrics', 'enabled', 'false')
+    path = os.path.join(directory, 'provisioner.ini')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def run_simulation(jobs, tenants, cycles, arrivals=0, runtime_cycles=3,
+                   fulfil_cycles=1, boot_cycles=1, server=None,
+                   schema='db-create.sql',
+                   base_config='ggprovisioner/provisioner.ini',
+                   cloudinit_file='cloudinit.cfg'):
+    """
+    Run full provisioning cycles against a synthetic queue of a number of
+    jobs per tenant, a fake cloud and a throwaway database. Returns a
+    report of the cost of each phase.
+    As the provisioner's caches are singletons, run one simulation per
+    process.
+    """
+    specs = make_tenants(tenants)
+    database = TemporaryDatabase(schema, server)
+    directory = tempfile.mkdtemp(prefix='ggprovisioner-sim-config-')
+    database.start()
+    try:
+        database.seed(specs, INSTANCE_TYPES)
+        config = ProvisionerConfig(
+            config_file=write_config(base_config, database.settings(),
+                                     directory),
+            cloudinit_file=cloudinit_file)
+        config.dbconn = CountingConnection(config.dbconn)
+
+        cloud = FakeCloud(INSTANCE_TYPES, ZONES, fulfil_cycles,
+                          boot_cycles)
+        connection.factory = cloud.connect
+        pools = [SimulatedPool(s['condor_address'], s['public_ip'],
+                               s['subnets'].values()) for s in specs]
+        sched = SyntheticScheduler(cloud, pools, jobs, arrivals,
+                                   runtime_cycles)
+        recorder = PhaseRecorder(config.dbconn, cloud)
+        prov = Provisioner(recorder, sched)
+
+        start = time.time()
+        for cycle in range(cycles):
+            cloud.advance()
+            sched.advance()
+            recorder.new_cycle()
+            prov.run_cycle()
+            logger.info("Simulated cycle %s of %s.", cycle + 1, cycles)
+
+        return {
+            'jobs_per_tenant': jobs,
+            'tenants': tenants,
+            'cycles': cycles,
+            'seconds': time.time() - start,
+            'phases': recorder.summary(),
+            'per_cycle': recorder.cycles,
+            'api_calls': cloud.calls,
+            'instances': len(cloud.instances),
+            'spot_requests': len(cloud.requests)}
+    finally:
+        database.stop()
+        connection.factory = connection.connect
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def parse_server(value):
+    """
+    Read a server given as user[:password]@host:port.
+    """
+    (credentials, address) = value.rsplit('@', 1)
+    (user, password) = (credentials.split(':', 1) + [''])[:2]
+    (host, port) = address.rsplit(':', 1)
+    return {'user': user, 'password': password, 'host': host,
+            'port': int(port)}
+
+
+def format_report(report):
+    lines = ["%s jobs x %s tenants, %s cycles in %.2fs" %
+             (report['jobs_per_tenant'], report['tenants'],
+              report['cycles'], report['seconds']),
+             "%-24s %10s %10s %10s %10s" % ('phase', 'mean s', 'max s',
+                                           'queries', 'api calls')]
+    for (phase, measured) in sorted(report['phases'].iteritems()):
+        lines.append("%-24s %10.3f %10.3f %10.1f %10.1f" %
+                     (phase, measured['seconds']['mean'],
+                      measured['seconds']['max'],
+                      measured['queries']['mean'],
+                      measured['api_calls']['mean']))
+    lines.append("api calls: %s" % ", ".join(
+        "%s=%s" % c for c in sorted(report['api_calls'].iteritems())))
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate provisioning cycles offline against a '
+        'synthetic queue, a fake EC2 and a throwaway Postgres database.')
+    parser.add_argument('--jobs', type=int, default=1000,
+                        help='jobs queued for each tenant at the start')
+    parser.add_argument('--tenants', type=int, default=1)
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--arrivals', type=int, default=0,
+                        help='jobs submitted to each tenant every cycle')
+    parser.add_argument('--runtime-cycles', type=int, default=3,
+                        help='cycles a job runs for once it starts')
+    parser.add_argument('--fulfil-cycles', type=int, default=1,
+                        help='cycles before a spot request is fulfilled')
+    parser.add_argument('--boot-cycles', type=int, default=1,
+                        help='cycles an instance takes to boot')
+    parser.add_argument('--server', type=parse_server, default=None,
+                        help='make the database on an existing server, '
+                        'given as user[:password]@host:port, rather than '
+                        'starting one')
+    parser.add_argument('--schema', default='db-create.sql')
+    parser.add_argument('--config', default='ggprovisioner/provisioner.ini',
+                        help='the config to take the other settings from')
+    parser.add_argument('--json', default=None,
+                        help='write the full report to this file')
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log.setup_logging(logger, getattr(logging, args.log_level),
+                      filename=None)
+    report = run_simulation(args.jobs, args.tenants, args.cycles,
+                            args.arrivals, args.runtime_cycles,
+                            args.fulfil_cycles, args.boot_cycles,
+                            args.server, args.schema, args.config)
+    print format_report(report)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
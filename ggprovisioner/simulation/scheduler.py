@@ -0,0 +1,155 @@
+import random
+import time
+
+from ggprovisioner.scheduler import Job, Slot
+from ggprovisioner.scheduler.condor.condor_scheduler import CondorScheduler
+
+# (cpus, memory in GB, weight) of the jobs generated by default
+DEFAULT_SHAPES = [(1, 2, 6), (2, 4, 3), (4, 8, 2), (8, 16, 1)]
+
+
+class SimulatedPool(object):
+    """
+    The queue and machines of one tenant's simulated condor pool.
+    """
+    def __init__(self, condor_address, public_ip, subnets):
+        self.condor_address = condor_address
+        self.public_ip = public_ip
+        self.subnets = set(subnets)
+        # job id -> [cpus, memory, submitted, machine, finish cycle]
+        self.jobs = {}
+        # machine -> [cpus, memory, free cpus, free memory, idle since]
+        self.machines = {}
+        self.next_id = 1
+
+
+class SyntheticScheduler(CondorScheduler):
+    """
+    A scheduler that generates a stream of jobs for each pool rather than
+    reading condor_q. Idle jobs are matched to the running instances of
+    the fake cloud each cycle, run for a number of cycles and then leave
+    the queue. Tenants are matched to their jobs as they are for condor.
+    """
+    def __init__(self, cloud, pools, initial_jobs, arrivals=0,
+                 runtime_cycles=3, shapes=DEFAULT_SHAPES, seed=1):
+        self.cloud = cloud
+        self.pools = dict((p.public_ip, p) for p in pools)
+        self.arrivals = arrivals
+        self.runtime_cycles = runtime_cycles
+        self.shapes = shapes
+        self.random = random.Random(seed)
+        self.cycle = 0
+        for pool in pools:
+            self.submit(pool, initial_jobs)
+
+    def submit(self, pool, count):
+        """
+        Add jobs to a pool's queue. They are made old enough to be
+        provisioned for straight away.
+        """
+        submitted = int(time.time()) - 60
+        total = sum(s[2] for s in self.shapes)
+        for x in xrange(count):
+            pick = self.random.uniform(0, total)
+            for (cpus, memory, weight) in self.shapes:
+                pick -= weight
+                if pick <= 0:
+                    break
+            pool.jobs[pool.next_id] = [cpus, memory, submitted, None, None]
+            pool.next_id += 1
+
+    def advance(self):
+        """
+        Move the pools on a cycle: finish jobs that have run long enough,
+        submit new jobs, and match idle jobs to free machines.
+        """
+        self.cycle += 1
+        now = int(time.time())
+        for pool in self.pools.itervalues():
+            self.sync_machines(pool, now)
+            for (job_id, job) in pool.jobs.items():
+                if job[4] is not None and job[4] <= self.cycle:
+                    self.release(pool, job, now)
+                    del pool.jobs[job_id]
+            self.submit(pool, self.arrivals)
+            self.negotiate(pool, now)
+
+    def sync_machines(self, pool, now):
+        """
+        Add the pool's newly running instances as machines, and put the jobs
+        of machines that have gone back in the queue.
+        """
+        running = {}
+        for inst in self.cloud.running_instances(pool.subnets):
+            (cpus, memory, price) = self.cloud.instance_types[
+                inst.instance_type]
+            running[inst.private_dns_name] = (cpus, memory)
+        for machine in pool.machines.keys():
+            if machine not in running:
+                del pool.machines[machine]
+        for (machine, (cpus, memory)) in running.iteritems():
+            if machine not in pool.machines:
+                pool.machines[machine] = [cpus, memory, cpus, memory, now]
+        for job in pool.jobs.itervalues():
+            if job[3] is not None and job[3] not in pool.machines:
+                job[3] = None
+                job[4] = None
+
+    def release(self, pool, job, now):
+        machine = pool.machines.get(job[3])
+        if machine is None:
+            return
+        machine[2] += job[0]
+        machine[3] += job[1]
+        if machine[2] == machine[0]:
+            machine[4] = now
+
+    def negotiate(self, pool, now):
+        """
+        Start idle jobs, oldest first, on the first machine they fit on.
+        """
+        free = [m for m in pool.machines.iteritems() if m[1][2] > 0]
+        if len(free) == 0:
+            return
+        for job_id in sorted(pool.jobs):
+            job = pool.jobs[job_id]
+            if job[3] is not None:
+                continue
+            for (name, machine) in free:
+                if machine[2] >= job[0] and machine[3] >= job[1]:
+                    machine[2] -= job[0]
+                    machine[3] -= job[1]
+                    job[3] = name
+                    job[4] = self.cycle + self.runtime_cycles
+                    break
+
+    def get_global_queue(self):
+        """
+        Make a Job for every job in every pool's queue.
+        """
+        jobs = []
+        for pool in self.pools.itervalues():
+            for (job_id, job) in pool.jobs.iteritems():
+                status = '1' if job[3] is None else '2'
+                jobs.append(Job(pool.condor_address, str(job_id), status,
+                                str(job[2]), job[0], job[1]))
+        return jobs
+
+    def get_status(self, pool_ip):
+        """
+        Report a partitionable slot per machine with its unclaimed
+        capacity, and a busy slot for the capacity in use.
+        """
+        pool = self.pools.get(pool_ip)
+        if pool is None:
+            return []
+        slots = []
+        for (name, m) in pool.machines.iteritems():
+            if m[2] > 0:
+                slots.append(Slot('slot1@%s' % name, name, 'Unclaimed',
+                                  'Idle', 'Partitionable', m[2], m[3], m[4]))
+            if m[2] < m[0]:
+                slots.append(Slot('slot1_1@%s' % name, name, 'Claimed',
+                                  'Busy', 'Dynamic', m[0] - m[2],
+                                  m[1] - m[3], m[4]))
+        return slots
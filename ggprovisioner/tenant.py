@@ -1,7 +1,10 @@
 import psycopg2
 import sys
+import time
 
-from ggprovisioner import logger, ProvisionerConfig, SimpleStringifiable
+from ggprovisioner import (logger, ProvisionerConfig, SimpleStringifiable,
+                           Singleton)
+from ggprovisioner.listener import ChangeListener
 
 
 class Tenant(SimpleStringifiable):
@@ -28,15 +31,57 @@ class Tenant(SimpleStringifiable):
         self.secret_key = secret_key
         self.key_pair = key_pair
         self.domain = domain
-        subnets = {}
-        subnets_db_id = {}
+        # The subnet of each zone the tenant can launch in, and its db id
+        self.subnets = {}
+        self.subnets_db_id = {}
 
         # TODO Add the option for varying idle times (how long a job must be
         # in queue before being processed) and request rates to the database
         self.idle_time = 10
         self.request_rate = 600
+        self.reset_cycle_state()
+
+    def reset_cycle_state(self):
+        """
+        Clear the jobs and pool state that are rebuilt every cycle.
+        """
         self.jobs = []
         self.idle_jobs = []
+        # The slots reported by the collector of the tenant's pool and the
+        # machines whose free capacity is reserved for idle jobs
+        self.slots = []
+        self.reserved_machines = set()
+
+
+class TenantRegistry(object):
+    """
+    Cache the subscribed tenants between cycles. The tenants are only
+    reloaded from the database when a trigger notifies that the tenant
+    tables have changed, or when the cache is older than the refresh rate.
+    Because this class is a Singleton, the cache survives for as long as
+    the provisioner is running.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.tenants = []
+        self.loaded_time = 0
+        ChangeListener().listen('tenant_changed')
+
+    def get_tenants(self):
+        """
+        Get the tenants, ready for a new cycle.
+        """
+        expired = (time.time() - self.loaded_time >
+                   ProvisionerConfig().cache_refresh_rate)
+        if ChangeListener().changed('tenant_changed') or expired:
+            logger.debug("Reloading tenants from the database.")
+            self.tenants = load_from_db()
+            self.loaded_time = time.time()
+        else:
+            for t in self.tenants:
+                t.reset_cycle_state()
+        return self.tenants
 
 
 def load_from_db():
@@ -76,6 +121,24 @@ def load_from_db():
             " tenant.credentials = aws_credentials.id AND" +
             " tenant.subscribed = TRUE AND subnet_mapping.tenant" +
             " = tenant.id AND subnet_mapping.zone = tenant.zone")
+        # Pull the subnets for all of the tenants in one go too. Create a
+        # dict for the subnets of each tenant.
+        # I later realised that I need the database id of the subnet to
+        # store the instance request in the database:
+        # Hello, subnets_db_id.
+        subnets = {}
+        subnets_db_id = {}
+        subs = ProvisionerConfig().dbconn.execute(
+            "select subnet_mapping.* " +
+            "from subnet_mapping, tenant " +
+            "where subnet_mapping.tenant = tenant.id and " +
+            "tenant.subscribed = TRUE")
+        for sn in subs:
+            subnets.setdefault(sn['tenant'], {}).update(
+                {sn['zone']: sn['subnet']})
+            subnets_db_id.setdefault(sn['tenant'], {}).update(
+                {sn['zone']: sn['id']})
+
         # Create a tenant object for each row returned
         for row in rows:
             t = Tenant(row['id'], row['name'], row['public_address'],
@@ -85,22 +148,8 @@ def load_from_db():
                        row['max_bid_price'], row['bid_percent'], 
                        row['timeout_threshold'], row['access_key_id'], 
                        row['secret_key'], row['key_pair'])
-            # Pull the subnets for the tenant too
-            subnets = {}
-            subnets_db_id = {}
-            subs = ProvisionerConfig().dbconn.execute(
-                "select * " +
-                "from subnet_mapping " +
-                "where tenant = %s" % t.db_id)
-            # Create a dict for the subnets and add that to the tenant
-            # I later realised that I need the database id of the subnet to
-            # store the instance request in the database:
-            # Hello, subnets_db_id.
-            for sn in subs:
-                subnets.update({sn['zone']: sn['subnet']})
-                subnets_db_id.update({sn['zone']: sn['id']})
-            t.subnets = subnets
-            t.subnets_db_id = subnets_db_id
+            t.subnets = subnets.get(t.db_id, {})
+            t.subnets_db_id = subnets_db_id.get(t.db_id, {})
             tenant_list.append(t)
     except psycopg2.Error:
         logger.exception("Failed to get tenant data.")
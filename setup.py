@@ -12,7 +12,8 @@ setup(
     install_requires=['sqlalchemy', 'psycopg2', 'boto', 'pytz'],
     packages=['ggprovisioner',
               'ggprovisioner.cloud', 'ggprovisioner.cloud.aws',
-              'ggprovisioner.scheduler', 'ggprovisioner.scheduler.condor'],
+              'ggprovisioner.scheduler', 'ggprovisioner.scheduler.condor',
+              'ggprovisioner.simulation'],
     package_data={'': ['*.ini']},
     entry_points={'console_scripts':
                   ['genomics_provisioner = ggprovisioner.cli:main']},
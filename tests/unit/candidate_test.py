@@ -0,0 +1,63 @@
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance, Request
+from ggprovisioner.cloud.aws.request import make_candidates
+from ggprovisioner.provisioner import Provisioner
+from ggprovisioner.scheduler import Job
+
+
+def make_instances():
+    large = Instance(1, 'large', 0.4, 8, 32, 10, 'ami-1')
+    large.spot = {'us-east-1a': 0.1, 'us-east-1b': 0.5}
+    small = Instance(2, 'small', 0.2, 2, 4, 10, 'ami-2')
+    small.spot = {'us-east-1a': 0.05}
+    return [large, small]
+
+
+class TestRunner(MockedIO):
+    @istest
+    def candidates_are_sorted_by_price(self):
+        """
+        Unit: Launch Candidates Are Made For Each Zone And Sorted By Price
+        """
+        candidates = make_candidates(make_instances())
+
+        assert [(c.instance_type, c.zone, c.price) for c in candidates] == [
+            ('small', 'us-east-1a', 0.05), ('large', 'us-east-1a', 0.1),
+            ('small', '', 0.2), ('large', '', 0.4),
+            ('large', 'us-east-1b', 0.5)]
+
+    @istest
+    def candidate_makes_request(self):
+        """
+        Unit: A Selected Candidate Makes A Request With Its Bid
+        """
+        candidate = make_candidates(make_instances())[1]
+
+        req = candidate.request(0.2)
+
+        assert isinstance(req, Request)
+        assert (req.instance_type, req.zone, req.ami, req.bid, req.odp,
+                req.price, req.ondemand) == ('large', 'us-east-1a', 'ami-1',
+                                             0.2, 0.4, 0.1, False)
+
+    @istest
+    def potential_instances_are_shared(self):
+        """
+        Unit: Jobs With The Same Eligible Instances Share Candidates
+        """
+        instances = make_instances()
+        prov = Provisioner.__new__(Provisioner)
+        prov.load_candidates(instances)
+        first = Job('10.0.0.1', '1', 1, 0, 2, 4)
+        second = Job('10.0.0.1', '2', 1, 0, 2, 4)
+        ondemand = Job('10.0.0.1', '3', 1, 0, 2, 4,
+                       description={'ondemand': True})
+
+        options = prov.get_potential_instances(instances[1:], first)
+
+        assert [c.instance_type for c in options] == ['small', 'small']
+        assert prov.get_potential_instances(instances[1:], second) is options
+        assert [c.zone for c in prov.get_potential_instances(
+            instances, ondemand)] == ['', '']
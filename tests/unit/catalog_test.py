@@ -0,0 +1,51 @@
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance, InstanceCatalog
+
+
+def make_catalog():
+    catalog = InstanceCatalog()
+    catalog.load([Instance(1, 'large', 0.4, 8, 32, 10, 'ami'),
+                  Instance(2, 'small', 0.1, 2, 4, 10, 'ami'),
+                  Instance(3, 'highmem', 0.3, 2, 64, 10, 'ami')])
+    return catalog
+
+
+class TestRunner(MockedIO):
+    @istest
+    def catalog_looks_up_by_name_and_id(self):
+        """
+        Unit: Instance Catalog Looks Up Types By Name And Database Id
+        """
+        catalog = make_catalog()
+
+        assert catalog.get('small').db_id == 2
+        assert catalog.get_by_id(1).type == 'large'
+        assert catalog.get('retired') is None
+
+    @istest
+    def catalog_finds_fitting_types_in_size_order(self):
+        """
+        Unit: Instance Catalog Finds Types Large Enough For A Job
+        """
+        catalog = make_catalog()
+
+        fitting = [ins.type for ins in catalog.fitting('2', 16)]
+
+        assert fitting == ['highmem', 'large'], fitting
+        assert catalog.fitting(16, 1) == []
+
+    @istest
+    def catalog_version_changes_on_load(self):
+        """
+        Unit: Instance Catalog Bumps Its Version And Drops Cached Lookups
+        """
+        catalog = make_catalog()
+        version = catalog.version
+        catalog.fitting(1, 1)
+
+        catalog.load([])
+
+        assert catalog.version == version + 1
+        assert catalog.fitting(1, 1) == []
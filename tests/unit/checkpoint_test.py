@@ -0,0 +1,102 @@
+import decimal
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import checkpoint
+from ggprovisioner.cloud.aws import Instance, InstanceCatalog
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.json.gz')
+        self.clock = 1000000.0
+        self.config = mock.Mock()
+        self.config.catalog = InstanceCatalog()
+        self.tracker = mock.Mock()
+        self.tracker.states = {1: {'i-1': 'running'}}
+        self.tracker.retries = {1: {'i-1': 2}}
+        self.forecaster = mock.Mock()
+        self.forecaster.tenants = {1: (500.0, [[0.5] * 24] * 7, (2, 4))}
+        self.forecaster.recorded = {1: set(['10', '11'])}
+        self.patches = [
+            mock.patch('ggprovisioner.ProvisionerConfig',
+                       return_value=self.config),
+            mock.patch('ggprovisioner.cloud.aws.tracker.InstanceTracker',
+                       return_value=self.tracker),
+            mock.patch('ggprovisioner.forecast.Forecaster',
+                       return_value=self.forecaster),
+            mock.patch('ggprovisioner.listener.ChangeListener'),
+            mock.patch.object(checkpoint.time, 'time',
+                              lambda: self.clock)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.directory)
+        super(TestRunner, self).tearDown()
+
+    def save(self):
+        ins = Instance(3, 'c4.large', decimal.Decimal('0.1'), 2,
+                       decimal.Decimal('3.75'), decimal.Decimal('0'), 'ami-1')
+        ins.spot = {'us-east-1a': 0.03}
+        self.config.catalog.load([ins], self.clock - 100)
+        prov = mock.Mock()
+        prov.prices_time = self.clock - 30
+        assert checkpoint.Checkpoint(self.path).save(prov)
+
+        # Start again with empty caches
+        self.config.catalog = InstanceCatalog()
+        self.tracker.states = {}
+        self.tracker.retries = {}
+        self.forecaster.tenants = {}
+        self.forecaster.recorded = {}
+
+    @istest
+    def caches_are_restored(self):
+        """
+        Unit: Checkpoint Restores The Caches It Saved
+        """
+        self.save()
+        prov = mock.Mock()
+        self.clock += 60
+
+        assert checkpoint.Checkpoint(self.path).load(prov)
+
+        ins = self.config.instance_types[0]
+        assert ins.ondemand == decimal.Decimal('0.1')
+        assert ins.spot == {'us-east-1a': 0.03}
+        assert self.config.catalog.get('c4.large') is ins
+        # The catalog version carries on from the saved one
+        assert self.config.catalog.version == 3
+        assert prov.restored_prices == self.config.catalog.version
+        assert self.tracker.states == {1: {'i-1': 'running'}}
+        assert self.tracker.retries == {1: {'i-1': 2}}
+        assert self.forecaster.tenants[1][2] == (2, 4)
+        assert self.forecaster.recorded == {1: set(['10', '11'])}
+
+    @istest
+    def old_checkpoints_are_ignored(self):
+        """
+        Unit: Checkpoint Is Ignored When Too Old And Prices When Stale
+        """
+        self.save()
+        prov = mock.Mock()
+        prov.restored_prices = None
+
+        # The prices are too old to use, the rest is still loaded
+        self.clock += 300
+        assert checkpoint.Checkpoint(self.path).load(prov)
+        assert prov.restored_prices is None
+        assert self.tracker.states == {1: {'i-1': 'running'}}
+
+        self.clock += 600
+        assert not checkpoint.Checkpoint(self.path).load(prov)
@@ -0,0 +1,78 @@
+import os
+import StringIO
+import subprocess
+import sys
+
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import cli
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+
+class TestRunner(MockedIO):
+    @istest
+    def provisioner_runs_without_a_command(self):
+        """
+        Unit: CLI Runs The Provisioner When No Command Is Given
+        """
+        args = cli.parse_args(['--cycles', '2'])
+        assert args.command == 'run'
+        assert args.cycles == 2
+        assert args.log_level == 'DEBUG'
+
+        args = cli.parse_args(['prices', '--type', 'c4.large'])
+        assert args.command == 'prices'
+        assert args.instance_type == 'c4.large'
+        # Read-only commands only log warnings unless asked for more
+        assert args.log_level == 'WARNING'
+
+        with mock.patch.object(cli, 'status') as status:
+            cli.main(['status'])
+        assert status.call_args[0][0].command == 'status'
+
+    @istest
+    def heavy_modules_are_imported_when_used(self):
+        """
+        Unit: Importing The CLI Doesn't Import boto Or The Database Drivers
+        """
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys\n'
+            'from ggprovisioner import cli\n'
+            'heavy = ["boto", "sqlalchemy", "psycopg2"]\n'
+            'print [m for m in heavy if m in sys.modules]\n'
+            'from ggprovisioner import ProvisionerConfig\n'
+            'print ProvisionerConfig.__module__'], cwd=ROOT)
+        assert output.splitlines() == ['[]', 'ggprovisioner.config'], output
+
+    @istest
+    def open_requests_are_counted(self):
+        """
+        Unit: CLI Counts The Requests That Have No Instance Yet
+        """
+        conn = sqlalchemy.create_engine('sqlite://').connect()
+        for statement in [
+                "create table tenant (id integer, name text)",
+                "create table instance_request (id integer, tenant integer)",
+                "create table instance (id integer, request_id integer)",
+                "create table launch_outbox (id integer, state text)",
+                "insert into tenant values (1, 'a'), (2, 'b')",
+                "insert into instance_request values (1, 1), (2, 1), (3, 1)",
+                "insert into instance values (1, 2)",
+                "insert into launch_outbox values (1, 'pending')"]:
+            conn.execute(statement)
+        args = cli.parse_args(['status', '--database'])
+        output = StringIO.StringIO()
+        with mock.patch('ggprovisioner.ProvisionerConfig') as config:
+            config.return_value.dbconn = conn
+            with mock.patch('sys.stdout', output):
+                cli.database_status(args)
+
+        lines = [line.split() for line in output.getvalue().splitlines()]
+        assert ['a', '2'] in lines, lines
+        assert ['b', '0'] in lines, lines
+        assert ['pending', '1'] in lines, lines
@@ -0,0 +1,210 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import fleet, Instance
+from ggprovisioner.cloud.aws.request import make_candidates
+from ggprovisioner.scheduler import Job
+
+FLEET_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<CreateFleetResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+  <requestId>req-1</requestId>
+  <fleetId>fleet-1</fleetId>
+  <fleetInstanceSet>%s</fleetInstanceSet>
+  <errorSet>%s</errorSet>
+</CreateFleetResponse>"""
+
+FLEET_INSTANCE = """<item>
+  <instanceIds><item>%s</item></instanceIds>
+  <instanceType>%s</instanceType>
+  <launchTemplateAndOverrides>
+    <overrides><instanceType>%s</instanceType>
+    <subnetId>%s</subnetId></overrides>
+  </launchTemplateAndOverrides>
+  <lifecycle>%s</lifecycle>
+</item>"""
+
+FLEET_ERROR = """<item>
+  <errorCode>InsufficientInstanceCapacity</errorCode>
+  <errorMessage>No capacity</errorMessage>
+</item>"""
+
+
+class FakeResponse(object):
+    def __init__(self, body, status=200):
+        self.status = status
+        self.reason = 'OK'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeFleetConnection(object):
+    """
+    A stand-in for EC2 that launches as many instances of each fleet as
+    it has capacity for.
+    """
+    def __init__(self, spot_capacity, ondemand_capacity):
+        self.capacity = {'spot': spot_capacity,
+                         'on-demand': ondemand_capacity}
+        self.calls = []
+        self.launched = 0
+
+    def make_request(self, action, params=None, path='/', verb='GET',
+                     api_version=None):
+        self.calls.append((action, params))
+        if action != 'CreateFleet':
+            return FakeResponse('<Response/>')
+        lifecycle = params[
+            'TargetCapacitySpecification.DefaultTargetCapacityType']
+        wanted = params['TargetCapacitySpecification.TotalTargetCapacity']
+        count = min(wanted, self.capacity[lifecycle])
+        ins_type = params['LaunchTemplateConfigs.1.Overrides.1.InstanceType']
+        subnet = params['LaunchTemplateConfigs.1.Overrides.1.SubnetId']
+        items = ""
+        for i in range(count):
+            self.launched += 1
+            items += FLEET_INSTANCE % ('i-%s' % self.launched, ins_type,
+                                       ins_type, subnet, lifecycle)
+        errors = FLEET_ERROR if count < wanted else ""
+        return FakeResponse(FLEET_RESPONSE % (items, errors))
+
+
+def make_tenant():
+    tenant = mock.Mock()
+    tenant.name = 'tenant'
+    tenant.db_id = 1
+    tenant.max_bid_price = 1.0
+    tenant.bid_percent = 80
+    tenant.subnets = {'us-east-1a': 'subnet-a', 'us-east-1b': 'subnet-b'}
+    tenant.subnets_db_id = {'us-east-1a': 10, 'us-east-1b': 11}
+    return tenant
+
+
+def make_jobs(count):
+    large = Instance(1, 'large', 0.4, 8, 32, 10, 'ami-1')
+    large.spot = {'us-east-1a': 0.1, 'us-east-1c': 0.05}
+    small = Instance(2, 'small', 0.2, 2, 4, 10, 'ami-2')
+    small.spot = {'us-east-1b': 0.05}
+    options = make_candidates([large, small])
+    jobs = []
+    for i in range(count):
+        job = Job('10.0.0.1', str(i), 1, 0, 2, 4)
+        job.launch_options = options
+        job.launch = options[0].request()
+        jobs.append(job)
+    return jobs
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        fleet.templates.clear()
+        self.config_patch = mock.patch(
+            'ggprovisioner.cloud.aws.fleet.ProvisionerConfig')
+        self.cloudinit_patch = mock.patch(
+            'ggprovisioner.cloud.aws.api.render_cloudinit',
+            return_value='#cloud-config')
+        # Fleets are made in boto's default region
+        self.region_patch = mock.patch(
+            'ggprovisioner.cloud.aws.fleet.zone_region', return_value=None)
+        self.dbconn = self.config_patch.start().return_value.dbconn
+        self.cloudinit_patch.start()
+        self.region_patch.start()
+
+    def tearDown(self):
+        self.config_patch.stop()
+        self.cloudinit_patch.stop()
+        self.region_patch.stop()
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def jobs_with_the_same_options_are_grouped(self):
+        """
+        Unit: Fleet Launches Group Jobs Sharing Options And Cpus
+        """
+        jobs = make_jobs(3)
+        jobs[1].fulfilled = True
+        jobs[2].launch = jobs[2].launch_options[1].request()
+
+        groups = fleet.group_jobs(jobs)
+
+        found = [(key, [j.id for j in group])
+                 for (key, options, group) in groups]
+        assert found == [
+            ((False, 8), ['0']), ((False, 2), ['2'])], found
+
+    @istest
+    def overrides_cover_affordable_pools(self):
+        """
+        Unit: Fleet Overrides Cover Each Affordable Zone With A Subnet
+        """
+        tenant = make_tenant()
+        options = make_jobs(1)[0].launch_options
+
+        spot = fleet.build_overrides(tenant, options, 8, False)
+        ondemand = fleet.build_overrides(tenant, options, 8, True)
+
+        assert spot == [{'InstanceType': 'large', 'SubnetId': 'subnet-a',
+                         'ImageId': 'ami-1', 'MaxPrice': '0.32'}], spot
+        assert sorted(o['SubnetId'] for o in ondemand) == [
+            'subnet-a', 'subnet-b'], ondemand
+        assert 'MaxPrice' not in ondemand[0]
+
+    @istest
+    def fleet_params_request_capacity(self):
+        """
+        Unit: Fleet Requests Ask For Price Capacity Optimized Spot
+        """
+        params = fleet.build_fleet_params(
+            'template', [{'InstanceType': 'small', 'SubnetId': 'subnet-b'}],
+            4, False, 'tenant')
+
+        assert params['Type'] == 'instant'
+        assert params['SpotOptions.AllocationStrategy'] == \
+            'price-capacity-optimized'
+        assert params['TargetCapacitySpecification.SpotTargetCapacity'] == 4
+        assert params[
+            'LaunchTemplateConfigs.1.Overrides.1.InstanceType'] == 'small'
+
+    @istest
+    def spot_shortfall_falls_back_to_ondemand(self):
+        """
+        Unit: Fleet Capacity Spot Cannot Find Is Launched Ondemand
+        """
+        tenant = make_tenant()
+        tenant.idle_jobs = make_jobs(3)
+        conn = FakeFleetConnection(spot_capacity=2, ondemand_capacity=5)
+
+        with mock.patch('ggprovisioner.cloud.aws.fleet.get_connection',
+                        return_value=conn):
+            fleet.request_fleets(tenant)
+
+        actions = [action for (action, params) in conn.calls]
+        assert actions == ['CreateLaunchTemplate', 'CreateFleet',
+                           'CreateFleet'], actions
+        insert = self.dbconn.execute.call_args[0][0]
+        assert insert.count("'fleet'") == 3, insert
+        # the third job is launched ondemand at the ondemand price
+        assert "(1, 1, 0.4, 2, 'fleet', 'i-3'," in insert, insert
+
+    @istest
+    def unrecorded_fleets_are_logged(self):
+        """
+        Unit: Fleet Instances That Can't Be Recorded Are Logged By Id
+        """
+        tenant = make_tenant()
+        tenant.idle_jobs = make_jobs(2)
+        conn = FakeFleetConnection(spot_capacity=2, ondemand_capacity=0)
+        self.dbconn.execute.side_effect = sqlalchemy.exc.OperationalError(
+            'insert', None, Exception('closed'))
+
+        with mock.patch('ggprovisioner.cloud.aws.fleet.get_connection',
+                        return_value=conn):
+            with mock.patch.object(fleet, 'logger') as logger:
+                fleet.request_fleets(tenant)
+
+        message = logger.exception.call_args[0][0]
+        assert 'i-1, i-2' in message, message
@@ -0,0 +1,152 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance, manager
+from ggprovisioner.cloud.aws.request import make_candidates
+from ggprovisioner.cloud.aws.scaler import select_warm_option
+from ggprovisioner.forecast import (build_rates, expected_arrivals,
+                                    warm_pool_size, backtest, Forecaster,
+                                    HOUR, WEEK)
+
+# 2015-01-05T00:00:00Z, a Monday
+MONDAY = 1420416000
+
+
+class TestRunner(MockedIO):
+    @istest
+    def rates_average_over_weeks(self):
+        """
+        Unit: Forecast Rates Are The Average Arrivals Per Hour Of The Week
+        """
+        rates = build_rates([(0, 9, 8), (6, 23, 2)], 4)
+
+        assert rates[0][9] == 2.0
+        assert rates[6][23] == 0.5
+        assert sum(sum(day) for day in rates) == 2.5
+
+    @istest
+    def expected_arrivals_span_hours(self):
+        """
+        Unit: Forecast Expected Arrivals Walk The Hours A Window Covers
+        """
+        rates = build_rates([(0, 9, 6), (0, 10, 12)], 1)
+
+        # Half of 9am and half of 10am on Monday
+        start = MONDAY + 9 * HOUR + HOUR / 2
+        assert expected_arrivals(rates, start, HOUR) == 9.0
+        # Nothing arrives on Tuesday
+        assert expected_arrivals(rates, start + 24 * HOUR, HOUR) == 0.0
+
+    @istest
+    def warm_pool_covers_arrivals(self):
+        """
+        Unit: Forecast Warm Pool Covers Poisson Arrivals Up To A Limit
+        """
+        assert warm_pool_size(0, 0.8, 10) == 0
+        # P(N <= 1) = 0.74 and P(N <= 2) = 0.92 for a mean of 1
+        assert warm_pool_size(1.0, 0.8, 10) == 2
+        assert warm_pool_size(1.0, 0.5, 10) == 1
+        assert warm_pool_size(100.0, 0.8, 10) == 10
+
+    @istest
+    def backtest_warms_for_regular_jobs(self):
+        """
+        Unit: Forecast Backtest Has Workers Warm Through The Working Day
+        """
+        # A job every 10 minutes from 9am to 5pm each weekday for 4 weeks
+        arrivals = [MONDAY + week * WEEK + day * 24 * HOUR + 9 * HOUR +
+                    i * 600 for week in range(4) for day in range(5)
+                    for i in range(48)]
+
+        result = backtest(arrivals, 2, 300, coverage=0.8)
+
+        assert result['jobs'] == 480
+        # Only the first job of each day waits for a worker to boot
+        assert result['warm_starts'] == 470
+        assert result['latency_saved_hours'] == 470 * 300.0 / HOUR
+        # One worker kept warm for 8 hours a day
+        assert result['extra_instance_hours'] == 80.0
+
+    @istest
+    def backtest_empty_trace(self):
+        """
+        Unit: Forecast Backtest Of An Empty Trace Reports Nothing
+        """
+        result = backtest([], 2, 300)
+
+        assert result['jobs'] == 0
+        assert result['extra_instance_hours'] == 0.0
+
+    @istest
+    def warm_option_fits_shape(self):
+        """
+        Unit: Warm Pool Launches The Cheapest Spot Option Fitting The Shape
+        """
+        small = Instance(1, 'small', 0.2, 1, 4, 10, 'ami')
+        small.spot = {'us-east-1a': 0.05}
+        large = Instance(2, 'large', 0.8, 4, 16, 10, 'ami')
+        large.spot = {'us-east-1a': 0.3, 'us-east-1b': 0.2}
+        tenant = mock.Mock()
+        tenant.subnets = {'us-east-1a': 'subnet-a'}
+        tenant.max_bid_price = 1.0
+        candidates = make_candidates([small, large])
+
+        option = select_warm_option(candidates, (2, 8), tenant)
+
+        assert (option.instance_type, option.zone) == ('large', 'us-east-1a')
+        assert select_warm_option(candidates, (1, 4), tenant).price == 0.05
+        assert select_warm_option(candidates, (8, 8), tenant) is None
+        assert select_warm_option(candidates, None, tenant) is None
+
+    @istest
+    def old_history_is_deleted(self):
+        """
+        Unit: Forecast Deletes Job History Older Than The Weeks It Covers
+        """
+        try:
+            del Forecaster._instance
+        except AttributeError:
+            pass
+        tenant = mock.Mock()
+        tenant.db_id = 3
+        with mock.patch('ggprovisioner.forecast.ProvisionerConfig') as config:
+            config.return_value.history_weeks = 4
+            config.return_value.dbconn.execute.return_value = []
+            Forecaster().load(tenant, MONDAY)
+        del Forecaster._instance
+
+        statement = config.return_value.dbconn.execute.call_args_list[0][0][0]
+        assert statement.startswith('delete from job_history where '
+                                    'tenant = 3'), statement
+        assert "interval '4 weeks'" in statement
+
+    @istest
+    def database_errors_keep_the_warm_pool(self):
+        """
+        Unit: Warm Pool Falls Back Safely When The Database Fails
+        """
+        try:
+            del Forecaster._instance
+        except AttributeError:
+            pass
+        tenant = mock.Mock()
+        tenant.db_id = 3
+        error = sqlalchemy.exc.OperationalError('select', None,
+                                                Exception('closed'))
+        with mock.patch('ggprovisioner.forecast.ProvisionerConfig') as config:
+            config.return_value.history_weeks = 4
+            config.return_value.dbconn.execute.side_effect = error
+            (rates, shape) = Forecaster().load(tenant, MONDAY)
+        del Forecaster._instance
+        assert shape is None
+        assert all(rate == 0 for day in rates for rate in day)
+
+        # Requests that can't be checked are taken to be warm, so they
+        # aren't cancelled
+        with mock.patch(
+                'ggprovisioner.cloud.aws.manager.ProvisionerConfig') as config:
+            config.return_value.dbconn.execute.side_effect = error
+            assert manager.get_warm_request_ids(
+                tenant, ['sir-1', 'sir-2']) == set(['sir-1', 'sir-2'])
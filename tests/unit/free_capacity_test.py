@@ -0,0 +1,118 @@
+import subprocess
+
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.scheduler import Job, Slot
+from ggprovisioner.replay import RecordedProcess
+from ggprovisioner.scheduler.base_scheduler import subtract_free_capacity
+from ggprovisioner.scheduler.condor import condor_scheduler
+
+
+def make_tenant(slots, jobs):
+    """
+    Build a mocked tenant with a pool of slots and a set of idle jobs
+    """
+    tenant = mock.Mock()
+    tenant.slots = slots
+    tenant.idle_jobs = list(jobs)
+    tenant.reserved_machines = set()
+    return tenant
+
+
+def make_job(id_num, cpus, mem):
+    return Job('tenant', id_num, '1', '0', cpus, mem)
+
+
+class TestRunner(MockedIO):
+    @istest
+    def free_slot_absorbs_fitting_job(self):
+        """
+        Unit: Free Capacity Removes A Job That Fits An Unclaimed Slot
+        """
+        slot = Slot('slot1@a', 'a', 'Unclaimed', 'Idle', 'Static', 4, 8)
+        job = make_job('1', '2', 4)
+        tenant = make_tenant([slot], [job])
+
+        subtract_free_capacity([tenant])
+
+        assert tenant.idle_jobs == [], tenant.idle_jobs
+        assert tenant.reserved_machines == set(['a'])
+
+    @istest
+    def claimed_and_small_slots_are_ignored(self):
+        """
+        Unit: Free Capacity Ignores Claimed Slots And Slots Too Small
+        """
+        busy = Slot('slot1@a', 'a', 'Claimed', 'Busy', 'Static', 8, 16)
+        small = Slot('slot1@b', 'b', 'Unclaimed', 'Idle', 'Static', 1, 1)
+        job = make_job('1', '2', 4)
+        tenant = make_tenant([busy, small], [job])
+
+        subtract_free_capacity([tenant])
+
+        assert tenant.idle_jobs == [job]
+        assert len(tenant.reserved_machines) == 0
+
+    @istest
+    def static_slot_runs_one_job(self):
+        """
+        Unit: Free Capacity Only Places One Job On A Static Slot
+        """
+        slot = Slot('slot1@a', 'a', 'Unclaimed', 'Idle', 'Static', 8, 16)
+        jobs = [make_job('1', '1', 1), make_job('2', '1', 1)]
+        tenant = make_tenant([slot], jobs)
+
+        subtract_free_capacity([tenant])
+
+        assert len(tenant.idle_jobs) == 1, tenant.idle_jobs
+
+    @istest
+    def partitionable_slot_is_carved_up(self):
+        """
+        Unit: Free Capacity Packs Jobs Into The Rest Of A Partitionable Slot
+        """
+        slot = Slot('slot1@a', 'a', 'Unclaimed', 'Idle', 'Partitionable',
+                    4, 8)
+        jobs = [make_job(str(i), '1', 2) for i in range(5)]
+        tenant = make_tenant([slot], jobs)
+
+        subtract_free_capacity([tenant])
+
+        # four single cpu jobs fit, the fifth needs a new instance
+        assert len(tenant.idle_jobs) == 1, tenant.idle_jobs
+
+    @istest
+    def slot_memory_is_read_in_gb(self):
+        """
+        Unit: Slot Memory Reported In MB Is Converted To GB, However Small
+        """
+        output = ('slot1@a:a:Unclaimed:Idle:Partitionable:2:1000:0\n'
+                  'slot1@b:b:Unclaimed:Idle:Partitionable:8:16384:0\n')
+        with mock.patch.object(condor_scheduler, 'popen',
+                               return_value=RecordedProcess(output, 0)):
+            slots = condor_scheduler.CondorScheduler().get_condor_status(
+                'pool')
+
+        assert [s.memory for s in slots] == [1000 / 1024.0, 16.0], slots
+        # A job needing more than the leftover memory is not absorbed
+        tenant = make_tenant(slots[:1], [make_job('1', '1', 1)])
+        subtract_free_capacity([tenant])
+        assert len(tenant.idle_jobs) == 1
+
+    @istest
+    def failed_status_polls_are_logged(self):
+        """
+        Unit: A Failed condor_status Is Logged And Its Errors Not Piped
+        """
+        with mock.patch.object(condor_scheduler, 'popen',
+                               return_value=RecordedProcess('', 1)) as popen:
+            with mock.patch.object(condor_scheduler.logger,
+                                   'error') as error:
+                slots = condor_scheduler.CondorScheduler().get_condor_status(
+                    'pool')
+
+        assert slots == []
+        assert error.call_count == 1
+        assert popen.call_args[1]['stderr'] is not subprocess.PIPE
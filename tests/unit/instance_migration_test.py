@@ -0,0 +1,148 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import manager
+from ggprovisioner.scheduler import Job
+
+
+def make_row(instance_id, dns, cpus, memory):
+    return {'instance_id': instance_id, 'private_dns': dns,
+            'job_runner_id': 100, 'type_id': 1, 'type': 'type%s' % cpus,
+            'ondemand_price': 0.1, 'cpus': cpus, 'memory': memory,
+            'disk': 10, 'ami': 'ami'}
+
+
+def make_job(id_num, cpus, mem):
+    return Job('tenant', id_num, '1', '0', cpus, mem)
+
+
+def make_tenant(jobs):
+    tenant = mock.Mock()
+    tenant.db_id = 1
+    tenant.idle_jobs = list(jobs)
+    tenant.reserved_machines = set()
+    return tenant
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.rows = []
+        self.statements = []
+        self.config_patch = mock.patch(
+            'ggprovisioner.cloud.aws.manager.ProvisionerConfig')
+        self.config = self.config_patch.start().return_value
+        self.config.dbconn.execute.side_effect = self.execute
+        self.idle_patch = mock.patch.object(manager.scaler,
+                                            'get_idle_machines')
+        self.idle = self.idle_patch.start()
+
+    def tearDown(self):
+        self.idle_patch.stop()
+        self.config_patch.stop()
+        super(TestRunner, self).tearDown()
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        if statement.startswith('select'):
+            return self.rows
+        return []
+
+    @istest
+    def largest_job_gets_the_worker(self):
+        """
+        Unit: Instance Migration Gives An Idle Worker To The Largest Job
+        """
+        self.idle.return_value = ['ip-1']
+        self.rows = [make_row('i-1', 'ip-1', 8, 32)]
+        small = make_job('1', '1', 1)
+        large = make_job('2', '8', 16)
+        tenant = make_tenant([small, large])
+
+        manager.migrate_instances([tenant])
+
+        # The worker is used once, by the largest job
+        inserts = [s for s in self.statements if s.startswith('insert')]
+        assert len(inserts) == 1, inserts
+        assert "'i-1', 100, 2" in inserts[0], inserts[0]
+        assert tenant.idle_jobs == [small]
+        assert tenant.reserved_machines == set(['ip-1'])
+
+    @istest
+    def workers_too_small_are_left(self):
+        """
+        Unit: Instance Migration Leaves Jobs That Don't Fit The Idle Workers
+        """
+        self.idle.return_value = ['ip-1']
+        self.rows = [make_row('i-1', 'ip-1', 2, 4)]
+        job = make_job('1', '4', 8)
+        tenant = make_tenant([job])
+
+        manager.migrate_instances([tenant])
+
+        assert tenant.idle_jobs == [job]
+        assert tenant.reserved_machines == set()
+        assert not any(s.startswith('insert') for s in self.statements)
+
+    @istest
+    def idle_workers_are_read_with_their_types(self):
+        """
+        Unit: Idle Workers Are Only Looked Up For Idle Machines
+        """
+        tenant = make_tenant([])
+        self.idle.return_value = []
+        assert manager.get_idle_workers(tenant, 0) == []
+        assert self.statements == []
+
+        self.idle.return_value = ['ip-1', 'ip-2']
+        self.rows = [make_row('i-1', 'ip-1', 4, 16)]
+        workers = manager.get_idle_workers(tenant, 0)
+
+        assert "in ('ip-1', 'ip-2')" in self.statements[0]
+        assert [w['instance_id'] for w in workers] == ['i-1']
+        assert workers[0]['instance'].cpus == 4
+
+    @istest
+    def migrations_are_recorded_once(self):
+        """
+        Unit: Instance Migration Is Only Inserted If Not Already Recorded
+        """
+        worker = {'instance_id': 'i-1', 'job_runner_id': None}
+
+        assert manager.migrate_instance(worker, make_job('5', '1', 1))
+
+        statement = self.statements[0]
+        assert statement.startswith('insert into instance_migration')
+        assert "where not exists" in statement
+        assert "instance_id = 'i-1' and to_job = 5" in statement
+        # A worker with no recorded job migrates from none
+        assert "'i-1', null, 5" in statement
+
+    @istest
+    def failed_migrations_leave_the_job_waiting(self):
+        """
+        Unit: Instance Migration Leaves The Job When The Database Fails
+        """
+        self.idle.return_value = ['ip-1']
+        self.rows = [make_row('i-1', 'ip-1', 8, 32)]
+        job = make_job('1', '1', 1)
+        tenant = make_tenant([job])
+
+        def execute(statement):
+            if statement.startswith('insert'):
+                raise sqlalchemy.exc.OperationalError(statement, None,
+                                                      Exception('closed'))
+            return self.execute(statement)
+        self.config.dbconn.execute.side_effect = execute
+        manager.migrate_instances([tenant])
+
+        assert tenant.idle_jobs == [job]
+        assert tenant.reserved_machines == set()
+
+        # Nor are workers found when they can't be read
+        self.config.dbconn.execute.side_effect = (
+            sqlalchemy.exc.OperationalError('select', None,
+                                            Exception('closed')))
+        assert manager.get_idle_workers(tenant, 0) == []
@@ -0,0 +1,39 @@
+import mock
+import sqlalchemy.exc
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.listener import ChangeListener
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        # give each test a fresh listener
+        try:
+            del ChangeListener._instance
+        except AttributeError:
+            pass
+
+    def tearDown(self):
+        try:
+            del ChangeListener._instance
+        except AttributeError:
+            pass
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def changes_are_reported_while_disconnected(self):
+        """
+        Unit: Change Listener Reports Changes When It Can't Connect
+        """
+        listener = ChangeListener()
+        error = sqlalchemy.exc.OperationalError('connect', None,
+                                                Exception('refused'))
+        with mock.patch('ggprovisioner.listener.ProvisionerConfig') as config:
+            config.return_value.engine.raw_connection.side_effect = error
+            listener.listen('tenant_changed')
+            assert listener.changed('tenant_changed')
+            # Without the connection, every check falls back to a reload
+            assert listener.changed('tenant_changed')
+        assert listener.conn is None
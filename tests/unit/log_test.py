@@ -0,0 +1,81 @@
+import logging
+
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.log import LazyRepr, RateLimitFilter, \
+    StructuredFormatter, fields
+
+
+class Counted(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        return "Counted()"
+
+
+def make_record(msg, level=logging.DEBUG, extra=None, lineno=1):
+    record = logging.LogRecord('test', level, __file__, lineno, msg, (),
+                               None)
+    if extra is not None:
+        record.__dict__.update(extra)
+    return record
+
+
+class TestRunner(MockedIO):
+    @istest
+    def lazy_repr_is_computed_once(self):
+        """
+        Unit: LazyRepr Calls repr() Once, Only When Formatted
+        """
+        obj = Counted()
+        lazy = LazyRepr(obj)
+        assert obj.calls == 0
+        assert "%s %s" % (lazy, lazy) == "Counted() Counted()"
+        assert obj.calls == 1
+
+    @istest
+    def structured_formatter_appends_fields(self):
+        """
+        Unit: Structured Records Are Formatted With Sorted Fields
+        """
+        formatter = StructuredFormatter('%(message)s')
+        record = make_record("Selected", extra=fields(zone='a', job=3))
+        assert formatter.format(record) == "Selected job=3 zone=a"
+
+    @istest
+    def rate_limit_drops_repeats(self):
+        """
+        Unit: Repeated Messages Are Rate Limited, Warnings Are Not
+        """
+        limit = RateLimitFilter(rate=2, period=60)
+        results = [limit.filter(make_record("repeated")) for i in range(4)]
+        assert results == [True, True, False, False]
+        assert limit.filter(make_record("repeated", logging.WARNING))
+        assert limit.filter(make_record("another", lineno=2))
+
+    @istest
+    def rate_limit_is_per_call(self):
+        """
+        Unit: Calls Logging The Same Bare Format Are Rate Limited Apart
+        """
+        limit = RateLimitFilter(rate=1, period=60)
+        assert limit.filter(make_record("%s", lineno=1))
+        assert limit.filter(make_record("%s", lineno=2))
+        assert not limit.filter(make_record("%s", lineno=1))
+
+    @istest
+    def rate_limit_reports_suppressed(self):
+        """
+        Unit: Records Dropped By The Rate Limit Are Reported
+        """
+        limit = RateLimitFilter(rate=1, period=60)
+        limit.filter(make_record("repeated"))
+        assert not limit.filter(make_record("repeated"))
+        # end the window
+        limit.windows[(__file__, 1)][0] -= 61
+        record = make_record("repeated")
+        assert limit.filter(record)
+        assert record.fields == {'suppressed': 1}
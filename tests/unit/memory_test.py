@@ -0,0 +1,50 @@
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import memory
+
+
+class TestRunner(MockedIO):
+    @istest
+    def growth_is_ranked(self):
+        """
+        Unit: Memory Monitor Ranks The Types That Grew The Most
+        """
+        before = {'Job': 10, 'dict': 100, 'Request': 5}
+        after = {'Job': 30, 'dict': 150, 'Request': 5, 'Tenant': 1}
+
+        growth = memory.top_growth(before, after, 2)
+
+        assert growth == [('dict', 50), ('Job', 20)]
+        assert memory.format_growth(growth) == 'dict+50,Job+20'
+
+    @istest
+    def steady_growth_is_reported(self):
+        """
+        Unit: Memory Monitor Warns When RSS Grows At Every Check
+        """
+        monitor = memory.MemoryMonitor(interval=2, growth_checks=3)
+        rss = iter([100, 200, 300, 400])
+        with mock.patch.object(memory, 'get_rss', lambda: next(rss)), \
+                mock.patch.object(memory, 'logger') as logger:
+            for cycle in range(6):
+                monitor.cycle_finished()
+            # Only checked every other cycle
+            assert list(monitor.history) == [100, 200, 300]
+            assert not logger.warn.called
+
+            monitor.cycle_finished()
+            monitor.cycle_finished()
+            assert list(monitor.history) == [100, 200, 300, 400]
+            assert logger.warn.called
+
+    @istest
+    def flat_memory_is_not_reported(self):
+        """
+        Unit: Memory Monitor Does Not Warn When RSS Stops Growing
+        """
+        monitor = memory.MemoryMonitor(growth_checks=3)
+        monitor.history.extend([100, 200, 200, 300])
+
+        assert not monitor.is_growing()
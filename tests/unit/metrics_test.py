@@ -0,0 +1,90 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import metrics
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.counter = metrics.Counter('test_calls_total', 'Test calls.')
+        self.histogram = metrics.Histogram('test_seconds', 'Test latency.',
+                                           buckets=(0.1, 1.0))
+
+    def tearDown(self):
+        metrics.enabled = False
+        del metrics.registry['test_calls_total']
+        del metrics.registry['test_seconds']
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def disabled_metrics_record_nothing(self):
+        """
+        Unit: Metrics Are Not Recorded While Disabled
+        """
+        metrics.enabled = False
+        self.counter.inc(action='a')
+        with self.histogram.time(action='a'):
+            pass
+
+        assert self.counter.values == {}
+        assert self.histogram.values == {}
+
+    @istest
+    def counters_render_with_labels(self):
+        """
+        Unit: Metrics Render Counters In The Prometheus Text Format
+        """
+        metrics.enabled = True
+        self.counter.inc(action='a')
+        self.counter.inc(2, action='a')
+
+        lines = self.counter.render()
+
+        assert 'test_calls_total{action="a"} 3' in lines, lines
+        assert '# TYPE test_calls_total counter' in lines, lines
+
+    @istest
+    def histograms_render_cumulative_buckets(self):
+        """
+        Unit: Metrics Render Histograms With Cumulative Buckets
+        """
+        metrics.enabled = True
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+
+        lines = self.histogram.render()
+
+        assert 'test_seconds_bucket{le="0.1"} 1' in lines, lines
+        assert 'test_seconds_bucket{le="1.0"} 2' in lines, lines
+        assert 'test_seconds_bucket{le="+Inf"} 3' in lines, lines
+        assert 'test_seconds_count 3' in lines, lines
+
+    @istest
+    def failed_statements_are_not_timed(self):
+        """
+        Unit: Metrics Only Count And Time Statements That Complete
+        """
+        metrics.enabled = True
+        engine = sqlalchemy.create_engine('sqlite://')
+        metrics.instrument_engine(engine)
+        conn = engine.connect()
+
+        with mock.patch.dict(metrics.DB_QUERIES.values, clear=True):
+            with mock.patch.dict(metrics.DB_QUERY_SECONDS.values,
+                                 clear=True):
+                for i in range(3):
+                    try:
+                        conn.execute('select * from missing')
+                    except sqlalchemy.exc.OperationalError:
+                        pass
+                conn.execute('select 1')
+
+                key = (('kind', 'select'),)
+                assert metrics.DB_QUERIES.values == {key: 1}
+                assert metrics.DB_QUERY_SECONDS.values[key][2] == 1
+        # Nothing is left behind for the failed statements
+        assert conn.info == {}, conn.info
@@ -0,0 +1,185 @@
+import boto.exception
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance, Request
+from ggprovisioner.cloud.aws.connection import EC2Connection
+from ggprovisioner.cloud.aws.outbox import LaunchOutbox
+
+
+def make_tenant():
+    tenant = mock.Mock()
+    tenant.db_id = 1
+    tenant.name = 'tenant'
+    tenant.subnet_id = 7
+    tenant.subnets = {'us-east-1a': 'subnet-a'}
+    tenant.subnets_db_id = {'us-east-1a': 8}
+    return tenant
+
+
+def make_job(job_id, request):
+    job = mock.Mock()
+    job.id = job_id
+    job.fulfilled = False
+    job.launch = request
+    return job
+
+
+class FakeDatabase(object):
+    """
+    Answers the statements of the outbox, keeping the state of each row.
+    """
+    def __init__(self):
+        self.statements = []
+        self.rows = {}
+
+    def execute(self, statement):
+        statement = str(statement)
+        self.statements.append(statement)
+        if statement.startswith('insert into launch_outbox'):
+            row = {'id': len(self.rows) + 1, 'tenant': 1,
+                   'job_runner_id': 10, 'instance_type': 3,
+                   'request_type': 'spot', 'price': 0.1,
+                   'zone': 'us-east-1a', 'count': 1, 'packed_jobs': None,
+                   'packed_cpus': None, 'client_token': 'token-1',
+                   'state': 'pending', 'attempts': 0}
+            self.rows[row['id']] = row
+            return [row]
+        if statement.startswith("update launch_outbox set state = 'la"):
+            row = self.rows[1]
+            if row['state'] != 'pending':
+                return []
+            row['state'] = 'launching'
+            row['attempts'] += 1
+            return [{'attempts': row['attempts']}]
+        if statement.startswith("update launch_outbox set state = '"):
+            self.rows[1]['state'] = statement.split("'")[1]
+        elif statement.startswith('with done'):
+            self.rows[1]['state'] = 'done'
+        return []
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        MockedIO.setUp(self)
+        self.db = FakeDatabase()
+        self.config = mock.patch(
+            'ggprovisioner.cloud.aws.outbox.ProvisionerConfig').start()
+        self.config.return_value.dbconn = self.db
+        self.config.return_value.instance_types = [
+            Instance(3, 'c4.large', 0.2, 2, 4, 0, 'ami-1')]
+        self.conn = mock.Mock()
+        mock.patch('ggprovisioner.cloud.aws.outbox.get_zone_connection',
+                   return_value=self.conn).start()
+        mock.patch('ggprovisioner.cloud.aws.api.render_cloudinit',
+                   return_value='').start()
+        mock.patch('ggprovisioner.cloud.aws.api.tag_requests').start()
+
+    def tearDown(self):
+        MockedIO.tearDown(self)
+        mock.patch.stopall()
+
+    @istest
+    def launches_are_written_before_being_made(self):
+        """
+        Unit: Outbox Writes A Tenant's Launches In One Statement Then Makes Them
+        """
+        instance = self.config.return_value.instance_types[0]
+        shared = Request(instance, 'c4.large', 'us-east-1a', 'ami-1', 1,
+                         bid=0.1)
+        tenant = make_tenant()
+        tenant.idle_jobs = [make_job(10, shared), make_job(11, shared)]
+        req = mock.Mock()
+        req.id = 'sir-1'
+        self.conn.request_spot_instances.return_value = [req]
+
+        LaunchOutbox(workers=0).enqueue(tenant)
+
+        # The jobs share one request, so only one launch is written
+        assert self.db.statements[0].count('), (') == 0
+        kwargs = self.conn.request_spot_instances.call_args[1]
+        assert kwargs['client_token'] == 'token-1'
+        assert kwargs['subnet_id'] == 'subnet-a'
+        assert "values ('sir-1')" in self.db.statements[-1]
+        assert self.db.rows[1]['state'] == 'done'
+
+    @istest
+    def failed_launches_are_retried_until_the_limit(self):
+        """
+        Unit: Outbox Returns Failed Launches For Retry Until Out Of Attempts
+        """
+        outbox = LaunchOutbox(workers=0, max_attempts=2)
+        self.db.execute('insert into launch_outbox')
+        self.conn.request_spot_instances.side_effect = (
+            boto.exception.EC2ResponseError(500, 'Error'))
+        tenant = make_tenant()
+
+        assert outbox.launch(self.db, self.db.rows[1], tenant) is None
+        assert self.db.rows[1]['state'] == 'pending'
+        assert outbox.launch(self.db, self.db.rows[1], tenant) is None
+        assert self.db.rows[1]['state'] == 'failed'
+        # Failed launches aren't claimed again
+        assert outbox.launch(self.db, self.db.rows[1], tenant) is None
+        assert self.conn.request_spot_instances.call_count == 2
+
+    @istest
+    def launches_that_raise_are_released(self):
+        """
+        Unit: Outbox Releases A Launch Whose Request Raises Any Error
+        """
+        outbox = LaunchOutbox(workers=0, max_attempts=2)
+        self.db.execute('insert into launch_outbox')
+        # The tenant no longer has a subnet in the launch's zone
+        tenant = make_tenant()
+        tenant.subnets = {}
+
+        outbox.submit([self.db.rows[1]], tenant)
+        assert self.db.rows[1]['state'] == 'pending'
+        outbox.submit([self.db.rows[1]], tenant)
+        assert self.db.rows[1]['state'] == 'failed'
+        # Launches out of attempts are never claimed
+        assert 'attempts < 2' in self.db.statements[-2]
+
+    @istest
+    def database_errors_skip_the_tenant(self):
+        """
+        Unit: Outbox Skips A Tenant Whose Launches Can't Be Written Or Read
+        """
+        instance = self.config.return_value.instance_types[0]
+        tenant = make_tenant()
+        tenant.idle_jobs = [make_job(10, Request(
+            instance, 'c4.large', 'us-east-1a', 'ami-1', 1, bid=0.1))]
+        error = sqlalchemy.exc.OperationalError('insert', None,
+                                                Exception('closed'))
+        self.db.execute = mock.Mock(side_effect=error)
+        outbox = LaunchOutbox(workers=0)
+
+        assert outbox.enqueue(tenant) == []
+        outbox.resume([tenant])
+        assert self.db.execute.call_count == 2
+        assert not self.conn.request_spot_instances.called
+
+    @istest
+    def spot_requests_send_the_client_token(self):
+        """
+        Unit: Spot Requests Pass Their Client Token To EC2
+        """
+        conn = EC2Connection('access', 'secret')
+        response = mock.Mock()
+        response.status = 200
+        response.read.return_value = (
+            '<RequestSpotInstancesResponse><spotInstanceRequestSet/>'
+            '</RequestSpotInstancesResponse>')
+
+        with mock.patch.object(conn, '_mexe',
+                               return_value=response) as mexe:
+            conn.request_spot_instances(0.1, 'ami-1', client_token='abc')
+            conn.request_spot_instances(0.1, 'ami-1')
+
+        with_token = mexe.call_args_list[0][0][0].params
+        without_token = mexe.call_args_list[1][0][0].params
+        assert with_token['ClientToken'] == 'abc'
+        assert with_token['Version'] == '2016-11-15'
+        assert 'ClientToken' not in without_token
@@ -0,0 +1,109 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance
+from ggprovisioner.cloud.aws.request import make_candidates
+from ggprovisioner.packing import pack_jobs
+from ggprovisioner.scheduler import Job
+from ggprovisioner.scheduler.base_scheduler import stop_over_requesting
+
+
+def make_options(*instances):
+    return make_candidates(instances)
+
+
+def make_job(id_num, cpus, mem, options):
+    job = Job('10.0.0.1', str(id_num), 1, 0, cpus, mem)
+    job.launch_options = options
+    return job
+
+
+SMALL = Instance(1, 'small', 0.2, 1, 4, 10, 'ami')
+SMALL.spot = {'us-east-1a': 0.1}
+LARGE = Instance(2, 'large', 1.6, 16, 64, 10, 'ami')
+LARGE.spot = {'us-east-1a': 0.4, 'us-east-1b': 0.5}
+SUBNETS = {'us-east-1a': 'subnet-1', 'us-east-1b': 'subnet-2'}
+
+
+class TestRunner(MockedIO):
+    @istest
+    def small_jobs_share_a_large_instance(self):
+        """
+        Unit: Packing Puts Small Jobs On A Larger Instance When Cheaper
+        """
+        options = make_options(SMALL, LARGE)
+        jobs = [make_job(i, 1, 2, options) for i in range(20)]
+
+        bins = pack_jobs(jobs, 2.0, SUBNETS)
+
+        found = [(option.instance_type, option.zone, len(packed))
+                 for (option, packed) in bins]
+        # 16 jobs at 0.025 each, the rest are cheaper on their own
+        assert found == [('large', 'us-east-1a', 16)] + [
+            ('small', 'us-east-1a', 1)] * 4, found
+
+    @istest
+    def packing_respects_memory_and_eligibility(self):
+        """
+        Unit: Packing Only Fills Instances Jobs Fit And Can Run On
+        """
+        both = make_options(SMALL, LARGE)
+        large_only = make_options(LARGE)
+        jobs = ([make_job(1, 4, 40, large_only),
+                 make_job(2, 4, 40, large_only)] +
+                [make_job(i, 1, 8, both) for i in range(3, 6)])
+
+        bins = pack_jobs(jobs, 2.0, SUBNETS)
+
+        found = sorted([(option.instance_type,
+                         sorted(int(job.id) for job in packed))
+                        for (option, packed) in bins])
+        assert found == [('large', [1, 3, 4, 5]), ('large', [2])], found
+
+    @istest
+    def unaffordable_jobs_are_left(self):
+        """
+        Unit: Packing Leaves Jobs With No Affordable Spot Option
+        """
+        options = make_options(SMALL, LARGE)
+        jobs = [make_job(1, 8, 8, options), make_job(2, 1, 1, options)]
+
+        bins = pack_jobs(jobs, 0.3, SUBNETS)
+
+        found = [(option.instance_type, [job.id for job in packed])
+                 for (option, packed) in bins]
+        assert found == [('small', ['2'])], found
+
+    @istest
+    def zones_without_a_subnet_are_not_packed(self):
+        """
+        Unit: Packing Only Uses Zones The Tenant Has A Subnet In
+        """
+        elsewhere = Instance(2, 'large', 1.6, 16, 64, 10, 'ami')
+        elsewhere.spot = {'us-east-1b': 0.5, 'us-west-2a': 0.2}
+        options = make_options(SMALL, elsewhere)
+        jobs = [make_job(i, 1, 2, options) for i in range(16)]
+
+        bins = pack_jobs(jobs, 2.0, SUBNETS)
+
+        assert [(option.zone, len(packed)) for (option, packed)
+                in bins] == [('us-east-1b', 16)], bins
+
+    @istest
+    def request_counts_that_fail_leave_the_jobs(self):
+        """
+        Unit: Jobs Are Kept When Their Requests Can't Be Counted
+        """
+        tenant = mock.Mock()
+        tenant.idle_jobs = [make_job(1, 1, 2, [])]
+        error = sqlalchemy.exc.OperationalError('select', None,
+                                                Exception('closed'))
+        with mock.patch('ggprovisioner.scheduler.base_scheduler.'
+                        'ProvisionerConfig') as config:
+            config.return_value.max_requests = 1
+            config.return_value.dbconn.execute.side_effect = error
+            stop_over_requesting([tenant])
+
+        assert len(tenant.idle_jobs) == 1
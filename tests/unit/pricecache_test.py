@@ -0,0 +1,128 @@
+import mmap
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import pricecache
+from ggprovisioner.cloud.aws import Instance
+
+
+def make_instances():
+    small = Instance(1, 'c4.large', 0.1, 2, 3.75, 0, 'ami-1')
+    large = Instance(2, 'c4.xlarge', 0.2, 4, 7.5, 0, 'ami-1')
+    return [small, large]
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'prices')
+        self.clock = 1000000.0
+        self.time_patch = mock.patch.object(pricecache.time, 'time',
+                                            lambda: self.clock)
+        self.time_patch.start()
+
+    def tearDown(self):
+        self.time_patch.stop()
+        shutil.rmtree(self.directory)
+        super(TestRunner, self).tearDown()
+
+    def fetch(self, instances):
+        def fetch():
+            self.fetches += 1
+            instances[0].spot.update({'us-east-1a': 0.03,
+                                      'eu-west-1b': 0.02})
+            instances[1].spot.update({'us-east-1a': 0.06})
+        self.fetches = 0
+        return fetch
+
+    @istest
+    def prices_are_fetched_once_per_host(self):
+        """
+        Unit: Price Table Is Refreshed By One Process And Read By Others
+        """
+        writer = make_instances()
+        fetch = self.fetch(writer)
+        pricecache.PriceCache(self.path).refresh(writer, fetch)
+
+        # Another process reads the prices rather than fetching them
+        reader = make_instances()
+        pricecache.PriceCache(self.path).refresh(reader, fetch)
+        assert self.fetches == 1
+        assert reader[0].spot == {'us-east-1a': 0.03, 'eu-west-1b': 0.02}
+        assert reader[1].spot == {'us-east-1a': 0.06}
+        (refreshed, entries) = pricecache.PriceCache(self.path).entries()
+        assert entries[0] == ('c4.large', 'eu-west-1b', 'eu-west-1', 0.02,
+                              self.clock), entries
+
+        # Stale prices, or prices of other instance types, aren't used
+        self.clock += 301
+        assert not pricecache.PriceCache(self.path).read(make_instances())
+        self.clock -= 301
+        other = Instance(3, 'm4.large', 0.1, 2, 8, 0, 'ami-1')
+        assert not pricecache.PriceCache(self.path).read([other])
+
+    @istest
+    def types_without_spot_prices_are_cached(self):
+        """
+        Unit: Price Table Is Used For Types That Have No Spot Prices
+        """
+        writer = make_instances()
+        fetch = self.fetch(writer)
+        # Not offered as spot anywhere
+        dedicated = Instance(3, 'x1.32xlarge', 13.3, 128, 1952, 0, 'ami-1')
+        writer.append(dedicated)
+        pricecache.PriceCache(self.path).refresh(writer, fetch)
+
+        reader = make_instances() + [
+            Instance(3, 'x1.32xlarge', 13.3, 128, 1952, 0, 'ami-1')]
+        pricecache.PriceCache(self.path).refresh(reader, fetch)
+
+        assert self.fetches == 1
+        assert reader[2].spot == {}
+        (refreshed, entries) = pricecache.PriceCache(self.path).entries()
+        assert len(entries) == 3, entries
+
+    @istest
+    def full_tables_are_replaced(self):
+        """
+        Unit: Price Table Too Small For The Prices Is Replaced And Remapped
+        """
+        instances = make_instances()
+        self.fetch(instances)()
+        reader = pricecache.PriceCache(self.path)
+        writer = pricecache.PriceCache(self.path, capacity=1)
+        writer.write(instances[1:])
+        assert reader.read(make_instances()[1:])
+
+        writer.write(instances)
+        assert writer.table_capacity() == 10
+        # The reader maps the new table
+        read = make_instances()
+        assert reader.read(read)
+        assert read[0].spot == {'us-east-1a': 0.03, 'eu-west-1b': 0.02}
+
+    @istest
+    def tables_being_written_are_not_read(self):
+        """
+        Unit: Price Table Is Not Read While A Write Is In Progress
+        """
+        instances = make_instances()
+        self.fetch(instances)()
+        pricecache.PriceCache(self.path).write(instances)
+        with open(self.path, 'r+b') as f:
+            table = mmap.mmap(f.fileno(), 0)
+        pricecache.SEQUENCE.pack_into(table, pricecache.SEQUENCE_OFFSET, 3)
+
+        with mock.patch.object(pricecache.time, 'sleep') as sleep:
+            assert pricecache.PriceCache(self.path).entries() is None
+        assert sleep.call_count == pricecache.READ_ATTEMPTS
+
+        pricecache.SEQUENCE.pack_into(table, pricecache.SEQUENCE_OFFSET, 4)
+        table.close()
+        assert pricecache.PriceCache(self.path).read(make_instances())
@@ -0,0 +1,65 @@
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.profiling import PhaseProfiler, StackSampler
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def inactive_profiler_records_nothing(self):
+        """
+        Unit: Phase Profiler Does Nothing Until Started
+        """
+        profiler = PhaseProfiler()
+        with profiler.profile('phase'):
+            sum(range(100))
+
+        assert profiler.profiles == {}
+
+    @istest
+    def profiler_writes_one_file_per_phase(self):
+        """
+        Unit: Phase Profiler Writes A pstats File For Each Phase
+        """
+        profiler = PhaseProfiler()
+        profiler.start()
+        with profiler.profile('first'):
+            sum(range(100))
+        with profiler.profile('second'):
+            sum(range(100))
+        profiler.dump(self.directory)
+
+        files = sorted(os.listdir(self.directory))
+        assert files == ['first.pstats', 'second.pstats'], files
+
+    @istest
+    def sampler_writes_folded_stacks(self):
+        """
+        Unit: Stack Sampler Writes Collapsed Stacks For Each Phase
+        """
+        sampler = StackSampler()
+        # samples outside of a phase are dropped
+        sampler.sample(None, sys._getframe())
+        with sampler.profile('phase'):
+            sampler.sample(None, sys._getframe())
+            sampler.sample(None, sys._getframe())
+        sampler.dump(self.directory)
+
+        with open(os.path.join(self.directory, 'phase.folded')) as f:
+            lines = f.readlines()
+        assert len(lines) == 1, lines
+        assert lines[0].endswith(' 2\n'), lines
+        assert 'sampler_writes_folded_stacks' in lines[0], lines
@@ -0,0 +1,104 @@
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import ratelimit
+from ggprovisioner.cloud.aws.connection import EC2Connection
+
+
+class FakeClock(object):
+    """
+    A clock that only moves when something sleeps.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+THROTTLED = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             '</Error></Errors></Response>')
+
+
+class TestRunner(MockedIO):
+    @istest
+    def bucket_allows_burst_then_paces(self):
+        """
+        Unit: Token Bucket Allows A Burst Then Waits For Tokens
+        """
+        clock = FakeClock()
+        bucket = ratelimit.TokenBucket(2, 3, clock=clock.time,
+                                       sleep=clock.sleep)
+
+        waits = [bucket.acquire() for i in range(5)]
+
+        assert waits == [0.0, 0.0, 0.0, 0.5, 0.5], waits
+
+    @istest
+    def bucket_adapts_to_throttling(self):
+        """
+        Unit: Token Bucket Halves Its Rate When Throttled And Recovers
+        """
+        clock = FakeClock()
+        bucket = ratelimit.TokenBucket(8, 10, min_rate=1, clock=clock.time,
+                                       sleep=clock.sleep)
+
+        bucket.throttled()
+        assert bucket.rate == 4
+        assert bucket.acquire() == 0.25
+        for i in range(3):
+            bucket.throttled()
+        assert bucket.rate == 1
+
+        for i in range(100):
+            bucket.succeeded()
+        assert bucket.rate == 8
+
+    @istest
+    def actions_use_separate_budgets(self):
+        """
+        Unit: Describe Calls And Mutating Calls Have Separate Budgets
+        """
+        assert ratelimit.get_kind('DescribeInstances') == ratelimit.DESCRIBE
+        assert (ratelimit.get_kind('GetConsoleOutput') ==
+                ratelimit.DESCRIBE)
+        assert ratelimit.get_kind('RunInstances') == ratelimit.MUTATE
+        assert ratelimit.get_kind('CreateTags') == ratelimit.MUTATE
+
+    @istest
+    def throttled_calls_are_retried(self):
+        """
+        Unit: Throttled EC2 Calls Are Retried Until They Run Out Of Retries
+        """
+        clock = FakeClock()
+        conn = EC2Connection('key', 'secret')
+        conn.limiter = ratelimit.RateLimiter(10, 10, 5, 5, max_retries=2,
+                                             clock=clock.time,
+                                             sleep=clock.sleep)
+        handler = conn.throttle_handler('RunInstances')
+
+        assert handler(FakeResponse(200), 0, 1) is None
+        assert handler(FakeResponse(400, '<Code>InvalidAMI</Code>'),
+                       0, 1) is None
+
+        (msg, attempt, backoff) = handler(FakeResponse(503, THROTTLED), 0, 1)
+        assert attempt == 1
+        assert 0 <= backoff <= 0.5
+        assert conn.limiter.buckets[ratelimit.MUTATE].rate == 2.5
+        assert conn.limiter.buckets[ratelimit.DESCRIBE].rate == 10
+
+        assert handler(FakeResponse(503, THROTTLED), 2, 1) is None
@@ -0,0 +1,113 @@
+import threading
+
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO, ensure_except
+
+from ggprovisioner.cloud.aws import connection, Instance
+from ggprovisioner.cloud.aws.request import make_candidates
+
+
+def make_tenant():
+    tenant = mock.Mock()
+    tenant.zone = 'us-east-1a'
+    tenant.subnets = {'us-east-1a': 'subnet-a', 'eu-west-1b': 'subnet-b'}
+    return tenant
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.config_patch = mock.patch(
+            'ggprovisioner.cloud.aws.connection.ProvisionerConfig')
+        self.config = self.config_patch.start().return_value
+        self.config.regions = ['us-east-1', 'eu-west-1', 'ap-south-1']
+
+    def tearDown(self):
+        self.config_patch.stop()
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def zones_are_mapped_to_regions(self):
+        """
+        Unit: Regions Are Found From Zone Names
+        """
+        assert connection.region_of('us-west-2a') == 'us-west-2'
+        assert connection.region_of('us-west-2-lax-1a') == 'us-west-2'
+        assert connection.region_of('us-gov-west-1b') == 'us-gov-west-1'
+        assert connection.region_of('') is None
+        # Without a zone, calls go to the first region
+        assert connection.zone_region('') == 'us-east-1'
+        # Only the regions the tenant has subnets in are used
+        assert connection.tenant_regions(make_tenant()) == [
+            'us-east-1', 'eu-west-1']
+
+        self.config.regions = []
+        assert connection.zone_region('eu-west-1b') is None
+        assert connection.tenant_regions(make_tenant()) == [None]
+
+    @istest
+    def zones_without_an_image_are_skipped(self):
+        """
+        Unit: Candidates Are Only Made In Regions With An Image
+        """
+        ins = Instance(1, 'large', 0.4, 8, 32, 10, 'ami-east')
+        ins.amis = {'us-east-1': 'ami-east', 'eu-west-1': 'ami-west'}
+        ins.spot = {'us-east-1a': 0.1, 'eu-west-1b': 0.05,
+                    'ap-south-1a': 0.01}
+
+        candidates = make_candidates([ins])
+
+        assert [(c.zone, c.ami) for c in candidates] == [
+            ('eu-west-1b', 'ami-west'), ('us-east-1a', 'ami-east'),
+            ('', 'ami-east')], candidates
+
+    @istest
+    def regions_are_called_at_the_same_time(self):
+        """
+        Unit: Regions Are Queried Concurrently
+        """
+        started = []
+        both = threading.Event()
+        lock = threading.Lock()
+
+        def call(conn):
+            with lock:
+                started.append(conn)
+                if len(started) == 2:
+                    both.set()
+            # Each call waits for the other, so they must run together
+            assert both.wait(5)
+            return conn.region
+
+        def get_connection(tenant, region):
+            conn = mock.Mock()
+            conn.region = region
+            return conn
+
+        with mock.patch.object(connection, 'get_connection',
+                               get_connection):
+            results = connection.map_regions(make_tenant(), call)
+
+        assert results == [('us-east-1', 'us-east-1'),
+                           ('eu-west-1', 'eu-west-1')]
+
+    @istest
+    def region_errors_are_raised(self):
+        """
+        Unit: An Error In One Region Is Raised Once All Have Finished
+        """
+        def call(conn):
+            if conn.region == 'eu-west-1':
+                raise ValueError(conn.region)
+            return conn.region
+
+        def get_connection(tenant, region):
+            conn = mock.Mock()
+            conn.region = region
+            return conn
+
+        with mock.patch.object(connection, 'get_connection',
+                               get_connection):
+            ensure_except(ValueError, connection.map_regions, make_tenant(),
+                          call)
@@ -0,0 +1,143 @@
+import datetime
+import decimal
+import gzip
+import os
+import subprocess
+import tempfile
+
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO, ensure_except
+
+from ggprovisioner.replay import (decode, encode, Recorder,
+                                  RecordingConnection, RecordingDatabase,
+                                  ReplayConnection, ReplayDatabase, Replayer,
+                                  TraceMismatch)
+from ggprovisioner.simulation import FakeCloud
+from ggprovisioner.simulation.cloud import FakeInstance
+
+TYPES = {'small': (2, 8, 0.1)}
+ZONES = ['us-east-1a']
+
+
+def make_result(keys, rows):
+    result = mock.Mock()
+    result.returns_rows = True
+    result.keys.return_value = keys
+    result.fetchall.return_value = rows
+    result.rowcount = len(rows)
+    return result
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        (handle, self.path) = tempfile.mkstemp(suffix='.json.gz')
+        os.close(handle)
+        self.recorder = Recorder(self.path)
+        self.recorder.write({'version': 1, 'settings': {}})
+        self.recorder.write({'cycle': 1, 'clock': 1000.0})
+
+    def tearDown(self):
+        super(TestRunner, self).tearDown()
+        os.remove(self.path)
+
+    def replay(self):
+        """
+        Close the trace and get ready to replay its first cycle.
+        """
+        self.recorder.close()
+        replayer = Replayer(self.path)
+        replayer.load(replayer.trace.cycles[0][1])
+        return replayer
+
+    @istest
+    def values_survive_encoding(self):
+        """
+        Unit: Replay Reads Back Recorded Values And Objects
+        """
+        inst = FakeInstance('i-1', 'small', 'subnet-a', 0)
+        inst.tags = {'tenant': 'sim'}
+        value = {'price': decimal.Decimal('0.125'),
+                 'when': datetime.datetime(2015, 1, 5, 12, 30),
+                 'instances': [inst], 'ids': set(['b', 'a'])}
+
+        read = decode(encode(value))
+
+        assert read['price'] == decimal.Decimal('0.125')
+        assert read['when'] == datetime.datetime(2015, 1, 5, 12, 30)
+        assert read['instances'][0].id == 'i-1'
+        assert read['instances'][0].state == 'pending'
+        assert read['instances'][0].tags == {'tenant': 'sim'}
+        assert read['ids'] == ['a', 'b']
+
+    @istest
+    def statements_are_replayed(self):
+        """
+        Unit: Replay Answers Statements With Their Recorded Rows
+        """
+        conn = mock.Mock()
+        conn.execute.return_value = make_result(
+            ['id', 'secret_key'], [(1, 'hunter2'), (2, 'hunter3')])
+        rows = RecordingDatabase(self.recorder, conn).execute(
+            "select id, secret_key from aws_credentials")
+        assert [r['secret_key'] for r in rows] == ['hunter2', 'hunter3']
+
+        replayer = self.replay()
+        rows = ReplayDatabase(replayer).execute(
+            "select id, secret_key from aws_credentials")
+
+        assert [(r['id'], r[1]) for r in rows] == [(1, 'redacted'),
+                                                   (2, 'redacted')]
+        assert replayer.missing == [0]
+
+    @istest
+    def ec2_calls_are_replayed(self):
+        """
+        Unit: Replay Answers EC2 Calls With Their Recorded Responses
+        """
+        cloud = FakeCloud(TYPES, ZONES, boot_cycles=0)
+        conn = RecordingConnection(self.recorder, cloud.connect('key', 's'))
+        conn.run_instances('ami', 2, 2, 'small', 'subnet-a',
+                           user_data='secret')
+        cloud.advance()
+        page = conn.get_all_reservations(max_results=1)
+
+        replayer = self.replay()
+        replayed = ReplayConnection(replayer)
+        replayed.run_instances('ami', 2, 2, 'small', 'subnet-a',
+                               user_data='other')
+        result = replayed.get_all_reservations(max_results=1)
+
+        assert result.next_token == page.next_token
+        [inst] = result[0].instances
+        assert inst.id == page[0].instances[0].id
+        assert inst.state == 'running'
+        assert 'secret' not in gzip.open(self.path).read()
+
+    @istest
+    def unrecorded_calls_are_reported(self):
+        """
+        Unit: Replay Reports Calls That Were Not Recorded
+        """
+        replayer = self.replay()
+
+        rows = ReplayDatabase(replayer).execute("select 1")
+        assert list(rows) == []
+        ensure_except(TraceMismatch,
+                      ReplayConnection(replayer).get_all_instances)
+        assert replayer.missing == [2]
+
+    @istest
+    def commands_are_replayed(self):
+        """
+        Unit: Replay Answers Condor Commands With Their Recorded Output
+        """
+        proc = self.recorder.popen(['echo', 'a:1'], stdout=subprocess.PIPE)
+        assert proc.communicate()[0] == 'a:1\n'
+
+        replayer = self.replay()
+        proc = replayer.popen(['echo', 'a:1'], stdout=subprocess.PIPE)
+
+        assert list(iter(proc.stdout.readline, '')) == ['a:1\n']
+        assert proc.wait() == 0
@@ -0,0 +1,79 @@
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import Instance
+from ggprovisioner.cloud.aws.manager import (assign_requests_to_jobs,
+                                             record_request_migrations)
+from ggprovisioner.scheduler import Job
+
+INSTANCE_TYPES = {
+    'small': Instance(1, 'small', 0.1, 2, 4, 10, 'ami'),
+    'large': Instance(2, 'large', 0.4, 8, 32, 10, 'ami')}
+
+
+def make_request(id_num, ins_type):
+    return {'id': id_num, 'type': ins_type, 'job_runner_id': 100,
+            'request_id': 'sir-%s' % id_num}
+
+
+def make_job(id_num, cpus, mem):
+    return Job('tenant', id_num, '1', '0', cpus, mem)
+
+
+class TestRunner(MockedIO):
+    @istest
+    def request_migrated_to_one_job_only(self):
+        """
+        Unit: Request Migration Assigns Each Request To At Most One Job
+        """
+        reqs = [make_request(1, 'small')]
+        jobs = [make_job('1', '1', 1), make_job('2', '1', 1)]
+
+        assignments = assign_requests_to_jobs(reqs, jobs, INSTANCE_TYPES)
+
+        assert len(assignments) == 1, assignments
+
+    @istest
+    def large_jobs_get_large_requests(self):
+        """
+        Unit: Request Migration Keeps Large Requests For Large Jobs
+        """
+        reqs = [make_request(1, 'large'), make_request(2, 'small')]
+        small_job = make_job('1', '1', 1)
+        large_job = make_job('2', '8', 16)
+
+        assignments = assign_requests_to_jobs(reqs, [small_job, large_job],
+                                              INSTANCE_TYPES)
+
+        assigned = dict((job.id, req['type']) for (req, job) in assignments)
+        assert assigned == {'1': 'small', '2': 'large'}, assigned
+
+    @istest
+    def unfit_and_unknown_requests_are_left(self):
+        """
+        Unit: Request Migration Skips Requests Too Small Or Of Unknown Type
+        """
+        reqs = [make_request(1, 'small'), make_request(2, 'retired')]
+        jobs = [make_job('1', '4', 8)]
+
+        assignments = assign_requests_to_jobs(reqs, jobs, INSTANCE_TYPES)
+
+        assert assignments == [], assignments
+
+    @istest
+    def migrations_are_committed(self):
+        """
+        Unit: Request Migration Statement Is Executed With Autocommit
+        """
+        jobs = [make_job('7', '1', 1)]
+        with mock.patch('ggprovisioner.cloud.aws.manager.'
+                        'ProvisionerConfig') as config:
+            assert record_request_migrations([(make_request(1, 'small'),
+                                               jobs[0])])
+
+        statement = config.return_value.dbconn.execute.call_args[0][0]
+        assert statement.get_execution_options()['autocommit']
+        # Unpacking a moved request is committed with the migration
+        assert 'delete from instance_request_job' in str(statement)
+        assert '(1, 100, 7)' in str(statement), str(statement)
@@ -0,0 +1,57 @@
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.scheduler import Slot
+from ggprovisioner.cloud.aws.scaler import (get_idle_machines,
+                                            select_idle_workers)
+
+# 2015-01-01T00:00:00Z
+EPOCH = 1420070400
+
+
+def make_instance(id_num, hostname, launch_time):
+    inst = mock.Mock()
+    inst.id = id_num
+    inst.private_dns_name = hostname
+    inst.launch_time = launch_time
+    return inst
+
+
+class TestRunner(MockedIO):
+    @istest
+    def idle_machines_skip_busy_and_reserved(self):
+        """
+        Unit: Scale In Only Considers Machines With No Claimed Or Reserved Slots
+        """
+        tenant = mock.Mock()
+        tenant.slots = [
+            Slot('slot1@a', 'a', 'Unclaimed', 'Idle', 'Static', 1, 1, 100),
+            Slot('slot2@a', 'a', 'Claimed', 'Busy', 'Static', 1, 1, 100),
+            Slot('slot1@b', 'b', 'Unclaimed', 'Idle', 'Static', 1, 1, 100),
+            Slot('slot2@b', 'b', 'Unclaimed', 'Idle', 'Static', 1, 1, 400),
+            Slot('slot1@c', 'c', 'Unclaimed', 'Idle', 'Static', 1, 1, 100)]
+        tenant.reserved_machines = set(['c'])
+
+        machines = get_idle_machines(tenant, 1000)
+
+        # b has only been idle since its second slot went idle
+        assert machines == {'b': 600}, machines
+
+    @istest
+    def idle_workers_ordered_by_billing_boundary(self):
+        """
+        Unit: Scale In Prefers Workers Nearest Their Billing Boundary
+        """
+        instances = [
+            make_instance('i-1', 'a', '2015-01-01T00:00:00.000Z'),
+            make_instance('i-2', 'b', '2015-01-01T00:30:00.000Z'),
+            make_instance('i-3', 'c', '2015-01-01T00:00:00.000Z')]
+        idle = {'a': 1200, 'b': 1200, 'c': 10}
+        now = EPOCH + 3000
+
+        workers = select_idle_workers(instances, idle, now, 600, 3600)
+
+        # c has not been idle long enough, a is 10 minutes from its boundary
+        assert [w[0].id for w in workers] == ['i-1', 'i-2'], workers
+        assert workers[0][2] == 600
@@ -0,0 +1,108 @@
+import mock
+import psycopg2
+import sqlalchemy.exc
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.sharding import ShardCoordinator
+
+
+class FakeLocks(object):
+    """
+    Advisory locks shared between replicas, and the number of live
+    replicas.
+    """
+    def __init__(self, replicas=1):
+        self.replicas = replicas
+        self.owners = {}
+
+    def coordinator(self, replica_id):
+        shards = ShardCoordinator(replica_id)
+        shards.conn = mock.Mock()
+
+        def execute(statement, params=None):
+            if 'pg_try_advisory_lock' in statement:
+                owner = self.owners.setdefault(params[1], replica_id)
+                return [(owner == replica_id,)]
+            if 'pg_advisory_unlock' in statement:
+                del self.owners[params[1]]
+                return [(True,)]
+            if 'count(*)' in statement:
+                return [(self.replicas,)]
+        shards.execute = execute
+        return shards
+
+
+def make_tenants(count):
+    tenants = []
+    for n in range(count):
+        t = mock.Mock()
+        t.db_id = n
+        tenants.append(t)
+    return tenants
+
+
+class TestRunner(MockedIO):
+    @istest
+    def tenants_are_split_between_replicas(self):
+        """
+        Unit: Sharding Splits Tenants Between Replicas Without Overlap
+        """
+        locks = FakeLocks(replicas=2)
+        tenants = make_tenants(5)
+        first = locks.coordinator('a')
+        second = locks.coordinator('b')
+
+        with mock.patch('ggprovisioner.sharding.InstanceTracker'):
+            held_first = first.claim(tenants)
+            held_second = second.claim(tenants)
+
+        assert len(held_first) == 3
+        assert len(held_second) == 2
+        assert not set(held_first) & set(held_second)
+
+    @istest
+    def extra_tenants_are_released_when_a_replica_joins(self):
+        """
+        Unit: Sharding Releases Tenants Beyond Its Share To A New Replica
+        """
+        locks = FakeLocks(replicas=1)
+        tenants = make_tenants(4)
+        first = locks.coordinator('a')
+
+        with mock.patch('ggprovisioner.sharding.InstanceTracker') as tracker:
+            assert len(first.claim(tenants)) == 4
+            locks.replicas = 2
+            assert len(first.claim(tenants)) == 2
+            second = locks.coordinator('b')
+            assert len(second.claim(tenants)) == 2
+
+        # The newly held tenants' tracked instances are forgotten
+        assert tracker.return_value.forget.call_count == 6
+
+    @istest
+    def nothing_is_processed_without_coordination(self):
+        """
+        Unit: Sharding Processes No Tenants If The Locks Are Lost
+        """
+        shards = ShardCoordinator('a')
+        shards.conn = mock.Mock()
+        shards.held = set([1])
+        shards.execute = mock.Mock(side_effect=psycopg2.OperationalError)
+
+        assert shards.claim(make_tenants(2)) == []
+        assert shards.held == set()
+        assert shards.conn is None
+
+    @istest
+    def failed_reconnects_process_nothing(self):
+        """
+        Unit: Sharding Processes No Tenants While It Can't Reconnect
+        """
+        shards = ShardCoordinator('a')
+        error = sqlalchemy.exc.OperationalError('connect', None,
+                                                Exception('refused'))
+        with mock.patch('ggprovisioner.sharding.ProvisionerConfig') as config:
+            config.return_value.engine.raw_connection.side_effect = error
+            assert shards.claim(make_tenants(2)) == []
+        assert shards.conn is None
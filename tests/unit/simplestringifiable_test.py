@@ -14,6 +14,17 @@ class Testclass(SimpleStringifiable):
         self.x = x
 
 
+class Slotted(SimpleStringifiable):
+    """
+    A class with slotted attributes for use in the tests below
+    """
+    __slots__ = ('y', 'x')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
 class TestRunner(MockedIO):
     @istest
     def simplestringifiable_repr_intattrs(self):
@@ -68,3 +79,17 @@ class TestRunner(MockedIO):
         alpha.y = 2
         # validate its repr
         assert repr(alpha) == "Testclass(x=1,y=2)", repr(alpha)
+
+    @istest
+    def simplestringifiable_repr_slots(self):
+        """
+        Unit: SimpleStringifiable repr() With Slotted Attributes
+        """
+        # create an instance, leaving one slot unset
+        alpha = Slotted(2, 1)
+        del alpha.y
+        # validate its repr, which should match a dict-backed instance
+        assert repr(alpha) == "Slotted(x=2)", repr(alpha)
+        alpha.y = 1
+        assert repr(alpha) == "Slotted(x=2,y=1)", repr(alpha)
+        assert str(alpha) == "Slotted:\n    x: 2\n    y: 1", str(alpha)
@@ -0,0 +1,171 @@
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.simulation import (CountingConnection, FakeCloud,
+                                      SimulatedPool, SyntheticScheduler)
+from ggprovisioner.simulation.harness import PhaseRecorder
+
+TYPES = {'small': (2, 8, 0.1), 'large': (8, 32, 0.4)}
+ZONES = ['us-east-1a', 'us-east-1b']
+
+
+def make_pool():
+    return SimulatedPool('pool.sim', '10.0.0.1', ['subnet-a', 'subnet-b'])
+
+
+class TestRunner(MockedIO):
+    @istest
+    def spot_requests_are_fulfilled(self):
+        """
+        Unit: Simulation Fulfils Spot Requests And Boots Their Instances
+        """
+        cloud = FakeCloud(TYPES, ZONES, fulfil_cycles=2, boot_cycles=1)
+        conn = cloud.connect('key', 'secret')
+        [req] = conn.request_spot_instances(0.1, 'ami', 1, 'small',
+                                            'subnet-a')
+        conn.create_tags([req.id], {'tenant': 'sim'})
+
+        cloud.advance()
+        assert req.state == 'open'
+        cloud.advance()
+        assert req.state == 'active'
+        inst = cloud.instances[req.instance_id]
+        assert inst.state == 'pending'
+        cloud.advance()
+        assert inst.state == 'running'
+        assert inst.spot_instance_request_id == req.id
+        assert cloud.running_instances(set(['subnet-a'])) == [inst]
+        assert cloud.calls == {'RequestSpotInstances': 1, 'CreateTags': 1}
+
+    @istest
+    def cancelled_requests_are_not_fulfilled(self):
+        """
+        Unit: Simulation Does Not Fulfil Cancelled Spot Requests
+        """
+        cloud = FakeCloud(TYPES, ZONES)
+        conn = cloud.connect('key', 'secret')
+        reqs = conn.request_spot_instances(0.1, 'ami', 2, 'small', 'subnet-a')
+        for req in reqs:
+            conn.create_tags([req.id], {'tenant': 'sim'})
+        conn.cancel_spot_instance_requests([reqs[0].id])
+
+        cloud.advance()
+
+        open_reqs = conn.get_all_spot_instance_requests(
+            filters={'tag-value': 'sim', 'state': 'open'})
+        assert open_reqs == []
+        assert [r.state for r in reqs] == ['cancelled', 'active']
+        assert len(cloud.instances) == 1
+
+    @istest
+    def reservations_are_paged(self):
+        """
+        Unit: Simulation Pages Instances Matching The Filters
+        """
+        cloud = FakeCloud(TYPES, ZONES, boot_cycles=0)
+        conn = cloud.connect('key', 'secret')
+        conn.run_instances('ami', 5, 5, 'small', 'subnet-a')
+        conn.run_instances('ami', 1, 1, 'small', 'subnet-z')
+        cloud.advance()
+
+        filters = {'subnet-id': ['subnet-a'],
+                   'instance-state-name': ['pending', 'running']}
+        first = conn.get_all_reservations(filters=filters, max_results=3)
+        second = conn.get_all_reservations(filters=filters, max_results=3,
+                                           next_token=first.next_token)
+
+        assert len(first[0].instances) == 3
+        assert len(second[0].instances) == 2
+        assert second.next_token is None
+        assert cloud.calls['DescribeInstances'] == 2
+
+    @istest
+    def terminated_instances_are_forgotten(self):
+        """
+        Unit: Simulation Terminates Instances And Then Forgets Them
+        """
+        cloud = FakeCloud(TYPES, ZONES, boot_cycles=0)
+        conn = cloud.connect('key', 'secret')
+        [inst] = conn.run_instances('ami', 1, 1, 'small',
+                                    'subnet-a').instances
+        cloud.advance()
+        conn.terminate_instances([inst.id])
+
+        cloud.advance()
+        assert inst.state == 'terminated'
+        cloud.advance()
+        cloud.advance()
+        assert inst.id not in cloud.instances
+
+    @istest
+    def jobs_run_on_machines(self):
+        """
+        Unit: Simulation Starts Queued Jobs On Running Instances
+        """
+        cloud = FakeCloud(TYPES, ZONES, boot_cycles=0)
+        pool = make_pool()
+        sched = SyntheticScheduler(cloud, [pool], 3, runtime_cycles=2,
+                                   shapes=[(1, 2, 1)])
+        conn = cloud.connect('key', 'secret')
+        [inst] = conn.run_instances('ami', 1, 1, 'small',
+                                    'subnet-a').instances
+
+        sched.advance()
+        assert [j.status for j in sched.get_global_queue()] == ['1'] * 3
+
+        cloud.advance()
+        sched.advance()
+        statuses = sorted(j.status for j in sched.get_global_queue())
+        # The instance has room for two of the jobs
+        assert statuses == ['1', '2', '2'], statuses
+        slots = sched.get_status('10.0.0.1')
+        assert [(s.state, s.cpus) for s in slots] == [('Claimed', 2)]
+
+        sched.advance()
+        sched.advance()
+        # The first two have finished and the last has started
+        assert [j.status for j in sched.get_global_queue()] == ['2']
+        [slot] = [s for s in sched.get_status('10.0.0.1') if s.is_free()]
+        assert slot.cpus == 1
+
+    @istest
+    def jobs_are_matched_to_tenants(self):
+        """
+        Unit: Simulation Jobs Are Matched To Their Tenant's Idle Jobs
+        """
+        cloud = FakeCloud(TYPES, ZONES)
+        sched = SyntheticScheduler(cloud, [make_pool()], 4)
+        tenant = mock.Mock()
+        tenant.condor_address = 'pool.sim'
+        tenant.idle_time = 10
+        tenant.jobs = []
+        tenant.idle_jobs = []
+
+        sched.process_global_queue(sched.get_global_queue(), [tenant])
+
+        assert len(tenant.idle_jobs) == 4
+
+    @istest
+    def phases_are_recorded(self):
+        """
+        Unit: Simulation Records The Queries And Calls Of Each Phase
+        """
+        cloud = FakeCloud(TYPES, ZONES)
+        dbconn = CountingConnection(mock.Mock())
+        recorder = PhaseRecorder(dbconn, cloud)
+        conn = cloud.connect('key', 'secret')
+
+        for cycle in range(2):
+            recorder.new_cycle()
+            with recorder.profile('load'):
+                dbconn.execute("select 1")
+                dbconn.execute("select 2")
+            with recorder.profile('provision'):
+                conn.get_spot_price_history('small')
+
+        summary = recorder.summary()
+        assert summary['load']['queries'] == {'mean': 2, 'max': 2}
+        assert summary['load']['api_calls']['mean'] == 0
+        assert summary['provision']['api_calls'] == {'mean': 1, 'max': 1}
+        assert dbconn.queries == 4
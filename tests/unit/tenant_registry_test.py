@@ -0,0 +1,63 @@
+import mock
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner import tenant
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        self.config_patch = mock.patch(
+            'ggprovisioner.tenant.ProvisionerConfig')
+        self.listener_patch = mock.patch(
+            'ggprovisioner.tenant.ChangeListener')
+        self.load_patch = mock.patch('ggprovisioner.tenant.load_from_db')
+        config = self.config_patch.start()
+        config.return_value.cache_refresh_rate = 3600
+        self.listener = self.listener_patch.start().return_value
+        self.load = self.load_patch.start()
+        try:
+            del tenant.TenantRegistry._instance
+        except AttributeError:
+            pass
+
+    def tearDown(self):
+        self.config_patch.stop()
+        self.listener_patch.stop()
+        self.load_patch.stop()
+        super(TestRunner, self).tearDown()
+
+    @istest
+    def registry_reuses_tenants_until_notified(self):
+        """
+        Unit: Tenant Registry Only Reloads Tenants When Notified
+        """
+        cached = mock.Mock()
+        self.load.return_value = [cached]
+        self.listener.changed.side_effect = [True, False, True]
+        registry = tenant.TenantRegistry()
+
+        assert registry.get_tenants() == [cached]
+        assert registry.get_tenants() == [cached]
+        # the cached tenant's jobs are cleared instead of reloading it
+        cached.reset_cycle_state.assert_called_once_with()
+        assert self.load.call_count == 1
+
+        registry.get_tenants()
+        assert self.load.call_count == 2
+
+    @istest
+    def registry_reloads_expired_tenants(self):
+        """
+        Unit: Tenant Registry Reloads Tenants Older Than The Refresh Rate
+        """
+        self.load.return_value = []
+        self.listener.changed.return_value = False
+        registry = tenant.TenantRegistry()
+
+        registry.get_tenants()
+        registry.loaded_time -= 3601
+        registry.get_tenants()
+
+        assert self.load.call_count == 2
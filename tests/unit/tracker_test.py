@@ -0,0 +1,123 @@
+import mock
+import sqlalchemy
+from nose.tools import istest
+from tests.helpers import MockedIO
+
+from ggprovisioner.cloud.aws import manager
+from ggprovisioner.cloud.aws.tracker import InstanceTracker, iter_instances
+
+
+def make_instance(id_num, state):
+    inst = mock.Mock()
+    inst.id = id_num
+    inst.state = state
+    return inst
+
+
+def make_tenant():
+    tenant = mock.Mock()
+    tenant.db_id = 1
+    return tenant
+
+
+class TestRunner(MockedIO):
+    def setUp(self):
+        super(TestRunner, self).setUp()
+        # give each test a fresh tracker
+        try:
+            del InstanceTracker._instance
+        except AttributeError:
+            pass
+
+    @istest
+    def tracker_reports_only_transitions(self):
+        """
+        Unit: Instance Tracker Only Reports Instances That Change State
+        """
+        tracker = InstanceTracker()
+        tenant = make_tenant()
+
+        launched, terminated = tracker.update(
+            tenant, [make_instance('i-1', 'pending'),
+                     make_instance('i-2', 'running')])
+        assert [i.id for i in launched] == ['i-2']
+        assert terminated == []
+
+        launched, terminated = tracker.update(
+            tenant, [make_instance('i-1', 'running'),
+                     make_instance('i-2', 'running')])
+        assert [i.id for i in launched] == ['i-1']
+
+        launched, terminated = tracker.update(
+            tenant, [make_instance('i-1', 'running'),
+                     make_instance('i-2', 'terminated')])
+        assert launched == []
+        assert [i.id for i in terminated] == ['i-2']
+
+    @istest
+    def tracker_ignores_duplicates(self):
+        """
+        Unit: Instance Tracker Reports An Instance Returned Twice Once
+        """
+        tracker = InstanceTracker()
+        inst = make_instance('i-1', 'running')
+
+        launched, terminated = tracker.update(make_tenant(), [inst, inst])
+
+        assert launched == [inst]
+
+    @istest
+    def tracker_retries_unmatched_instances(self):
+        """
+        Unit: Instance Tracker Reports Unmatched Instances Again
+        """
+        tracker = InstanceTracker()
+        tenant = make_tenant()
+        inst = make_instance('i-1', 'running')
+
+        launched, terminated = tracker.update(tenant, [inst])
+        tracker.retry(tenant, launched)
+        launched, terminated = tracker.update(tenant, [inst])
+
+        assert launched == [inst]
+
+    @istest
+    def unrecorded_changes_are_reported_again(self):
+        """
+        Unit: Instances Are Reported Again When The Database Write Fails
+        """
+        tenant = make_tenant()
+        conn = mock.Mock()
+        instances = [make_instance('i-1', 'running'),
+                     make_instance('i-2', 'terminated')]
+        error = sqlalchemy.exc.OperationalError('insert', None,
+                                                Exception('closed'))
+        with mock.patch.object(manager, 'map_regions',
+                               return_value=[(None, (conn, instances))]):
+            with mock.patch.object(manager, 'check_for_new_instances',
+                                   side_effect=error):
+                manager.update_database([tenant])
+
+        launched, terminated = InstanceTracker().update(tenant, instances)
+
+        assert [i.id for i in launched] == ['i-1']
+        assert [i.id for i in terminated] == ['i-2']
+
+    @istest
+    def iter_instances_follows_pages(self):
+        """
+        Unit: Instance Iteration Requests Every Page Of Reservations
+        """
+        first = mock.MagicMock()
+        first.__iter__.return_value = [mock.Mock(instances=['a', 'b'])]
+        first.next_token = 'token'
+        second = mock.MagicMock()
+        second.__iter__.return_value = [mock.Mock(instances=['c'])]
+        second.next_token = None
+        conn = mock.Mock()
+        conn.get_all_reservations.side_effect = [first, second]
+
+        instances = list(iter_instances(conn, {}))
+
+        assert instances == ['a', 'b', 'c'], instances
+        assert conn.get_all_reservations.call_count == 2